@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
 from typing import Callable, Optional, Union
 
 import torch
@@ -71,6 +72,278 @@ def cape_embed(p1, p2, qq, kk):
 
     return q, k
 
+def cape_table(p, d, dtype):
+    # p: b t pose_dim pose of each view, d: feature dim
+    # rotary table of each view, b t 1 d/2, broadcast over the tokens of the view. cape() repeats every pose entry
+    # d // n times, i.e. one angle per pair of features rotated by rotate_every_two
+    n = p.shape[-1]
+    assert d % (2 * n) == 0
+    m = einops.repeat(p.to(dtype), 'b t n -> b t 1 (n k)', k=d // (2 * n))
+    if dtype in (torch.float32, torch.float64):
+        # fused rotation as a complex multiply
+        return torch.polar(torch.ones_like(m), m)
+    return m.cos(), m.sin()
+
+def cape_rotate_views(x, table):
+    # x: b (t l) d feature, table: rotary table of each view from cape_table
+    # same as (x * m.cos()) + (rotate_every_two(x) * m.sin()) with m = cape(x, repeat(p, 'b t n -> b (t l) n'))
+    b, n, d = x.shape
+    if torch.is_tensor(table):
+        t = table.shape[1]
+        x = torch.view_as_complex(x.to(table.real.dtype).reshape(b, t, n // t, d // 2, 2))
+        return torch.view_as_real(x * table).reshape(b, n, d)
+    cos, sin = table
+    t = cos.shape[1]
+    x1, x2 = x.to(cos.dtype).reshape(b, t, n // t, d // 2, 2).unbind(dim=-1)
+    return torch.stack((x1 * cos - x2 * sin, x2 * cos + x1 * sin), dim=-1).reshape(b, n, d)
+
+class CaPEPoses(list):
+    r"""
+    4DoF CaPE poses `[p_out, p_in]` that cache their rotary tables.
+
+    The poses stay the same for all attention layers (and denoising steps), so the cos/sin tables are built once per
+    pose set and feature dimension instead of on every query and key. [`prepare_posemb`] builds it at the start of the
+    UNet forward; the pipeline builds it once per generation so the tables are also shared across timesteps. It can be
+    passed as `posemb` anywhere a plain `[p_out, p_in]` list is expected.
+
+    When the reference tokens are pruned or merged (see `reference_tokens.py`), `reference_views` `[b, n]` gives the
+    reference view of every key token, and the keys get the pose of their own view instead of one pose per
+    `l` tokens.
+    """
+
+    def __init__(self, posemb, reference_views=None):
+        super().__init__(posemb)
+        self.reference_views = reference_views
+        self.tables = {}
+        self.subsets = {}
+
+    def rotate(self, x, i):
+        # x: b (t l) d feature of the views with pose self[i], b n d reference tokens if reference_views is set
+        dtype = torch.promote_types(x.dtype, self[i].dtype)
+        key = (i, x.shape[-1], dtype, x.device)
+        if key not in self.tables:
+            pose = self[i].to(x.device)
+            if i == 1 and self.reference_views is not None:
+                batch = torch.arange(pose.shape[0], device=x.device)[:, None]
+                pose = pose[batch, self.reference_views.to(x.device)]  # one pose per token, b n pose_dim
+            self.tables[key] = cape_table(pose, x.shape[-1], dtype)
+        return cape_rotate_views(x, self.tables[key])
+
+    def embed_query(self, query):
+        # query: b (t_out l) d
+        return self.rotate(query, 0)
+
+    def embed_key(self, key, self_attn):
+        # key: b (t_in l) d for cross-attn or b (t_out l) d for self-attn
+        return self.rotate(key, 0 if self_attn else 1)
+
+    def objects(self, start):
+        # poses of the objects from `start` on, e.g. the conditional half of classifier-free guidance
+        if start not in self.subsets:
+            self.subsets[start] = CaPEPoses(
+                [poses[start:] for poses in self],
+                None if self.reference_views is None else self.reference_views[start:],
+            )
+        return self.subsets[start]
+
+    def samples(self, n):
+        # poses of `n` samples per object, consecutive in the batch, as the target views of one object each, so the
+        # cross-attention of the samples shares the reference keys and values of their object
+        key = ("samples", n)
+        if key not in self.subsets:
+            pose_out, pose_in = self
+            self.subsets[key] = CaPEPoses(
+                [pose_out.reshape(-1, n * pose_out.shape[1], *pose_out.shape[2:]), pose_in[::n]],
+                None if self.reference_views is None else self.reference_views[::n],
+            )
+        return self.subsets[key]
+
+    def target_views(self, views):
+        # poses of the target views `views` only, e.g. the views that are not frozen yet
+        key = ("views", tuple(views.tolist()))
+        if key not in self.subsets:
+            self.subsets[key] = CaPEPoses([self[0][:, views.to(self[0].device)], self[1]], self.reference_views)
+        return self.subsets[key]
+
+def prepare_posemb(posemb, reference_views=None):
+    # prepare the CaPE poses once, shared by all attention layers
+    if isinstance(posemb, CaPEPoses) and reference_views is None:
+        return posemb
+    return CaPEPoses(posemb, reference_views)
+
+def cape_query(query, posemb):
+    # query: b (t_out l) d
+    return prepare_posemb(posemb).embed_query(query)
+
+def cape_key(key, posemb, self_attn):
+    # key: b (t_in l) d for cross-attn or b (t_out l) d for self-attn
+    return prepare_posemb(posemb).embed_key(key, self_attn)
+
+def view_angles(p):
+    # p: b t pose_dim pose [theta, azimuth, radius, 0], angle between the camera directions of every two views, b t t
+    theta, azimuth = p[..., 0].float(), p[..., 1].float()
+    xyz = torch.stack([theta.sin() * azimuth.cos(), theta.sin() * azimuth.sin(), theta.cos()], dim=-1)
+    return torch.acos((xyz @ xyz.transpose(1, 2)).clamp(-1, 1))
+
+def farthest_views(angles, n):
+    # angles: b t t, greedily pick n views spread over all cameras starting from view 0, b n
+    b, t, _ = angles.shape
+    index = torch.zeros(b, min(n, t), dtype=torch.long, device=angles.device)
+    dist = angles[:, 0]
+    for i in range(1, index.shape[1]):
+        index[:, i] = dist.argmax(dim=-1)
+        dist = torch.minimum(dist, angles[torch.arange(b, device=angles.device), index[:, i]])
+    return index
+
+class ViewNeighbors:
+    r"""
+    Camera-proximity sparse pattern of the multiview self-attention between the target views.
+
+    Every target view attends to the tokens of its `k` nearest target views by angular distance and of `num_anchors`
+    global anchor views spread over all cameras, instead of the tokens of all `t_out` views, so the self-attention
+    cost grows linearly instead of quadratically in `t_out`. Pass it to the attention processors through
+    `cross_attention_kwargs={"view_neighbors": ViewNeighbors.from_posemb(posemb, k)}`, it is supported by
+    [`CaPEAttnProcessor2_0`].
+
+    Args:
+        index (`torch.LongTensor`):
+            The views attended by each target view, `[b, t_out, m]`.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    @classmethod
+    def from_posemb(cls, posemb, k, num_anchors=0):
+        angles = view_angles(posemb[0])
+        b, t, _ = angles.shape
+        anchors = farthest_views(angles, num_anchors) if num_anchors > 0 else angles.new_zeros(b, 0, dtype=torch.long)
+        # nearest views among the non-anchor views (a view always is its own nearest view), so every target view
+        # attends to exactly k + num_anchors distinct views
+        angles = angles.scatter(2, anchors[:, None].expand(-1, t, -1), float("inf"))
+        index = angles.topk(min(k, t - anchors.shape[1]), dim=-1, largest=False).indices
+        index = torch.cat([index, anchors[:, None].expand(-1, t, -1)], dim=-1)
+        return cls(index.sort(dim=-1).values)
+
+class ViewSegments:
+    r"""
+    Several objects packed into one multiview batch, with a different number of target and reference views each.
+
+    The target views (and reference views) of every object are consecutive in the batch. The multiview attention is
+    block diagonal: the views of an object only attend to the target views and reference tokens of the same object, as
+    with a per-object attention mask, but without materializing the mask. Pass it to the attention processors through
+    `cross_attention_kwargs={"view_segments": ViewSegments(target_views, reference_views)}`, it is supported by
+    [`CaPEAttnProcessor2_0`] and [`CaPEChunkedAttnProcessor`].
+
+    Args:
+        target_views (`List[int]`):
+            The number of target views of every object.
+        reference_views (`List[int]`):
+            The number of reference views of every object.
+    """
+
+    def __init__(self, target_views, reference_views):
+        if len(target_views) != len(reference_views):
+            raise ValueError("`target_views` and `reference_views` need one entry per object.")
+        self.target_views = list(target_views)
+        self.reference_views = list(reference_views)
+
+    def token_ranges(self, query_tokens, key_tokens, self_attn):
+        # (query start, query end, key start, key end) of every object, in tokens
+        l = query_tokens // sum(self.target_views)
+        views = self.target_views if self_attn else self.reference_views
+        l_key = key_tokens // sum(views)
+        ranges, q_start, k_start = [], 0, 0
+        for t_out, t_key in zip(self.target_views, views):
+            ranges.append((q_start, q_start + t_out * l, k_start, k_start + t_key * l_key))
+            q_start, k_start = q_start + t_out * l, k_start + t_key * l_key
+        return ranges
+
+def view_neighbors_attention(query, key, value, view_neighbors, t_out, chunk=None):
+    # query, key, value: b heads (t_out l) head_dim of the multiview self-attention
+    # each view attends to the keys and values of its neighbour views only, gathered per view. The target views are
+    # processed in chunks of `chunk` views, by default so the gathered keys and values stay about the size of the
+    # dense ones
+    b, heads, n, head_dim = query.shape
+    l = n // t_out
+    index = view_neighbors.index.to(query.device)
+    batch = torch.arange(b, device=query.device)[:, None, None]
+    chunk = chunk or max(1, t_out // index.shape[-1])
+    query = query.reshape(b, heads, t_out, l, head_dim)
+    key = key.reshape(b, heads, t_out, l, head_dim)
+    value = value.reshape(b, heads, t_out, l, head_dim)
+    hidden_states = torch.empty_like(query)
+
+    def gather(x, views):
+        x = x[batch, :, index[:, views]]  # b t m heads l head_dim
+        return x.permute(0, 1, 3, 2, 4, 5).reshape(-1, heads, x.shape[2] * l, head_dim)
+
+    for start in range(0, t_out, chunk):
+        views = slice(start, start + chunk)
+        q = query[:, :, views].transpose(1, 2).reshape(-1, heads, l, head_dim)
+        out = F.scaled_dot_product_attention(
+            q, gather(key, views), gather(value, views), attn_mask=None, dropout_p=0.0, is_causal=False
+        )
+        hidden_states[:, :, views] = out.reshape(b, -1, heads, l, head_dim).transpose(1, 2)
+    return hidden_states.reshape(b, heads, n, head_dim)
+
+def view_segments_attention(query, key, value, view_segments, self_attn, attention_mask=None, chunk=None):
+    # query, key, value: b heads n head_dim of objects packed with `view_segments`, each object only attends to its
+    # own keys and values. The queries of an object are processed in chunks of `chunk` tokens
+    hidden_states = torch.empty_like(query)
+    for q_start, q_end, k_start, k_end in view_segments.token_ranges(query.shape[2], key.shape[2], self_attn):
+        step = chunk or q_end - q_start
+        for start in range(q_start, q_end, step):
+            end = min(start + step, q_end)
+            attn_mask = attention_mask
+            if attention_mask is not None:
+                attn_mask = attention_mask[..., start:end, :] if attention_mask.shape[2] > 1 else attention_mask
+                attn_mask = attn_mask[..., k_start:k_end]
+            hidden_states[:, :, start:end] = F.scaled_dot_product_attention(
+                query[:, :, start:end], key[:, :, k_start:k_end], value[:, :, k_start:k_end], attn_mask=attn_mask,
+                dropout_p=0.0, is_causal=False,
+            )
+    return hidden_states
+
+def available_memory(device):
+    # free memory in bytes on `device`, None if unknown
+    if device.type == "cuda":
+        return torch.cuda.mem_get_info(device)[0]
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def attention_chunk_size(batch_heads, query_tokens, key_tokens, dtype, max_memory):
+    # number of query tokens whose attention scores fit in `max_memory` bytes, for a (batch_heads, query_tokens,
+    # key_tokens) attention. Counts the scores and probabilities in `dtype` and a float32 softmax upcast
+    if max_memory is None:
+        return query_tokens
+    per_query = batch_heads * key_tokens * (2 * torch.finfo(dtype).bits // 8 + 4)
+    return int(min(query_tokens, max(1, max_memory // per_query)))
+
+
+def _split_fused_projections(module, state_dict, prefix, local_metadata):
+    # state dict hook of `Attention`: store a fused `to_qkv` as the separate `to_q`, `to_k` and `to_v` projections
+    if not module.fused_projections:
+        return
+    for param in ["weight", "bias"]:
+        fused = state_dict.pop(f"{prefix}to_qkv.{param}", None)
+        if fused is not None:
+            for name, x in zip(["to_q", "to_k", "to_v"], fused.chunk(3)):
+                state_dict[f"{prefix}{name}.{param}"] = x.clone()
+
+
+def _fuse_projections_state_dict(module, state_dict, prefix, *args):
+    # load state dict pre-hook of `Attention`: load separate `to_q`, `to_k` and `to_v` projections into a fused `to_qkv`
+    if not module.fused_projections:
+        return
+    for param in ["weight", "bias"]:
+        keys = [f"{prefix}{name}.{param}" for name in ["to_q", "to_k", "to_v"]]
+        if all(key in state_dict for key in keys):
+            state_dict[f"{prefix}to_qkv.{param}"] = torch.cat([state_dict.pop(key) for key in keys])
+
+
 @maybe_allow_in_graph
 class Attention(nn.Module):
     r"""
@@ -85,6 +358,9 @@ class Attention(nn.Module):
         dropout (`float`, *optional*, defaults to 0.0): The dropout probability to use.
         bias (`bool`, *optional*, defaults to False):
             Set to `True` for the query, key, and value linear layers to contain a bias parameter.
+        cape (`bool`, *optional*, defaults to False):
+            Set to `True` for the multiview attention of the UNet transformer blocks, which defaults to
+            [`CaPEAttnProcessor2_0`] instead of [`AttnProcessor2_0`] and takes the camera poses `posemb`.
     """
 
     def __init__(
@@ -110,9 +386,11 @@ class Attention(nn.Module):
         residual_connection: bool = False,
         _from_deprecated_attn_block=False,
         processor: Optional["AttnProcessor"] = None,
+        cape: bool = False,
     ):
         super().__init__()
         inner_dim = dim_head * heads
+        self.is_cross_attention = cross_attention_dim is not None
         cross_attention_dim = cross_attention_dim if cross_attention_dim is not None else query_dim
         self.upcast_attention = upcast_attention
         self.upcast_softmax = upcast_softmax
@@ -125,6 +403,7 @@ class Attention(nn.Module):
         self._from_deprecated_attn_block = _from_deprecated_attn_block
 
         self.scale_qk = scale_qk
+        self.cape = cape
         self.scale = dim_head**-0.5 if self.scale_qk else 1.0
 
         self.heads = heads
@@ -192,13 +471,21 @@ class Attention(nn.Module):
         self.to_out.append(nn.Linear(inner_dim, query_dim, bias=out_bias))
         self.to_out.append(nn.Dropout(dropout))
 
+        # see `fuse_projections`, checkpoints always store the separate query, key and value projections
+        self.fused_projections = False
+        self._register_state_dict_hook(_split_fused_projections)
+        self._register_load_state_dict_pre_hook(_fuse_projections_state_dict, with_module=True)
+
         # set attention processor
-        # We use the AttnProcessor2_0 by default when torch 2.x is used which uses
+        # We use the AttnProcessor2_0 by default when torch 2.x is used, or the CaPEAttnProcessor2_0 for the
+        # multiview attention of the UNet (`cape`), which uses
         # torch.nn.functional.scaled_dot_product_attention for native Flash/memory_efficient_attention
         # but only if it has the default `scale` argument. TODO remove scale_qk check when we move to torch 2.1
         if processor is None:
             processor = (
-                AttnProcessor2_0() if hasattr(F, "scaled_dot_product_attention") and self.scale_qk else AttnProcessor()
+                (CaPEAttnProcessor2_0() if self.cape else AttnProcessor2_0())
+                if hasattr(F, "scaled_dot_product_attention") and self.scale_qk
+                else AttnProcessor()
             )
         self.set_processor(processor)
 
@@ -309,11 +596,12 @@ class Attention(nn.Module):
                     processor.to(self.processor.to_k_custom_diffusion.weight.device)
             else:
                 # set attention processor
-                # We use the AttnProcessor2_0 by default when torch 2.x is used which uses
+                # We use the AttnProcessor2_0 by default when torch 2.x is used, or the CaPEAttnProcessor2_0 for the
+                # multiview attention of the UNet (`cape`), which uses
                 # torch.nn.functional.scaled_dot_product_attention for native Flash/memory_efficient_attention
                 # but only if it has the default `scale` argument. TODO remove scale_qk check when we move to torch 2.1
                 processor = (
-                    AttnProcessor2_0()
+                    (CaPEAttnProcessor2_0() if self.cape else AttnProcessor2_0())
                     if hasattr(F, "scaled_dot_product_attention") and self.scale_qk
                     else AttnProcessor()
                 )
@@ -332,11 +620,14 @@ class Attention(nn.Module):
             processor = AttnAddedKVProcessor()
         else:
             # set attention processor
-            # We use the AttnProcessor2_0 by default when torch 2.x is used which uses
+            # We use the AttnProcessor2_0 by default when torch 2.x is used, or the CaPEAttnProcessor2_0 for the
+            # multiview attention of the UNet (`cape`), which uses
             # torch.nn.functional.scaled_dot_product_attention for native Flash/memory_efficient_attention
             # but only if it has the default `scale` argument. TODO remove scale_qk check when we move to torch 2.1
             processor = (
-                AttnProcessor2_0() if hasattr(F, "scaled_dot_product_attention") and self.scale_qk else AttnProcessor()
+                (CaPEAttnProcessor2_0() if self.cape else AttnProcessor2_0())
+                if hasattr(F, "scaled_dot_product_attention") and self.scale_qk
+                else AttnProcessor()
             )
 
         self.set_processor(processor)
@@ -352,8 +643,57 @@ class Attention(nn.Module):
             logger.info(f"You are removing possibly trained weights of {self.processor} with {processor}")
             self._modules.pop("processor")
 
+        if getattr(self, "fused_projections", False):
+            self.check_fused_projections_processor(processor)
         self.processor = processor
 
+    def check_fused_projections_processor(self, processor: "AttnProcessor"):
+        # the fused `to_qkv` replaces `to_q`, `to_k` and `to_v`, which processors without a fused branch call
+        if not isinstance(processor, FUSED_PROJECTIONS_PROCESSORS):
+            raise ValueError(
+                f"{type(processor).__name__} doesn't support fused query, key and value projections. Use one of"
+                f" {', '.join(cls.__name__ for cls in FUSED_PROJECTIONS_PROCESSORS)}, or split the projections with"
+                " `fuse_projections(False)` first."
+            )
+
+    def fuse_projections(self, fuse: bool = True):
+        r"""
+        Fuse the query, key and value projections of a self-attention layer into one `to_qkv` linear layer, so they run
+        as a single matrix multiplication, or split them again with `fuse=False`. The state dict keeps the separate
+        `to_q`, `to_k` and `to_v` weights either way, so checkpoints stay interchangeable. Raises a `ValueError` if
+        the attention processor of the layer (e.g. LoRA or custom diffusion) has no fused projections branch.
+        """
+        if fuse == self.fused_projections or self.is_cross_attention or self.added_kv_proj_dim is not None:
+            return
+
+        if fuse:
+            self.check_fused_projections_processor(self.processor)
+            linears = [self.to_q, self.to_k, self.to_v]
+            weight = torch.cat([linear.weight.detach() for linear in linears])
+            bias = None if self.to_q.bias is None else torch.cat([linear.bias.detach() for linear in linears])
+            self.to_qkv = nn.Linear(
+                weight.shape[1], weight.shape[0], bias=bias is not None, device=weight.device, dtype=weight.dtype
+            )
+            self.to_qkv.weight.data.copy_(weight)
+            if bias is not None:
+                self.to_qkv.bias.data.copy_(bias)
+            self.to_qkv.requires_grad_(self.to_q.weight.requires_grad)
+            del self.to_q, self.to_k, self.to_v
+        else:
+            weight = self.to_qkv.weight.detach()
+            bias = None if self.to_qkv.bias is None else self.to_qkv.bias.detach()
+            for name, w, b in zip(
+                ["to_q", "to_k", "to_v"], weight.chunk(3), [None] * 3 if bias is None else bias.chunk(3)
+            ):
+                linear = nn.Linear(w.shape[1], w.shape[0], bias=b is not None, device=w.device, dtype=w.dtype)
+                linear.weight.data.copy_(w)
+                if b is not None:
+                    linear.bias.data.copy_(b)
+                linear.requires_grad_(self.to_qkv.weight.requires_grad)
+                setattr(self, name, linear)
+            del self.to_qkv
+        self.fused_projections = fuse
+
     def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None, **cross_attention_kwargs):
         # The `Attention` class can call different attention processors / attention functions
         # here we simply pass along all tensors to the selected processor class
@@ -479,6 +819,79 @@ class Attention(nn.Module):
         return encoder_hidden_states
 
 
+class CrossAttnKVCache(dict):
+    r"""
+    Cache of the cross-attention keys and values of the reference views, keyed by attention layer.
+
+    The reference images and poses stay the same for all denoising steps, so the keys (with CaPE applied) and values
+    are projected on the first UNet call and reused for the remaining steps. Pass it to the attention processors
+    through `cross_attention_kwargs={"kv_cache": CrossAttnKVCache()}` and use a new cache for every generation.
+    """
+
+
+class FrozenViews(dict):
+    r"""
+    Self-attention keys and values of the frozen target views, keyed by attention layer.
+
+    Target views whose latents have converged are dropped from the UNet batch for the remaining denoising steps, and
+    the poses passed to the UNet only hold the active views. The multiview self-attention of the active views still
+    attends to the frozen views through the keys (with CaPE applied) and values of their last UNet call: on a call with
+    `capture` set, the keys and values of those active views are added to the cache. Pass it to the attention
+    processors through `cross_attention_kwargs={"frozen_views": FrozenViews()}` and use a new cache for every
+    generation, it is supported by [`CaPEAttnProcessor2_0`] and [`CaPEChunkedAttnProcessor`].
+    """
+
+    def __init__(self):
+        super().__init__()
+        # positions, among the active views, of the views frozen after the current UNet call
+        self.capture = None
+
+    def attend(self, attn, key, value, t_out):
+        # key, value: b (t_out l) d of the active views, returns them with the frozen views appended, b (t l) d
+        frozen = self.get(attn)
+        if frozen is not None and frozen[0].shape[0] != key.shape[0]:
+            if frozen[0].shape[0] < key.shape[0]:
+                raise ValueError("The views were frozen without classifier-free guidance, it can't be enabled again.")
+            # classifier-free guidance has stopped, keep the conditional half
+            frozen = tuple(x[-key.shape[0]:] for x in frozen)
+        if self.capture is not None:
+            capture = self.capture.to(key.device)
+            captured = tuple(x.unflatten(1, (t_out, -1))[:, capture].flatten(1, 2) for x in (key, value))
+            self[attn] = captured if frozen is None else tuple(torch.cat(x, dim=1) for x in zip(frozen, captured))
+        if frozen is None:
+            return key, value
+        return torch.cat([key, frozen[0]], dim=1), torch.cat([value, frozen[1]], dim=1)
+
+
+def null_condition_attention(processor, attn, hidden_states, encoder_hidden_states, attention_mask, null_condition,
+                             posemb=None, **kwargs):
+    r"""
+    Cross-attention for classifier-free guidance where the first `null_condition` objects of the batch are conditioned
+    on the all-zero null embedding. All their keys are the same, so the softmax is uniform and their attention output
+    is the constant `to_out(to_v(norm_cross(0)))`. Only the other objects go through `processor`, so the null branch
+    needs no key/value projections, attention scores or cached keys and values.
+    """
+    rows = null_condition * (hidden_states.shape[0] // encoder_hidden_states.shape[0])  # null objects x target views
+    null = encoder_hidden_states.new_zeros(1, 1, encoder_hidden_states.shape[-1])
+    if attn.norm_cross:
+        # the normalized null tokens are equal too, but not zero (e.g. the bias of a LayerNorm)
+        null = attn.norm_encoder_hidden_states(null)
+    null = attn.to_out[1](attn.to_out[0](attn.to_v(null))).to(hidden_states.dtype)
+    null = null.expand(rows, hidden_states.shape[1], -1)
+    if attn.residual_connection:
+        null = null + hidden_states[:rows]
+    null = null / attn.rescale_output_factor
+
+    if attention_mask is not None:
+        attention_mask = attention_mask[null_condition:]
+    if posemb is not None:
+        posemb = prepare_posemb(posemb).objects(null_condition)
+    hidden_states = processor(
+        attn, hidden_states[rows:], encoder_hidden_states[null_condition:], attention_mask, posemb=posemb, **kwargs
+    )
+    return torch.cat([null, hidden_states])
+
+
 class AttnProcessor:
     r"""
     Default processor for performing attention-related computations.
@@ -511,15 +924,20 @@ class AttnProcessor:
         if attn.group_norm is not None:
             hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
 
-        query = attn.to_q(hidden_states)
+        if attn.fused_projections:
+            # self-attention query, key and value in one matrix multiplication
+            query, key, value = attn.to_qkv(hidden_states).chunk(3, dim=-1)
+        else:
+            query = attn.to_q(hidden_states)
 
         if encoder_hidden_states is None:
             encoder_hidden_states = hidden_states
         elif attn.norm_cross:
             encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
 
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
+        if not attn.fused_projections:
+            key = attn.to_k(encoder_hidden_states)
+            value = attn.to_v(encoder_hidden_states)
 
         query = attn.head_to_batch_dim(query)
         key = attn.head_to_batch_dim(key)
@@ -1040,7 +1458,15 @@ class XFormersAttnProcessor:
         attention_mask: Optional[torch.FloatTensor] = None,
         temb: Optional[torch.FloatTensor] = None,
         posemb: Optional = None,
+        kv_cache: Optional[CrossAttnKVCache] = None,
+        null_condition: Optional[int] = None,
     ):
+        if null_condition and encoder_hidden_states is not None and hidden_states.ndim == 3:
+            return null_condition_attention(
+                self, attn, hidden_states, encoder_hidden_states, attention_mask, null_condition,
+                temb=temb, posemb=posemb, kv_cache=kv_cache,
+            )
+
         residual = hidden_states
 
         if attn.spatial_norm is not None:
@@ -1055,8 +1481,7 @@ class XFormersAttnProcessor:
         if posemb is not None:
             # turn 2d attention into multiview attention
             self_attn = encoder_hidden_states is None  # check if self attn or cross attn
-            p_out, p_in = posemb
-            t_out, t_in = p_out.shape[1], p_in.shape[1]  # t size
+            t_out = posemb[0].shape[1]  # t size
             hidden_states = einops.rearrange(hidden_states, '(b t_out) l d -> b (t_out l) d', t_out=t_out)
 
         batch_size, key_tokens, _ = (
@@ -1077,24 +1502,35 @@ class XFormersAttnProcessor:
         if attn.group_norm is not None:
             hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
 
-        query = attn.to_q(hidden_states)
-        if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
-        elif attn.norm_cross:
-            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+        if attn.fused_projections:
+            # self-attention query, key and value in one matrix multiplication
+            query, key, value = attn.to_qkv(hidden_states).chunk(3, dim=-1)
+        else:
+            query = attn.to_q(hidden_states)
+
+        if kv_cache is not None and encoder_hidden_states is not None and attn in kv_cache:
+            # reuse the reference keys and values of the first denoising step
+            key, value = kv_cache[attn]
+        else:
+            use_cache = kv_cache is not None and encoder_hidden_states is not None
+            if encoder_hidden_states is None:
+                encoder_hidden_states = hidden_states
+            elif attn.norm_cross:
+                encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+
+            if not attn.fused_projections:
+                key = attn.to_k(encoder_hidden_states)
+                value = attn.to_v(encoder_hidden_states)
 
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
+            # apply 4DoF CaPE
+            if posemb is not None:
+                key = cape_key(key, posemb, self_attn)
 
+            if use_cache:
+                kv_cache[attn] = (key, value)
 
-        # apply 4DoF CaPE, todo now only for xformer processor
         if posemb is not None:
-            p_out = einops.repeat(p_out, 'b t_out d -> b (t_out l) d', l=query.shape[1]//t_out)  # query shape
-            if self_attn:
-                p_in = p_out
-            else:
-                p_in = einops.repeat(p_in, 'b t_in d -> b (t_in l) d', l=key.shape[1] // t_in)  # key shape
-            query, key = cape_embed(p_out, p_in, query, key)
+            query = cape_query(query, posemb)
 
         query = attn.head_to_batch_dim(query).contiguous()
         key = attn.head_to_batch_dim(key).contiguous()
@@ -1174,15 +1610,20 @@ class AttnProcessor2_0:
         if attn.group_norm is not None:
             hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
 
-        query = attn.to_q(hidden_states)
+        if attn.fused_projections:
+            # self-attention query, key and value in one matrix multiplication
+            query, key, value = attn.to_qkv(hidden_states).chunk(3, dim=-1)
+        else:
+            query = attn.to_q(hidden_states)
 
         if encoder_hidden_states is None:
             encoder_hidden_states = hidden_states
         elif attn.norm_cross:
             encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
 
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
+        if not attn.fused_projections:
+            key = attn.to_k(encoder_hidden_states)
+            value = attn.to_v(encoder_hidden_states)
 
         head_dim = inner_dim // attn.heads
 
@@ -1216,6 +1657,222 @@ class AttnProcessor2_0:
         return hidden_states
 
 
+class CaPEAttnProcessor2_0:
+    r"""
+    Processor for implementing scaled dot-product attention with 4DoF camera positional encoding (CaPE). It is the
+    PyTorch 2.0 counterpart of [`XFormersAttnProcessor`] and is used by default for the attention layers of the UNet
+    transformer blocks (`Attention(cape=True)`), so multiview attention also runs on machines without xformers (e.g.
+    CPU). The other attention layers, e.g. in the VAE, keep [`AttnProcessor2_0`].
+    """
+
+    def __init__(self):
+        if not hasattr(F, "scaled_dot_product_attention"):
+            raise ImportError("CaPEAttnProcessor2_0 requires PyTorch 2.0, to use it, please upgrade PyTorch to 2.0.")
+
+    def __call__(
+        self,
+        attn: Attention,
+        hidden_states: torch.FloatTensor,
+        encoder_hidden_states: Optional[torch.FloatTensor] = None,
+        attention_mask: Optional[torch.FloatTensor] = None,
+        temb: Optional[torch.FloatTensor] = None,
+        posemb: Optional = None,
+        kv_cache: Optional[CrossAttnKVCache] = None,
+        view_neighbors: Optional[ViewNeighbors] = None,
+        view_segments: Optional[ViewSegments] = None,
+        null_condition: Optional[int] = None,
+        frozen_views: Optional[FrozenViews] = None,
+    ):
+        if null_condition and encoder_hidden_states is not None and hidden_states.ndim == 3:
+            return null_condition_attention(
+                self, attn, hidden_states, encoder_hidden_states, attention_mask, null_condition,
+                temb=temb, posemb=posemb, kv_cache=kv_cache, view_segments=view_segments,
+            )
+
+        residual = hidden_states
+
+        if attn.spatial_norm is not None:
+            hidden_states = attn.spatial_norm(hidden_states, temb)
+
+        input_ndim = hidden_states.ndim
+
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        self_attn = encoder_hidden_states is None  # check if self attn or cross attn
+        t_out = None
+        if posemb is not None:
+            # turn 2d attention into multiview attention
+            t_out = posemb[0].shape[1]  # t size
+            hidden_states = einops.rearrange(hidden_states, '(b t_out) l d -> b (t_out l) d', t_out=t_out)
+
+        batch_size, sequence_length, _ = (
+            hidden_states.shape if encoder_hidden_states is None else encoder_hidden_states.shape
+        )
+        inner_dim = hidden_states.shape[-1]
+
+        if attention_mask is not None:
+            attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
+            # scaled_dot_product_attention expects attention_mask shape to be
+            # (batch, heads, source_length, target_length)
+            attention_mask = attention_mask.view(batch_size, attn.heads, -1, attention_mask.shape[-1])
+
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+
+        if attn.fused_projections:
+            # self-attention query, key and value in one matrix multiplication
+            query, key, value = attn.to_qkv(hidden_states).chunk(3, dim=-1)
+        else:
+            query = attn.to_q(hidden_states)
+
+        if kv_cache is not None and encoder_hidden_states is not None and attn in kv_cache:
+            # reuse the reference keys and values of the first denoising step
+            key, value = kv_cache[attn]
+        else:
+            use_cache = kv_cache is not None and encoder_hidden_states is not None
+            if encoder_hidden_states is None:
+                encoder_hidden_states = hidden_states
+            elif attn.norm_cross:
+                encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+
+            if not attn.fused_projections:
+                key = attn.to_k(encoder_hidden_states)
+                value = attn.to_v(encoder_hidden_states)
+
+            # apply 4DoF CaPE
+            if posemb is not None:
+                key = cape_key(key, posemb, self_attn)
+
+            if use_cache:
+                kv_cache[attn] = (key, value)
+
+        if frozen_views is not None and posemb is not None and self_attn:
+            # the active views also attend to the cached keys and values of the frozen views
+            key, value = frozen_views.attend(attn, key, value, t_out)
+
+        if posemb is not None:
+            query = cape_query(query, posemb)
+
+        head_dim = inner_dim // attn.heads
+
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        # the output of sdp = (batch, num_heads, seq_len, head_dim)
+        hidden_states = self.attention(
+            attn, query, key, value, attention_mask, self_attn, t_out, view_neighbors, view_segments
+        )
+
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if posemb is not None:
+            # reshape back
+            hidden_states = einops.rearrange(hidden_states, 'b (t_out l) d -> (b t_out) l d', t_out=t_out)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+
+        return hidden_states
+
+    def attention(self, attn, query, key, value, attention_mask, self_attn, t_out, view_neighbors, view_segments):
+        r"""
+        Attention of the `(batch, heads, tokens, head_dim)` query, key and value, after CaPE. `t_out` is None for
+        attention without camera poses.
+        """
+        # self-attn b (ml) c  x  b (ml) c -> b (ml) c
+        # cross-attn  b (ml) c  x  b (nl) c -> b (ml) c
+        if view_segments is not None and t_out is not None:
+            if view_neighbors is not None:
+                raise ValueError("`view_segments` can not be combined with `view_neighbors`.")
+            # the views of each packed object only attend to the same object
+            hidden_states = view_segments_attention(query, key, value, view_segments, self_attn, attention_mask)
+        elif view_neighbors is not None and t_out is not None and self_attn:
+            if attention_mask is not None:
+                raise ValueError("`view_neighbors` sparse self-attention does not support an `attention_mask`.")
+            # each target view only attends to its nearest target views
+            hidden_states = view_neighbors_attention(query, key, value, view_neighbors, t_out)
+        else:
+            hidden_states = F.scaled_dot_product_attention(
+                query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
+            )
+
+        return hidden_states
+
+
+class CaPEChunkedAttnProcessor(CaPEAttnProcessor2_0):
+    r"""
+    Processor for implementing memory-bounded attention with CaPE. Same as [`CaPEAttnProcessor2_0`], but the query
+    sequence is split into chunks so that the attention scores of a chunk fit in a memory budget, which bounds the
+    multiview attention memory for large `t_out`.
+
+    Args:
+        max_memory (`int`, *optional*):
+            Memory budget in bytes for the attention scores of a chunk. Defaults to half of the free memory of the
+            device (free RAM on CPU), queried on every call, and the chunk size follows from the current
+            `(b, t_out l, t_in l, heads)` attention shape.
+    """
+
+    def __init__(self, max_memory: Optional[int] = None):
+        if not hasattr(F, "scaled_dot_product_attention"):
+            raise ImportError(
+                "CaPEChunkedAttnProcessor requires PyTorch 2.0, to use it, please upgrade PyTorch to 2.0."
+            )
+        self.max_memory = max_memory
+
+    def attention(self, attn, query, key, value, attention_mask, self_attn, t_out, view_neighbors, view_segments):
+        batch_size = query.shape[0]
+        max_memory = self.max_memory
+        if max_memory is None and available_memory(query.device) is not None:
+            max_memory = available_memory(query.device) // 2
+        query_tokens = query.shape[2]
+
+        if view_segments is not None and t_out is not None:
+            if view_neighbors is not None:
+                raise ValueError("`view_segments` can not be combined with `view_neighbors`.")
+            # the views of each packed object only attend to the same object, the largest object bounds the chunk
+            key_tokens = max(k_end - k_start for _, _, k_start, k_end in view_segments.token_ranges(
+                query_tokens, key.shape[2], self_attn))
+            chunk = attention_chunk_size(batch_size * attn.heads, query_tokens, key_tokens, query.dtype, max_memory)
+            hidden_states = view_segments_attention(
+                query, key, value, view_segments, self_attn, attention_mask, chunk=chunk
+            )
+        elif view_neighbors is not None and t_out is not None and self_attn:
+            if attention_mask is not None:
+                raise ValueError("`view_neighbors` sparse self-attention does not support an `attention_mask`.")
+            # each target view only attends to its nearest target views, in chunks of whole views
+            l = query_tokens // t_out
+            key_tokens = view_neighbors.index.shape[-1] * l
+            chunk = attention_chunk_size(batch_size * attn.heads, query_tokens, key_tokens, query.dtype, max_memory)
+            hidden_states = view_neighbors_attention(query, key, value, view_neighbors, t_out, chunk=max(1, chunk // l))
+        else:
+            chunk = attention_chunk_size(batch_size * attn.heads, query_tokens, key.shape[2], query.dtype, max_memory)
+            hidden_states = torch.empty_like(query)
+            for start in range(0, query_tokens, chunk):
+                end = start + chunk
+                attn_mask = attention_mask
+                if attention_mask is not None and attention_mask.shape[2] > 1:
+                    attn_mask = attention_mask[:, :, start:end]
+                hidden_states[:, :, start:end] = F.scaled_dot_product_attention(
+                    query[:, :, start:end], key, value, attn_mask=attn_mask, dropout_p=0.0, is_causal=False
+                )
+
+        return hidden_states
+
+
 class LoRAXFormersAttnProcessor(nn.Module):
     r"""
     Processor for implementing the LoRA attention mechanism with memory efficient attention using xFormers.
@@ -1537,7 +2194,11 @@ class SlicedAttnProcessor:
         if attn.group_norm is not None:
             hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
 
-        query = attn.to_q(hidden_states)
+        if attn.fused_projections:
+            # self-attention query, key and value in one matrix multiplication
+            query, key, value = attn.to_qkv(hidden_states).chunk(3, dim=-1)
+        else:
+            query = attn.to_q(hidden_states)
         dim = query.shape[-1]
         query = attn.head_to_batch_dim(query)
 
@@ -1546,8 +2207,9 @@ class SlicedAttnProcessor:
         elif attn.norm_cross:
             encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
 
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
+        if not attn.fused_projections:
+            key = attn.to_k(encoder_hidden_states)
+            value = attn.to_v(encoder_hidden_states)
         key = attn.head_to_batch_dim(key)
         value = attn.head_to_batch_dim(value)
 
@@ -1676,6 +2338,8 @@ class SlicedAttnAddedKVProcessor:
 AttentionProcessor = Union[
     AttnProcessor,
     AttnProcessor2_0,
+    CaPEAttnProcessor2_0,
+    CaPEChunkedAttnProcessor,
     XFormersAttnProcessor,
     SlicedAttnProcessor,
     AttnAddedKVProcessor,
@@ -1690,6 +2354,15 @@ AttentionProcessor = Union[
     CustomDiffusionXFormersAttnProcessor,
 ]
 
+# processors with a branch for the fused projections of `Attention.fuse_projections`
+FUSED_PROJECTIONS_PROCESSORS = (
+    AttnProcessor,
+    AttnProcessor2_0,
+    CaPEAttnProcessor2_0,
+    XFormersAttnProcessor,
+    SlicedAttnProcessor,
+)
+
 
 class SpatialNorm(nn.Module):
     """
@@ -0,0 +1 @@
+../../../6DoF/diffusers/schedulers/scheduling_lcm.py
\ No newline at end of file
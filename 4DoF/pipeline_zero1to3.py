@@ -2,24 +2,31 @@
 # by Xin Kong
 
 import inspect
-from typing import Any, Callable, Dict, List, Optional, Union
+import json
+import math
+import os
+import threading
+from queue import Empty, Queue
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import torch
 from packaging import version
-from transformers import CLIPFeatureExtractor, CLIPVisionModelWithProjection, ConvNextV2Model, AutoImageProcessor
+from transformers import CLIPFeatureExtractor, CLIPVisionModelWithProjection, ConvNextV2Config, ConvNextV2Model, AutoImageProcessor
 from CN_encoder import CN_encoder
+from reference_tokens import reference_token_budget
 from torchvision import transforms
 
 import einops
 
-from unet_2d_condition import UNet2DConditionModel
-from diffusers import AutoencoderKL, DiffusionPipeline
+from unet_2d_condition import DeepCache, UNet2DConditionModel
+from diffusers import AutoencoderKL, DDIMInverseScheduler, DiffusionPipeline
 from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput, StableDiffusionSafetyChecker
 from diffusers.schedulers import KarrasDiffusionSchedulers
 from diffusers.utils import (
     deprecate,
     is_accelerate_available,
     is_accelerate_version,
+    is_safetensors_available,
     randn_tensor,
     replace_example_docstring,
 )
@@ -29,8 +36,28 @@ import PIL
 import numpy as np
 from diffusers.configuration_utils import ConfigMixin, register_to_config
 from diffusers.models.modeling_utils import ModelMixin
+from diffusers.models.attention_processor import (
+    CaPEAttnProcessor2_0,
+    CaPEChunkedAttnProcessor,
+    CrossAttnKVCache,
+    FrozenViews,
+    ViewNeighbors,
+    ViewSegments,
+    prepare_posemb,
+    view_angles,
+)
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+# the scheduler fields carried from one denoising step to the next, the only scheduler state of a checkpoint, the rest
+# follows from the scheduler config and `set_timesteps`
+CHECKPOINT_SCHEDULER_STATE = (
+    "ets", "counter", "cur_sample", "cur_model_output",  # PNDM
+    "derivatives", "is_scale_input_called",  # LMS, Euler
+    "prev_derivative", "dt", "sample",  # Heun, KDPM2, DPM-Solver singlestep
+    "model_outputs", "lower_order_nums", "timestep_list", "last_sample", "this_order",  # DPM-Solver, DEIS, UniPC
+    "_step_index",
+)
 # todo
 EXAMPLE_DOC_STRING = """
     Examples:
@@ -233,6 +260,114 @@ class Zero1to3StableDiffusionPipeline(DiffusionPipeline):
         """
         self.vae.disable_tiling()
 
+    def enable_chunked_attention(self, max_memory: Optional[int] = None):
+        r"""
+        Enable memory-bounded chunked CaPE attention.
+
+        When this option is enabled, the attention layers split the query sequence in chunks whose attention scores fit
+        in `max_memory` bytes (by default half of the free memory of the device). This bounds the multiview attention
+        memory for a large number of target views, at the cost of some speed.
+        """
+        self.unet.set_attn_processor(CaPEChunkedAttnProcessor(max_memory))
+
+    def disable_chunked_attention(self):
+        r"""
+        Disable chunked CaPE attention. If `enable_chunked_attention` was previously invoked, the attention layers go
+        back to computing the attention in one step.
+        """
+        self.unet.set_attn_processor(CaPEAttnProcessor2_0())
+
+    def enable_token_merging(self, ratio: Union[float, List[float]] = 0.5):
+        r"""
+        Enable token merging (ToMe) in the multiview self-attention of the UNet.
+
+        When this option is enabled, the most similar tokens of each target view are merged before the self-attention,
+        which reduces its cost for many target views. `ratio` is the fraction of tokens merged, either for all
+        resolution levels or one value per level from the highest resolution to the lowest (see
+        `UNet2DConditionModel.set_token_merging`).
+        """
+        self.unet.set_token_merging(ratio)
+
+    def disable_token_merging(self):
+        r"""
+        Disable token merging. If `enable_token_merging` was previously invoked, the self-attention goes back to using
+        all tokens.
+        """
+        self.unet.set_token_merging(None)
+
+    def fuse_qkv_projections(self):
+        r"""
+        Fuse the query, key and value projections of the UNet self-attention layers into one linear layer each. The
+        UNet checkpoints saved with `save_pretrained` keep the separate projections.
+        """
+        self.unet.fuse_qkv_projections()
+
+    def unfuse_qkv_projections(self):
+        r"""
+        Disable the fused query, key and value projections. If `fuse_qkv_projections` was previously invoked, the UNet
+        self-attention layers go back to separate projections.
+        """
+        self.unet.unfuse_qkv_projections()
+
+    def save_bundle(self, path: str, dtype: torch.dtype = torch.float16):
+        r"""
+        Save the weights of the UNet, the VAE and the ConvNeXt image encoder in `dtype`, together with the configs of
+        all components, to a single safetensors file. Load it with [`from_bundle`].
+        """
+        if not is_safetensors_available():
+            raise ImportError("`save_bundle` requires `safetensors`.")
+        import safetensors.torch
+
+        tensors = {}
+        for name in ("unet", "vae", "image_encoder"):
+            for key, tensor in getattr(self, name).state_dict().items():
+                tensor = tensor.detach().to("cpu", dtype if tensor.is_floating_point() else tensor.dtype)
+                tensors[f"{name}.{key}"] = tensor.contiguous()
+        metadata = {
+            "unet": json.dumps(dict(self.unet.config)),
+            "vae": json.dumps(dict(self.vae.config)),
+            "image_encoder": self.image_encoder.config.to_json_string(),
+            "scheduler": self.scheduler.__class__.__name__,
+            "scheduler_config": json.dumps(dict(self.scheduler.config)),
+        }
+        safetensors.torch.save_file(tensors, path, metadata=metadata)
+
+    @classmethod
+    def from_bundle(cls, path: str, device: Union[str, torch.device] = "cpu"):
+        r"""
+        Load a pipeline saved with [`save_bundle`]. The modules are created on the meta device, without initializing
+        their weights, and their parameters are set from the memory-mapped file directly on `device` in the dtype of
+        the bundle, so no float32 copy of the weights is built and cast.
+        """
+        if not is_safetensors_available() or not is_accelerate_available():
+            raise ImportError("`from_bundle` requires `safetensors` and `accelerate`.")
+        import diffusers
+        import safetensors
+        from accelerate import init_empty_weights
+        from accelerate.utils import set_module_tensor_to_device
+
+        with safetensors.safe_open(path, framework="pt", device=str(device)) as f:
+            metadata = f.metadata()
+            with init_empty_weights():
+                modules = {
+                    "unet": UNet2DConditionModel.from_config(json.loads(metadata["unet"])),
+                    "vae": AutoencoderKL.from_config(json.loads(metadata["vae"])),
+                    "image_encoder": CN_encoder(ConvNextV2Config.from_dict(json.loads(metadata["image_encoder"]))),
+                }
+            keys = set(f.keys())
+            for name, module in modules.items():
+                missing = {f"{name}.{key}" for key in module.state_dict()} - keys
+                if missing:
+                    raise ValueError(f"The bundle {path} misses the {name} weights {sorted(missing)}.")
+                # one tensor at a time from the memory map, no state dict of the whole bundle
+                for key in sorted(k for k in keys if k.startswith(f"{name}.")):
+                    tensor = f.get_tensor(key)
+                    set_module_tensor_to_device(module, key[len(name) + 1:], device, value=tensor, dtype=tensor.dtype)
+                module.eval()
+        scheduler = getattr(diffusers, metadata["scheduler"]).from_config(json.loads(metadata["scheduler_config"]))
+        return cls(**modules, scheduler=scheduler, safety_checker=None, feature_extractor=None,
+                   requires_safety_checker=False)
+
     def enable_sequential_cpu_offload(self, gpu_id=0):
         r"""
         Offloads all models to CPU using accelerate, significantly reducing memory usage. When called, unet,
@@ -496,6 +631,260 @@ class Zero1to3StableDiffusionPipeline(DiffusionPipeline):
 
         return image_embeddings
 
+    @staticmethod
+    def guidance_scale_at(step, num_steps, guidance_scale, guidance_interval=None, guidance_decay=None):
+        # classifier-free guidance scale of denoising step `step`, 1.0 means the step runs without guidance
+        progress = step / num_steps
+        if guidance_interval is not None and not guidance_interval[0] <= progress < guidance_interval[1]:
+            return 1.0
+        if guidance_decay == "linear":
+            return 1.0 + (guidance_scale - 1.0) * (1.0 - progress)
+        if guidance_decay == "cosine":
+            return 1.0 + (guidance_scale - 1.0) * 0.5 * (1.0 + math.cos(math.pi * progress))
+        return guidance_scale
+
+    def _conditional_inputs(self, prompt_embeds, poses, encoder_attention_mask, cross_attention_kwargs):
+        # UNet inputs of the conditional half of the classifier-free guidance batch, for the steps without guidance
+        cond = prompt_embeds.shape[0] // 2
+        cross_attention_kwargs = dict(cross_attention_kwargs or {})
+        null_condition = cross_attention_kwargs.pop("null_condition", None)
+        # the poses are given per sample, see `num_images_per_prompt`
+        samples = cross_attention_kwargs.get("samples_per_object", 1)
+        # with the null-condition branch the cache only holds the conditional objects and can be shared
+        if "kv_cache" in cross_attention_kwargs and null_condition is None:
+            cross_attention_kwargs["kv_cache"] = CrossAttnKVCache()
+        if "view_neighbors" in cross_attention_kwargs:
+            view_neighbors = cross_attention_kwargs["view_neighbors"]
+            cross_attention_kwargs["view_neighbors"] = ViewNeighbors(view_neighbors.index[cond * samples:])
+        mask = None if encoder_attention_mask is None else encoder_attention_mask[cond:]
+        return prompt_embeds[cond:], poses.objects(cond * samples), mask, cross_attention_kwargs
+
+    def _reference_token_budget(self, prompt_embeds, image, poses, T_in, budget, alphas, do_classifier_free_guidance):
+        if not isinstance(image, torch.Tensor):
+            raise ValueError("`reference_token_budget` requires `prompt_imgs` as a tensor in [-1, 1]")
+        if image.ndim == 3:
+            image = image.unsqueeze(0)
+        if do_classifier_free_guidance:
+            prompt_embeds = prompt_embeds.chunk(2)[1]
+        prompt_embeds = einops.rearrange(prompt_embeds, '(b t) l c -> b t l c', t=T_in)
+        image = (image.to(prompt_embeds.device, torch.float32) + 1.) / 2.
+        pose_in = poses[1].to(prompt_embeds.device)
+        tokens, views, mask = reference_token_budget(prompt_embeds, image, pose_in, budget, alphas)
+
+        if do_classifier_free_guidance:
+            tokens = torch.cat([torch.zeros_like(tokens), tokens])
+            views = torch.cat([views] * 2)
+            mask = torch.cat([mask] * 2) if mask is not None else None
+        return tokens, views, mask
+
+    def _warm_start(self, input_imgs, pose_out, pose_in, noise, timesteps, num_inference_steps, angle, strength,
+                    inversion, unet_inputs, vae_chunk_size=None):
+        # every target view whose nearest reference is within `angle` starts from the latent of that reference, at a
+        # later step the closer it is. Returns the step index every view starts at (-1 from noise at the first step)
+        # and the latents of the reference views for the steps up to the last start.
+        b, T_out, T_in = pose_out.shape[0], pose_out.shape[1], pose_in.shape[1]
+        angles = view_angles(torch.cat([pose_out, pose_in], dim=1).to(noise.device))[:, :T_out, T_out:]
+        distance, nearest = angles.min(dim=-1)  # b t_out
+        distance = distance.flatten()
+        # fraction of the denoising steps run, from `strength` at the reference's pose to all steps at `angle`
+        fraction = strength + (1 - strength) * distance / angle
+        start = ((1 - fraction) * num_inference_steps).round().long() * self.scheduler.order
+        start = torch.where(distance < angle, start, -1)
+
+        reference_latents = self.prepare_img_latents(
+            input_imgs, b * T_in, noise.dtype, noise.device, chunk_size=vae_chunk_size
+        )
+        reference_latents = reference_latents * self.vae.config.scaling_factor
+        nearest = (nearest + torch.arange(b, device=nearest.device)[:, None] * T_in).flatten()
+        latents = reference_latents[nearest]
+        steps = range(max(int(start.min()), 0), int(start.max()) + 1)
+
+        if not inversion:
+            # the reference latent noised to the noise level of every step, with the initial noise of the view
+            return start, {i: self.scheduler.add_noise(latents, noise, timesteps[i].reshape(1)) for i in steps}
+
+        # the deterministic DDIM inversion of the reference latent, conditioned as the target views without guidance
+        inverse_scheduler = DDIMInverseScheduler.from_config(self.scheduler.config)
+        inverse_scheduler.set_timesteps(num_inference_steps, device=noise.device)
+        if self.scheduler.order != 1 or not torch.equal(inverse_scheduler.timesteps.flip(0), timesteps):
+            raise ValueError(
+                "`warm_start_inversion` requires a first order scheduler with the DDIM timesteps, e.g. DDIMScheduler."
+            )
+        prompt_embeds, poses, encoder_attention_mask, cross_attention_kwargs = unet_inputs
+        trajectory = {len(timesteps) - 1: latents}
+        for i, t in zip(range(len(timesteps) - 2, steps.start - 1, -1), inverse_scheduler.timesteps):
+            noise_pred = self.unet(latents,
+                                   t,
+                                   encoder_hidden_states=prompt_embeds,
+                                   pose=poses,
+                                   cross_attention_kwargs=cross_attention_kwargs,
+                                   encoder_attention_mask=encoder_attention_mask).sample
+            latents = inverse_scheduler.step(noise_pred, t, latents, return_dict=False)[0]
+            trajectory[i] = latents
+        return start, {i: trajectory[i] for i in steps}
+
+    def _save_checkpoint(self, path, step, latents, generator, guidance_stopped):
+        # the state carried from one denoising step to the next, written to a temporary file first so a job killed
+        # while saving keeps its previous checkpoint
+        if generator is None:
+            # the global RNGs, used by the stochastic schedulers without a generator
+            cuda_state = torch.cuda.get_rng_state_all() if torch.cuda.is_initialized() else None
+            rng_state = (torch.get_rng_state(), cuda_state)
+        else:
+            rng_state = [g.get_state() for g in (generator if isinstance(generator, list) else [generator])]
+        # tensors and plain values only, loaded with `weights_only=True`
+        checkpoint = {
+            "step": step,
+            "latents": latents,
+            "scheduler": self.scheduler.__class__.__name__,
+            "num_inference_steps": self.scheduler.num_inference_steps,
+            "scheduler_state": {
+                k: getattr(self.scheduler, k) for k in CHECKPOINT_SCHEDULER_STATE if hasattr(self.scheduler, k)
+            },
+            "rng_state": rng_state,
+            "guidance_stopped": guidance_stopped,
+        }
+        torch.save(checkpoint, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def _load_checkpoint(self, path, latents, generator):
+        # restores the scheduler and RNG state of `_save_checkpoint`, returns the step to resume at, the latents and
+        # whether the guidance had stopped
+        checkpoint = torch.load(path, weights_only=True)
+        if (
+            checkpoint["scheduler"] != self.scheduler.__class__.__name__
+            or checkpoint["num_inference_steps"] != self.scheduler.num_inference_steps
+            or checkpoint["latents"].shape != latents.shape
+        ):
+            raise ValueError(
+                f"The checkpoint {path} was saved by a run with another scheduler, number of steps or batch, remove it"
+                " to start from the first step."
+            )
+        for k, v in checkpoint["scheduler_state"].items():
+            if k in CHECKPOINT_SCHEDULER_STATE:
+                setattr(self.scheduler, k, v)
+        if generator is None:
+            cpu_state, cuda_state = checkpoint["rng_state"]
+            torch.set_rng_state(cpu_state)
+            if cuda_state is not None:
+                torch.cuda.set_rng_state_all(cuda_state)
+        else:
+            for g, rng_state in zip(generator if isinstance(generator, list) else [generator], checkpoint["rng_state"]):
+                g.set_state(rng_state)
+        return checkpoint["step"], checkpoint["latents"], checkpoint["guidance_stopped"]
+
+    def _window_inputs(self, unet_inputs, window, guidance):
+        # UNet inputs of `window` consecutive denoising steps batched together, ordered [uncond steps, cond steps] so the
+        # null-condition branch still finds the unconditional objects first
+        prompt_embeds, poses, encoder_attention_mask, cross_attention_kwargs = unet_inputs
+
+        def tile(x):
+            if x is None:
+                return None
+            if isinstance(x, (list, tuple)):
+                return [tile(y) for y in x]
+            halves = x.chunk(2) if guidance else (x,)
+            return torch.cat([h.repeat(window, *([1] * (h.ndim - 1))) for h in halves])
+
+        cross_attention_kwargs = dict(cross_attention_kwargs or {})
+        if "null_condition" in cross_attention_kwargs:
+            cross_attention_kwargs["null_condition"] *= window
+        if "view_neighbors" in cross_attention_kwargs:
+            view_neighbors = cross_attention_kwargs["view_neighbors"]
+            cross_attention_kwargs["view_neighbors"] = ViewNeighbors(tile(view_neighbors.index))
+        poses = prepare_posemb(tile(list(poses)), tile(poses.reference_views))
+        return tile(prompt_embeds), poses, tile(encoder_attention_mask), cross_attention_kwargs
+
+    def _parallel_sampling(self, latents, timesteps, unet_inputs, guidance, guidance_scale, guidance_interval,
+                           guidance_decay, parallel, tolerance, generator, eta, progress_bar, callback, callback_steps):
+        # ParaDiGMS (https://arxiv.org/abs/2305.16317): denoise a sliding window of `parallel` steps in one batched UNet
+        # call and refine it by Picard iterations, the window slides past the steps that have converged
+        scheduler = self.scheduler
+        num_steps = len(timesteps)
+        parallel = min(parallel, num_steps)
+        rows = latents.shape[0]
+
+        # latents of every step, the buffer[j + 1] = step(buffer[j]) fixed point is the sequential sampling result
+        buffer = torch.stack([latents] * (num_steps + 1))
+        # the noise of stochastic schedulers is sampled once per step, not per iteration
+        noise = torch.zeros_like(buffer)
+        if not scheduler._is_ode_scheduler:
+            for j in range(num_steps):
+                noise[j] = scheduler._get_variance(timesteps[j]) ** 0.5 * randn_tensor(
+                    latents.shape, generator=generator, device=latents.device, dtype=latents.dtype
+                )
+        # the tolerance is relative to the noise level of every step
+        variance = torch.tensor([scheduler._get_variance(t) for t in timesteps] + [0], device=latents.device)
+        inverse_variance_norm = 1.0 / variance[:, None] / latents[0].numel()
+        scaled_tolerance = tolerance**2
+
+        step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
+        accepted = set(inspect.signature(scheduler.batch_step_no_noise).parameters.keys())
+        step_kwargs = {k: v for k, v in step_kwargs.items() if k in accepted}
+        scales = torch.tensor(
+            [self.guidance_scale_at(j, num_steps, guidance_scale, guidance_interval, guidance_decay)
+             for j in range(num_steps)],
+            device=latents.device, dtype=latents.dtype,
+        )
+
+        window_inputs = {}
+        begin, end = 0, parallel
+        while begin < num_steps:
+            window = end - begin
+            if window not in window_inputs:
+                window_inputs[window] = self._window_inputs(unet_inputs, window, guidance)
+            step_prompt_embeds, step_poses, step_attention_mask, step_kwargs_attn = window_inputs[window]
+
+            block_latents = buffer[begin:end]
+            block_t = timesteps[begin:end].repeat_interleave(rows)
+            t_vec = torch.cat([block_t] * 2) if guidance else block_t
+            latent_model_input = block_latents.flatten(0, 1)
+            latent_model_input = torch.cat([latent_model_input] * 2) if guidance else latent_model_input
+            latent_model_input = scheduler.scale_model_input(latent_model_input, t_vec)
+
+            noise_pred = self.unet(latent_model_input,
+                                   t_vec,
+                                   encoder_hidden_states=step_prompt_embeds,
+                                   pose=step_poses,
+                                   cross_attention_kwargs=step_kwargs_attn,
+                                   encoder_attention_mask=step_attention_mask).sample
+            noise_pred = noise_pred.unflatten(0, (-1, window, rows))
+            if guidance:
+                noise_pred_uncond, noise_pred_text = noise_pred
+                scale = scales[begin:end, None, None, None, None]
+                noise_pred = noise_pred_uncond + scale * (noise_pred_text - noise_pred_uncond)
+            else:
+                noise_pred = noise_pred[0]
+
+            block_latents_denoise = scheduler.batch_step_no_noise(
+                model_output=noise_pred.flatten(0, 1),
+                timesteps=block_t,
+                sample=block_latents.flatten(0, 1),
+                **step_kwargs,
+            ).view_as(block_latents)
+
+            # Picard update: the window is re-integrated from its (fixed) first latents
+            delta = torch.cumsum(block_latents_denoise - block_latents, dim=0)
+            block_latents_new = buffer[begin][None] + delta + torch.cumsum(noise[begin:end], dim=0)
+            error = (block_latents_new - buffer[begin + 1:end + 1]).flatten(2).norm(dim=-1).pow(2)
+            error_ratio = error * inverse_variance_norm[begin + 1:end + 1]
+            # slide the window up to the first step that has not converged yet
+            error_ratio = torch.nn.functional.pad(error_ratio, (0, 0, 0, 1), value=1e9)
+            first_error = (error_ratio > scaled_tolerance).any(dim=1).int().argmax().item()
+            new_begin = begin + min(1 + first_error, parallel)
+            new_end = min(new_begin + parallel, num_steps)
+
+            buffer[begin + 1:end + 1] = block_latents_new
+            # the new steps of the window start from the latest latents
+            buffer[end:new_end + 1] = buffer[end][None]
+
+            for j in range(begin, new_begin):
+                progress_bar.update()
+                if callback is not None and j % callback_steps == 0:
+                    callback(j, timesteps[j], buffer[j + 1])
+            begin, end = new_begin, new_end
+        return buffer[-1]
+
     def run_safety_checker(self, image, device, dtype):
         if self.safety_checker is not None:
             safety_checker_input = self.feature_extractor(self.numpy_to_pil(image), return_tensors="pt").to(device)
@@ -506,13 +895,31 @@ class Zero1to3StableDiffusionPipeline(DiffusionPipeline):
             has_nsfw_concept = None
         return image, has_nsfw_concept
 
-    def decode_latents(self, latents):
+    def decode_latents(self, latents, chunk_size=None, dtype=np.float32):
+        r"""
+        Decode `latents` into a `(n, H, W, 3)` array. Called as `decode_latents(latents)` it returns float32 images in
+        [0, 1], the same as before `chunk_size` and `dtype` were added.
+
+        `chunk_size` latents are decoded per VAE call (all at once by default) into a preallocated array. With
+        `dtype=np.uint8` every chunk is quantized on the device as `(image * 255).astype(np.uint8)` would quantize the
+        float32 images (truncation, as the evaluation scripts save them), so no float copy of all images is kept.
+        """
         latents = 1 / self.vae.config.scaling_factor * latents
-        image = self.vae.decode(latents).sample
-        image = (image / 2 + 0.5).clamp(0, 1)
-        # we always cast to float32 as this does not cause significant overhead and is compatible with bfloat16
-        image = image.cpu().permute(0, 2, 3, 1).float().numpy()
-        return image
+        chunk_size = chunk_size or latents.shape[0]
+        images = None
+        for start in range(0, latents.shape[0], chunk_size):
+            image = self.vae.decode(latents[start:start + chunk_size]).sample
+            image = (image / 2 + 0.5).clamp(0, 1)
+            if dtype == np.uint8:
+                image = (image.float() * 255).to(torch.uint8)
+            else:
+                # we always cast to float32 as this does not cause significant overhead and is compatible with bfloat16
+                image = image.float()
+            image = image.cpu().permute(0, 2, 3, 1).numpy()
+            if images is None:
+                images = np.empty((latents.shape[0], *image.shape[1:]), dtype=image.dtype)
+            images[start:start + chunk_size] = image
+        return images
 
     def prepare_extra_step_kwargs(self, generator, eta):
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
@@ -570,7 +977,36 @@ class Zero1to3StableDiffusionPipeline(DiffusionPipeline):
         latents = latents * self.scheduler.init_noise_sigma
         return latents
 
-    def prepare_img_latents(self, image, batch_size, dtype, device, generator=None, do_classifier_free_guidance=False, t_in=None):
+    @staticmethod
+    def view_generators(seed, object_ids, view_indices, num_samples=1):
+        r"""
+        One CPU generator per target view, in the order of the latents of [`__call__`] (objects, samples, views). The
+        seed of a view is hashed from `(seed, object id, view index, sample)` with `numpy.random.SeedSequence`, so the
+        noise of a view only depends on these and not on the other views in the batch or on the device.
+
+        Args:
+            seed (`int`):
+                The base seed.
+            object_ids (`List[int]`):
+                A non-negative id per object, e.g. its position in the dataset.
+            view_indices (`torch.LongTensor` or `List`):
+                The indices of the target views within their object, `(T_out,)` for all objects or
+                `(num_objects, T_out)`.
+            num_samples (`int`, *optional*, defaults to 1):
+                The samples per object, see `num_images_per_prompt`.
+        """
+        object_ids = list(object_ids)
+        view_indices = torch.as_tensor(view_indices).expand(len(object_ids), -1).tolist()
+        generators = []
+        for object_id, views in zip(object_ids, view_indices):
+            for sample in range(num_samples):
+                for view in views:
+                    state = np.random.SeedSequence([seed, object_id, view, sample]).generate_state(1, np.uint64)
+                    generators.append(torch.Generator().manual_seed(int(state[0])))
+        return generators
+
+    def prepare_img_latents(self, image, batch_size, dtype, device, generator=None, do_classifier_free_guidance=False, t_in=None,
+                            chunk_size=None):
         if not isinstance(image, (torch.Tensor, PIL.Image.Image, list)):
             raise ValueError(
                 f"`image` has to be of type `torch.Tensor`, `PIL.Image.Image` or list but is {type(image)}"
@@ -609,13 +1045,13 @@ class Zero1to3StableDiffusionPipeline(DiffusionPipeline):
                 f" size of {batch_size}. Make sure the batch size matches the length of the generators."
             )
 
-        if isinstance(generator, list):
-            init_latents = [
-                self.vae.encode(image[i : i + 1]).latent_dist.mode(generator[i]) for i in range(batch_size) # sample
-            ]
-            init_latents = torch.cat(init_latents, dim=0)
-        else:
-            init_latents = self.vae.encode(image).latent_dist.mode()
+        # the latents are the deterministic mode of the VAE posterior, so the images are encoded in batches of
+        # `chunk_size` (all at once by default) whether or not there is a generator per image
+        chunk_size = chunk_size or image.shape[0]
+        init_latents = torch.cat([
+            self.vae.encode(image[start:start + chunk_size]).latent_dist.mode()
+            for start in range(0, image.shape[0], chunk_size)
+        ])
 
         if batch_size > init_latents.shape[0]:
             # init_latents = init_latents.repeat(batch_size // init_latents.shape[0], 1, 1, 1)
@@ -659,6 +1095,29 @@ class Zero1to3StableDiffusionPipeline(DiffusionPipeline):
         callback_steps: int = 1,
         cross_attention_kwargs: Optional[Dict[str, Any]] = None,
         controlnet_conditioning_scale: float = 1.0,
+        cache_reference_kv: bool = False,
+        view_neighbors: Optional[int] = None,
+        view_anchors: int = 0,
+        reference_token_budget: Optional[int] = None,
+        reference_alphas: Optional[torch.FloatTensor] = None,
+        null_condition_attention: bool = False,
+        guidance_interval: Optional[Tuple[float, float]] = None,
+        guidance_decay: Optional[str] = None,
+        guidance_stop_threshold: Optional[float] = None,
+        deep_cache_interval: Optional[int] = None,
+        deep_cache_branch: int = 1,
+        parallel: Optional[int] = None,
+        parallel_tolerance: float = 0.1,
+        warm_start_angle: Optional[float] = None,
+        warm_start_strength: float = 0.5,
+        warm_start_inversion: bool = False,
+        freeze_threshold: Optional[float] = None,
+        vae_chunk_size: Optional[int] = None,
+        checkpoint_path: Optional[str] = None,
+        checkpoint_steps: int = 10,
+        view_seed: Optional[int] = None,
+        object_ids: Optional[List[int]] = None,
+        view_indices: Optional[torch.LongTensor] = None,
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -686,7 +1145,10 @@ class Zero1to3StableDiffusionPipeline(DiffusionPipeline):
                 `negative_prompt_embeds`. instead. If not defined, one has to pass `negative_prompt_embeds`. instead.
                 Ignored when not using guidance (i.e., ignored if `guidance_scale` is less than `1`).
             num_images_per_prompt (`int`, *optional*, defaults to 1):
-                The number of images to generate per prompt.
+                The number of samples generated per object, e.g. to estimate the uncertainty of the views. The
+                reference images are encoded once, and the cross-attention of all samples of an object shares its
+                reference keys and values. The samples are denoised in one batch but do not attend to each other. The
+                images are returned per object, sample and target view.
             eta (`float`, *optional*, defaults to 0.0):
                 Corresponds to parameter eta (η) in the DDIM paper: https://arxiv.org/abs/2010.02502. Only applies to
                 [`schedulers.DDIMScheduler`], will be ignored for others.
@@ -706,7 +1168,9 @@ class Zero1to3StableDiffusionPipeline(DiffusionPipeline):
                 argument.
             output_type (`str`, *optional*, defaults to `"pil"`):
                 The output format of the generate image. Choose between
-                [PIL](https://pillow.readthedocs.io/en/stable/): `PIL.Image.Image` or `np.array`.
+                [PIL](https://pillow.readthedocs.io/en/stable/): `PIL.Image.Image` or `np.array`. `"uint8"` returns
+                a `np.uint8` array `(n, H, W, 3)` the views are decoded into chunk by chunk, without a float copy of
+                all images, truncated as `(image * 255).astype(np.uint8)` of the `"numpy"` output.
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] instead of a
                 plain tuple.
@@ -720,6 +1184,91 @@ class Zero1to3StableDiffusionPipeline(DiffusionPipeline):
                 A kwargs dictionary that if specified is passed along to the `AttnProcessor` as defined under
                 `self.processor` in
                 [diffusers.cross_attention](https://github.com/huggingface/diffusers/blob/main/src/diffusers/models/cross_attention.py).
+            cache_reference_kv (`bool`, *optional*, defaults to `False`):
+                Whether to cache the cross-attention keys and values of the reference views. The reference embeddings
+                and poses do not change across the denoising steps, so they are projected (and CaPE-embedded) once on
+                the first step and reused for the remaining steps.
+            view_neighbors (`int`, *optional*):
+                If set, every target view only attends to its `view_neighbors` nearest target views (by camera angle)
+                in the multiview self-attention instead of all `T_out` views. Reduces the self-attention cost from
+                quadratic to linear in `T_out`, requires the default `CaPEAttnProcessor2_0`.
+            view_anchors (`int`, *optional*, defaults to 0):
+                Number of global anchor views, spread over all cameras, that every target view also attends to when
+                `view_neighbors` is set.
+            reference_token_budget (`int`, *optional*):
+                If set, the reference tokens are reduced to at most `reference_token_budget` per object: tokens that
+                only cover background are dropped, and near-duplicate tokens of neighbouring references are merged.
+                Each token keeps the CaPE pose of its reference view. Requires `prompt_imgs` as a tensor.
+            reference_alphas (`torch.FloatTensor`, *optional*):
+                Alpha masks `(T_in, 1, H, W)` of the reference images to find the background tokens. If not given,
+                tokens of a uniform background colour are dropped.
+            null_condition_attention (`bool`, *optional*, defaults to `False`):
+                Whether to skip the cross-attention of the unconditional half of classifier-free guidance. Its
+                reference embeddings are all zero, so every cross-attention layer outputs a constant there, which is
+                used directly instead of projecting and attending over the null reference tokens.
+            guidance_interval (`Tuple[float, float]`, *optional*):
+                If set, classifier-free guidance is only applied on the denoising steps in `[start, end)`, given as
+                fractions of the steps (e.g. `(0.0, 0.6)`). The other steps run the conditional batch only.
+            guidance_decay (`str`, *optional*):
+                Decay the guidance scale from `guidance_scale` to 1 over the denoising steps, `"linear"` or
+                `"cosine"`.
+            guidance_stop_threshold (`float`, *optional*):
+                If set, classifier-free guidance stops for the remaining steps once the relative difference
+                `|eps_cond - eps_uncond| / |eps_cond|` of the noise predictions falls below this threshold.
+            deep_cache_interval (`int`, *optional*):
+                If set, the full UNet only runs every `deep_cache_interval` steps (DeepCache). The steps in between
+                reuse its deep features and only recompute the `deep_cache_branch` shallowest resolution levels. The
+                features are cached separately for the unconditional and conditional halves of the guidance batch.
+            deep_cache_branch (`int`, *optional*, defaults to 1):
+                The number of shallow resolution levels recomputed on the cheap steps of `deep_cache_interval`.
+            parallel (`int`, *optional*):
+                If set, the denoising steps are sampled in parallel (ParaDiGMS): a window of `parallel` steps is
+                denoised in one batched UNet call and refined by Picard iterations until it converges, trading more
+                UNet evaluations for fewer sequential ones. Requires a scheduler with `batch_step_no_noise`, e.g.
+                `DDIMParallelScheduler.from_config(pipeline.scheduler.config)`.
+            parallel_tolerance (`float`, *optional*, defaults to 0.1):
+                The error tolerance of the parallel sampling, relative to the noise level of every step. Smaller values
+                stay closer to the sequential sampler but need more iterations.
+            warm_start_angle (`float`, *optional*):
+                If set, every target view whose nearest reference view (by camera angle, in radians) is closer than
+                `warm_start_angle` starts from the VAE latent of that reference instead of pure noise, noised to the
+                step it starts at. The closer the reference, the later it starts: a target at the pose of its
+                reference only runs the last `warm_start_strength` of the steps. Until it starts, a view follows the
+                noised reference latent, so all views still denoise in one batch; the steps before the first start
+                are skipped.
+            warm_start_strength (`float`, *optional*, defaults to 0.5):
+                The fraction of the denoising steps run for a target view at the pose of its reference, see
+                `warm_start_angle`.
+            warm_start_inversion (`bool`, *optional*, defaults to `False`):
+                Start from the deterministic DDIM inversion of the reference latents (with `DDIMInverseScheduler`)
+                instead of the noised latents. The inversion costs one conditional UNet call per skipped step.
+            freeze_threshold (`float`, *optional*):
+                If set, a target view is frozen once the relative update `|x_t-1 - x_t| / |x_t|` of its latent in a
+                sampler step falls below this threshold (for all objects). A frozen view is dropped from the UNet
+                batch for the remaining steps and follows its last noise prediction, the active views still attend
+                to it through its cached self-attention keys and values. Requires the default
+                `CaPEAttnProcessor2_0` or the chunked attention, and a `guidance_interval` starting at 0.
+            vae_chunk_size (`int`, *optional*):
+                The number of images encoded or decoded per VAE call, all at once if not set. Bounds the memory of the
+                VAE activations and of the float images for large `T_out`.
+            checkpoint_path (`str`, *optional*):
+                If set, the state of the denoising loop (latents, step index, scheduler and RNG state) is saved to this
+                file every `checkpoint_steps` sampler steps and after the last step, and the loop resumes from it if the
+                file exists. A resumed run gives the same result as an uninterrupted one for the same inputs. The file
+                is kept after the last step: calling again only decodes the latents and restores the generator state
+                of the finished run.
+            checkpoint_steps (`int`, *optional*, defaults to 10):
+                The number of sampler steps between two checkpoints, see `checkpoint_path`.
+            view_seed (`int`, *optional*):
+                If set, the noise of every target view is drawn from its own generator, seeded from `(view_seed, object
+                id, view index)` by [`view_generators`], instead of from `generator`. A view then gets the same noise
+                whichever other views and objects are in the batch, so a subset of the views can be regenerated alone.
+            object_ids (`List[int]`, *optional*):
+                The ids of the objects in the batch for `view_seed`, defaults to their positions in the batch.
+            view_indices (`torch.LongTensor`, *optional*):
+                The indices of the target views within their object for `view_seed`, `(T_out,)` for all objects or
+                `(num_objects, T_out)`. Defaults to `0, ..., T_out - 1`; pass the original indices of the views when
+                regenerating a subset of them.
 
         Examples:
 
@@ -737,6 +1286,45 @@ class Zero1to3StableDiffusionPipeline(DiffusionPipeline):
         # 1. Check inputs. Raise error if not correct
         # input_image = hint_imgs
         self.check_inputs(input_imgs, height, width, callback_steps)
+        if guidance_decay not in (None, "linear", "cosine"):
+            raise ValueError(f"`guidance_decay` has to be None, 'linear' or 'cosine' but is {guidance_decay}.")
+        if parallel is not None:
+            if not hasattr(self.scheduler, "batch_step_no_noise"):
+                raise ValueError(
+                    f"`parallel` sampling needs a parallel scheduler but got {self.scheduler.__class__.__name__}, use"
+                    " e.g. `DDIMParallelScheduler.from_config(pipeline.scheduler.config)`."
+                )
+            if cache_reference_kv or deep_cache_interval is not None or guidance_stop_threshold is not None:
+                raise ValueError(
+                    "`parallel` sampling can't be combined with `cache_reference_kv`, `deep_cache_interval` or"
+                    " `guidance_stop_threshold`, which assume one denoising step per UNet call."
+                )
+            if warm_start_angle is not None or freeze_threshold is not None:
+                raise ValueError("`parallel` sampling can't be combined with `warm_start_angle` or `freeze_threshold`.")
+        if warm_start_angle is not None and num_images_per_prompt > 1:
+            raise ValueError("`warm_start_angle` requires `num_images_per_prompt=1`.")
+        if freeze_threshold is not None and (
+            deep_cache_interval is not None or view_neighbors is not None or warm_start_angle is not None
+            or "view_segments" in (cross_attention_kwargs or {})
+        ):
+            raise ValueError(
+                "`freeze_threshold` can't be combined with `deep_cache_interval`, `view_neighbors`, `warm_start_angle`"
+                " or packed objects, which assume all target views in every UNet call."
+            )
+        if freeze_threshold is not None and guidance_interval is not None and guidance_interval[0] > 0:
+            raise ValueError(
+                "`freeze_threshold` can't be combined with a `guidance_interval` starting after the first step: views"
+                " frozen before the guidance starts have no keys and values of the unconditional branch."
+            )
+        if view_seed is not None and generator is not None:
+            raise ValueError("Pass either `generator` or `view_seed`, not both.")
+        if checkpoint_path is not None and (
+            parallel is not None or deep_cache_interval is not None or freeze_threshold is not None
+        ):
+            raise ValueError(
+                "`checkpoint_path` can't be combined with `parallel`, `deep_cache_interval` or `freeze_threshold`, whose"
+                " state between the steps is not saved."
+            )
 
         # 2. Define call parameters
         if isinstance(input_imgs, PIL.Image.Image):
@@ -753,20 +1341,57 @@ class Zero1to3StableDiffusionPipeline(DiffusionPipeline):
 
         # 3. Encode input image with pose as prompt
         # prompt_embeds = self._encode_image_with_pose(prompt_imgs, poses, device, num_images_per_prompt, do_classifier_free_guidance, t_in)
-        prompt_embeds = self._encode_image(prompt_imgs, device, num_images_per_prompt, do_classifier_free_guidance)
-        prompt_embeds = einops.rearrange(prompt_embeds, '(b t) l c -> b (t l) c', t=T_in)
+        # the references are encoded once per object and shared by its samples, see `num_images_per_prompt`
+        prompt_embeds = self._encode_image(prompt_imgs, device, 1, do_classifier_free_guidance)
+        reference_views, encoder_attention_mask = None, None
+        if reference_token_budget is not None:
+            prompt_embeds, reference_views, encoder_attention_mask = self._reference_token_budget(
+                prompt_embeds, prompt_imgs, poses, T_in, reference_token_budget, reference_alphas,
+                do_classifier_free_guidance
+            )
+        else:
+            prompt_embeds = einops.rearrange(prompt_embeds, '(b t) l c -> b (t l) c', t=T_in)
 
         if do_classifier_free_guidance:
             pose_out, pose_in = poses
             pose_in = torch.cat([pose_in] * 2)
             pose_out = torch.cat([pose_out] * 2)
             poses = [pose_out, pose_in]
+        if num_images_per_prompt > 1:
+            # the samples of an object are consecutive in the batch, with the poses of the object
+            poses = [p.repeat_interleave(num_images_per_prompt, dim=0) for p in poses]
+            if reference_views is not None:
+                reference_views = reference_views.repeat_interleave(num_images_per_prompt, dim=0)
+            cross_attention_kwargs = dict(cross_attention_kwargs or {}, samples_per_object=num_images_per_prompt)
+        # prepare the CaPE poses once, shared by all attention layers and denoising steps
+        poses = prepare_posemb(poses, reference_views)
+
+        if cache_reference_kv:
+            cross_attention_kwargs = dict(cross_attention_kwargs or {}, kv_cache=CrossAttnKVCache())
+        if null_condition_attention and do_classifier_free_guidance:
+            # the first half of the batch is conditioned on the all-zero null embedding of `_encode_image`
+            cross_attention_kwargs = dict(cross_attention_kwargs or {}, null_condition=prompt_embeds.shape[0] // 2)
+        if view_neighbors is not None:
+            cross_attention_kwargs = dict(
+                cross_attention_kwargs or {}, view_neighbors=ViewNeighbors.from_posemb(poses, view_neighbors, view_anchors)
+            )
+        if freeze_threshold is not None:
+            cross_attention_kwargs = dict(cross_attention_kwargs or {}, frozen_views=FrozenViews())
 
         # 4. Prepare timesteps
         self.scheduler.set_timesteps(num_inference_steps, device=device)
         timesteps = self.scheduler.timesteps
 
         # 5. Prepare latent variables
+        if view_seed is not None:
+            # one noise stream per target view, see `view_seed`
+            num_objects = batch_size // T_in
+            generator = self.view_generators(
+                view_seed,
+                range(num_objects) if object_ids is None else object_ids,
+                torch.arange(T_out) if view_indices is None else view_indices,
+                num_images_per_prompt,
+            )
         latents = self.prepare_latents(
             batch_size // T_in * T_out * num_images_per_prompt,
             4,
@@ -781,35 +1406,137 @@ class Zero1to3StableDiffusionPipeline(DiffusionPipeline):
         # 7. Prepare extra step kwargs.
         extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
 
+        # inputs of the steps without guidance, see `guidance_interval`, `guidance_decay` and `guidance_stop_threshold`
+        unet_inputs = (prompt_embeds, poses, encoder_attention_mask, cross_attention_kwargs)
+        if do_classifier_free_guidance:
+            cond_unet_inputs = self._conditional_inputs(*unet_inputs)
+        else:
+            cond_unet_inputs = unet_inputs
+        guidance_stopped = False
+        deep_cache = DeepCache(deep_cache_branch) if deep_cache_interval is not None else None
+
+        # start the target views close to a reference from its latent, see `warm_start_angle`
+        warm_start_steps, warm_start_latents, first_step = None, {}, 0
+        if warm_start_angle is not None:
+            pose_out, pose_in = cond_unet_inputs[1]
+            warm_start_steps, warm_start_latents = self._warm_start(
+                input_imgs, pose_out, pose_in, latents / self.scheduler.init_noise_sigma, timesteps,
+                num_inference_steps, warm_start_angle, warm_start_strength, warm_start_inversion, cond_unet_inputs,
+                vae_chunk_size,
+            )
+            first_step = max(int(warm_start_steps.min()), 0)
+
+        # drop the converged target views from the UNet batch, see `freeze_threshold`
+        active_views, freezing_views, frozen_noise_pred = None, None, None
+        if freeze_threshold is not None:
+            frozen_views = cross_attention_kwargs["frozen_views"]
+            active_views = torch.arange(T_out, device=device)
+            objects = torch.arange(latents.shape[0] // T_out, device=device)[:, None] * T_out
+            step_start_latents = latents
+
+        # resume an interrupted run from its last checkpoint, see `checkpoint_path`
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            first_step, latents, guidance_stopped = self._load_checkpoint(checkpoint_path, latents, generator)
+
         # 7. Denoising loop
-        num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
-        with self.progress_bar(total=num_inference_steps) as progress_bar:
-            for i, t in enumerate(timesteps):
-                # expand the latents if we are doing classifier free guidance
-                latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
-                latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-                latent_model_input = torch.cat([latent_model_input], dim=1)
-
-                # predict the noise residual
-                noise_pred = self.unet(latent_model_input,
-                                       t,
-                                       encoder_hidden_states=prompt_embeds,
-                                       pose=poses).sample
-
-                # perform guidance
-                if do_classifier_free_guidance:
-                    noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                    noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
-
-                # compute the previous noisy sample x_t -> x_t-1
-                # latents = self.scheduler.step(noise_pred.to(dtype=torch.float32), t, latents.to(dtype=torch.float32)).prev_sample.to(prompt_embeds.dtype)
-                latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs, return_dict=False)[0]
-
-                # call the callback, if provided
-                if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
-                    progress_bar.update()
-                    if callback is not None and i % callback_steps == 0:
-                        callback(i, t, latents)
+        if parallel is not None:
+            with self.progress_bar(total=num_inference_steps) as progress_bar:
+                latents = self._parallel_sampling(
+                    latents, timesteps, unet_inputs, do_classifier_free_guidance, guidance_scale, guidance_interval,
+                    guidance_decay, parallel, parallel_tolerance, generator, eta, progress_bar, callback,
+                    callback_steps,
+                )
+        else:
+            num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
+            with self.progress_bar(total=num_inference_steps - first_step // self.scheduler.order) as progress_bar:
+                for i, t in enumerate(timesteps):
+                    if i < first_step:
+                        # all target views start later on, from their nearest reference
+                        continue
+                    if i in warm_start_latents:
+                        # the views that have not started yet follow the latent of their reference
+                        waiting = (warm_start_steps >= i)[:, None, None, None]
+                        latents = torch.where(waiting, warm_start_latents[i], latents)
+                    # schedule by full sampler steps, so all model evaluations of a multi-order step use the same scale
+                    scale = self.guidance_scale_at(
+                        i // self.scheduler.order, num_inference_steps, guidance_scale, guidance_interval, guidance_decay
+                    )
+                    guidance = do_classifier_free_guidance and scale > 1.0 and not guidance_stopped
+                    step_prompt_embeds, step_poses, step_attention_mask, step_kwargs = (
+                        unet_inputs if guidance else cond_unet_inputs
+                    )
+
+                    step_latents = latents
+                    if active_views is not None:
+                        # only the active views go through the UNet, they attend to the frozen views through the cache
+                        rows = (objects + active_views).flatten()
+                        step_latents = latents[rows]
+                        step_poses = step_poses.target_views(active_views)
+                        frozen_views.capture = freezing_views if (i + 1) % self.scheduler.order == 0 else None
+
+                    if active_views is not None and len(active_views) == 0:
+                        # all target views are frozen and follow their last noise prediction
+                        noise_pred = frozen_noise_pred
+                    else:
+                        # expand the latents if we are doing classifier free guidance
+                        latent_model_input = torch.cat([step_latents] * 2) if guidance else step_latents
+                        latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
+                        latent_model_input = torch.cat([latent_model_input], dim=1)
+
+                        # predict the noise residual
+                        noise_pred = self.unet(latent_model_input,
+                                               t,
+                                               encoder_hidden_states=step_prompt_embeds,
+                                               pose=step_poses,
+                                               cross_attention_kwargs=step_kwargs,
+                                               encoder_attention_mask=step_attention_mask,
+                                               deep_cache=deep_cache,
+                                               deep_cache_parts=["uncond", "cond"] if guidance else ["cond"],
+                                               deep_cache_refresh=deep_cache is None
+                                               or ((i - first_step) // self.scheduler.order) % deep_cache_interval == 0).sample
+
+                        # perform guidance
+                        if guidance:
+                            noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+                            if guidance_stop_threshold is not None and (i + 1) % self.scheduler.order == 0:
+                                # the guidance has no effect anymore once both predictions (nearly) agree
+                                difference = (noise_pred_text - noise_pred_uncond).norm() / noise_pred_text.norm()
+                                guidance_stopped = difference.item() < guidance_stop_threshold
+                            noise_pred = noise_pred_uncond + scale * (noise_pred_text - noise_pred_uncond)
+                        if active_views is not None and len(active_views) < T_out:
+                            # the frozen views follow their last noise prediction
+                            noise_pred = frozen_noise_pred.index_copy(0, rows, noise_pred)
+
+                    # compute the previous noisy sample x_t -> x_t-1
+                    # latents = self.scheduler.step(noise_pred.to(dtype=torch.float32), t, latents.to(dtype=torch.float32)).prev_sample.to(prompt_embeds.dtype)
+                    latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs, return_dict=False)[0]
+
+                    if active_views is not None:
+                        frozen_noise_pred = noise_pred
+                        if (i + 1) % self.scheduler.order == 0:
+                            if freezing_views is not None:
+                                keep = torch.ones_like(active_views, dtype=torch.bool)
+                                keep[freezing_views] = False
+                                active_views, freezing_views = active_views[keep], None
+                            # relative latent update of the full sampler step, the largest over the objects
+                            update = (latents - step_start_latents).flatten(1).norm(dim=1)
+                            update = (update / step_start_latents.flatten(1).norm(dim=1)).view(-1, T_out).amax(dim=0)
+                            converged = (update[active_views] < freeze_threshold).nonzero().flatten()
+                            # the converged views run once more to cache their keys and values, then are frozen
+                            freezing_views = converged if len(converged) > 0 else None
+                            step_start_latents = latents
+
+                    # call the callback, if provided
+                    if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
+                        progress_bar.update()
+                        if callback is not None and i % callback_steps == 0:
+                            callback(i, t, latents)
+
+                    if checkpoint_path is not None and (
+                        i == len(timesteps) - 1
+                        or ((i + 1) % self.scheduler.order == 0 and (i + 1) // self.scheduler.order % checkpoint_steps == 0)
+                    ):
+                        self._save_checkpoint(checkpoint_path, i + 1, latents, generator, guidance_stopped)
 
         # 8. Post-processing
         has_nsfw_concept = None
@@ -817,12 +1544,14 @@ class Zero1to3StableDiffusionPipeline(DiffusionPipeline):
             image = latents
         elif output_type == "pil":
             # 8. Post-processing
-            image = self.decode_latents(latents)
+            image = self.decode_latents(latents, vae_chunk_size)
             # 10. Convert to PIL
             image = self.numpy_to_pil(image)
+        elif output_type == "uint8":
+            image = self.decode_latents(latents, vae_chunk_size, np.uint8)
         else:
             # 8. Post-processing
-            image = self.decode_latents(latents)
+            image = self.decode_latents(latents, vae_chunk_size)
 
         # Offload last model to CPU
         if hasattr(self, "final_offload_hook") and self.final_offload_hook is not None:
@@ -831,4 +1560,184 @@ class Zero1to3StableDiffusionPipeline(DiffusionPipeline):
         if not return_dict:
             return (image, has_nsfw_concept)
 
-        return StableDiffusionPipelineOutput(images=image, nsfw_content_detected=has_nsfw_concept)
\ No newline at end of file
+        return StableDiffusionPipelineOutput(images=image, nsfw_content_detected=has_nsfw_concept)
+
+    @torch.no_grad()
+    def generate_batch(self, objects: List[Dict[str, Any]], **kwargs):
+        r"""
+        Generate the target views of several objects, each with its own number of reference and target views, in one
+        batch. The objects are packed along the views into a single multiview batch, and the attention is split into
+        per-object segments (see [`ViewSegments`]) so the views of different objects never attend to each other.
+
+        Args:
+            objects (`List[dict]`):
+                The objects, each a dict with `input_imgs` `(T_in, 3, H, W)` in [-1, 1], `poses` as in [`__call__`]
+                (batch size 1) and optionally `prompt_imgs` (defaults to `input_imgs`). With `view_seed`, also
+                optionally `object_id` (defaults to the position in `objects`) and `view_indices`.
+            kwargs:
+                Passed to [`__call__`]. All of them are checked before the objects are packed:
+
+                - `input_imgs`, `prompt_imgs`, `poses`, `T_in` and `T_out` are given per object in `objects`.
+                - `view_neighbors`, `reference_token_budget`, `warm_start_angle`, `freeze_threshold` and
+                  `num_images_per_prompt > 1` do not support packed objects.
+                - `checkpoint_path` can't be combined with `parallel` or `deep_cache_interval`, `parallel` can't be
+                  combined with `cache_reference_kv`, `deep_cache_interval` or `guidance_stop_threshold`, and
+                  `view_seed` can't be combined with `generator`, as for [`__call__`].
+
+        Returns:
+            `List`: The generated `images` of every object, in the `output_type` of [`__call__`].
+        """
+        per_object = [name for name in ("input_imgs", "prompt_imgs", "poses", "T_in", "T_out") if name in kwargs]
+        if per_object:
+            raise ValueError(f"`generate_batch` takes {per_object} per object in `objects`.")
+        unsupported = [
+            name
+            for name in ("view_neighbors", "reference_token_budget", "warm_start_angle", "freeze_threshold")
+            if kwargs.get(name) is not None
+        ]
+        if kwargs.get("num_images_per_prompt", 1) > 1:
+            unsupported.append("num_images_per_prompt")
+        if unsupported:
+            raise ValueError(f"`generate_batch` does not support {unsupported} with packed objects.")
+        parallel, deep_cache_interval = kwargs.get("parallel"), kwargs.get("deep_cache_interval")
+        if kwargs.get("checkpoint_path") is not None and (parallel is not None or deep_cache_interval is not None):
+            raise ValueError(
+                "`checkpoint_path` can't be combined with `parallel` or `deep_cache_interval`, whose state between the"
+                " steps is not saved."
+            )
+        if parallel is not None and (
+            kwargs.get("cache_reference_kv") or deep_cache_interval is not None
+            or kwargs.get("guidance_stop_threshold") is not None
+        ):
+            raise ValueError(
+                "`parallel` sampling can't be combined with `cache_reference_kv`, `deep_cache_interval` or"
+                " `guidance_stop_threshold`, which assume one denoising step per UNet call."
+            )
+        if kwargs.get("view_seed") is not None and kwargs.get("generator") is not None:
+            raise ValueError("Pass either `generator` or `view_seed`, not both.")
+
+        def cat_poses(poses):
+            if isinstance(poses[0], torch.Tensor):
+                return torch.cat(poses, dim=1)
+            return [cat_poses(p) for p in zip(*poses)]
+
+        target_views = [obj["poses"][0].shape[1] for obj in objects]
+        reference_views = [obj["input_imgs"].shape[0] for obj in objects]
+        input_imgs = torch.cat([obj["input_imgs"] for obj in objects])
+        prompt_imgs = torch.cat([obj.get("prompt_imgs", obj["input_imgs"]) for obj in objects])
+        poses = cat_poses([obj["poses"] for obj in objects])
+        cross_attention_kwargs = dict(
+            kwargs.pop("cross_attention_kwargs", None) or {},
+            view_segments=ViewSegments(target_views, reference_views),
+        )
+        view_seed = kwargs.pop("view_seed", None)
+        if view_seed is not None:
+            # the packed batch is a single object for `__call__`, so the views are seeded per object here
+            kwargs["generator"] = [
+                generator
+                for i, (obj, t_out) in enumerate(zip(objects, target_views))
+                for generator in self.view_generators(
+                    view_seed, [obj.get("object_id", i)], obj.get("view_indices", torch.arange(t_out))
+                )
+            ]
+        images = self(
+            input_imgs=input_imgs, prompt_imgs=prompt_imgs, poses=poses, T_in=sum(reference_views),
+            T_out=sum(target_views), cross_attention_kwargs=cross_attention_kwargs, **kwargs
+        ).images
+
+        outputs, start = [], 0
+        for t_out in target_views:
+            outputs.append(images[start:start + t_out])
+            start += t_out
+        return outputs
+
+    def _decode_views(self, latents, chunk_size, output_type):
+        # decode `chunk_size` views at a time, so only one chunk of decoded images is held at once
+        for start in range(0, latents.shape[0], chunk_size):
+            with torch.no_grad():
+                if output_type == "uint8":
+                    images = self.decode_latents(latents[start:start + chunk_size], dtype=np.uint8)
+                else:
+                    images = self.decode_latents(latents[start:start + chunk_size])
+            if output_type == "pil":
+                images = self.numpy_to_pil(images)
+            for i, image in enumerate(images):
+                yield start + i, image
+
+    def generate_stream(
+        self,
+        decode_chunk_size: int = 8,
+        preview_steps: Optional[int] = None,
+        preview_callback: Optional[Callable[[int, int, Any], None]] = None,
+        **kwargs,
+    ):
+        r"""
+        Generate the target views as [`__call__`] does, but yield the views as soon as the VAE has decoded them instead
+        of returning once all views are decoded, so consumers (writers, metrics, reconstruction) can start early.
+
+        The denoising runs in a background thread while the views are decoded and yielded in the calling thread, in
+        chunks of `decode_chunk_size` views, so the memory of the decoded images stays bounded for large `T_out`.
+        Closing the generator early stops the denoising at the next step.
+
+        Args:
+            decode_chunk_size (`int`, *optional*, defaults to 8):
+                The number of views decoded by the VAE at once.
+            preview_steps (`int`, *optional*):
+                If set, previews of all views are decoded from the current latents every `preview_steps` denoising
+                steps and passed to `preview_callback`.
+            preview_callback (`Callable`, *optional*):
+                Called as `preview_callback(step, view_index, image)` for every view of a preview, in the calling
+                thread while the generator is consumed. Required with `preview_steps`.
+            kwargs:
+                Passed to [`__call__`]. `output_type` is `"numpy"` (default), `"uint8"` or `"pil"`.
+
+        Yields:
+            `(view_index, image)`: The index of the target view and its final image.
+        """
+        if preview_steps is not None and preview_callback is None:
+            raise ValueError("`preview_steps` requires a `preview_callback` to pass the previews to.")
+        output_type = kwargs.pop("output_type", "numpy")
+        callback = kwargs.pop("callback", None)
+        callback_steps = kwargs.pop("callback_steps", 1)
+        kwargs.pop("return_dict", None)
+        # the denoising thread hands over latents only, at most two sets of them are pending at once
+        queue = Queue(maxsize=2)
+        stopped = threading.Event()
+
+        def step_callback(i, t, latents):
+            if stopped.is_set():
+                raise InterruptedError("generate_stream was closed")
+            if callback is not None and i % callback_steps == 0:
+                callback(i, t, latents)
+            if preview_steps is not None and (i + 1) % preview_steps == 0:
+                queue.put((i, latents))
+
+        def denoise():
+            try:
+                latents = self(output_type="latent", callback=step_callback, callback_steps=1, **kwargs).images
+                queue.put((None, latents))
+            except BaseException as error:
+                queue.put((None, error))
+
+        thread = threading.Thread(target=denoise, daemon=True)
+        thread.start()
+        try:
+            while True:
+                step, latents = queue.get()
+                if isinstance(latents, BaseException):
+                    raise latents
+                for view_index, image in self._decode_views(latents, decode_chunk_size, output_type):
+                    if step is None:
+                        yield view_index, image
+                    else:
+                        preview_callback(step, view_index, image)
+                if step is None:
+                    break
+        finally:
+            stopped.set()
+            # unblock the denoising thread until it sees `stopped` or finishes
+            while thread.is_alive():
+                try:
+                    queue.get(timeout=0.1)
+                except Empty:
+                    pass
@@ -0,0 +1,115 @@
+# Reference token budget: prune the background tokens of the reference views and merge near-duplicate tokens of
+# neighbouring references, so the cross-attention cost stays roughly flat as T_in grows.
+
+import torch
+import torch.nn.functional as F
+
+from diffusers.models.attention_processor import view_angles
+
+
+def foreground_tokens(images, grid, alphas=None, tol=2 / 255):
+    """
+    Find the reference tokens that do not only cover background.
+    :param images: reference images [bt, 3, H, W] in [0, 1]
+    :param grid: (h, w) token grid of the image encoder
+    :param alphas: optional alpha masks [bt, 1, H, W], background where 0
+    :param tol: colour tolerance of the uniform background test, used without alphas
+    :return: foreground mask [bt, h*w]
+    """
+    if alphas is not None:
+        fg = F.adaptive_avg_pool2d(alphas.float(), grid) > 0
+    else:
+        # patches of uniform background colour, taken as the median colour of the image border (white for load_im)
+        images = images.float()
+        border = torch.cat([images[..., 0, :], images[..., -1, :], images[..., 0], images[..., -1]], dim=-1)
+        background = border.median(dim=-1).values[..., None, None]
+        deviation = (images - background).abs().amax(dim=1, keepdim=True)
+        fg = F.adaptive_max_pool2d(deviation, grid) > tol
+    return fg.flatten(1)
+
+
+def merge_tokens(x, views, size, budget, neighbors, chunk=1024):
+    """
+    Bipartite (ToMe-style) merging of the most similar tokens of neighbouring references until `budget` tokens are
+    left. A merged token is the size-weighted mean of its tokens and keeps the reference view (pose) of the token it is
+    merged into.
+    :param x: tokens [n, c]
+    :param views: reference view of every token [n]
+    :param size: number of original tokens in every token [n]
+    :param budget: number of tokens to keep
+    :param neighbors: [t, t] bool, which references may be merged together
+    :param chunk: rows of the similarity matrix computed at once
+    :return: merged x, views, size
+    """
+    while x.shape[0] > budget:
+        xa, xb = x[::2], x[1::2]
+        va, vb = views[::2], views[1::2]
+        sa, sb = size[::2], size[1::2]
+        na, nb = F.normalize(xa.float(), dim=-1), F.normalize(xb.float(), dim=-1)
+        best, match = [], []
+        for start in range(0, xa.shape[0], chunk):
+            similarity = na[start:start + chunk] @ nb.T
+            similarity.masked_fill_(~neighbors[va[start:start + chunk]][:, vb], -float("inf"))
+            value, index = similarity.max(dim=-1)
+            best.append(value)
+            match.append(index)
+        best, match = torch.cat(best), torch.cat(match)
+
+        order = best.argsort(descending=True)
+        merged = order[:x.shape[0] - budget]
+        merged = merged[best[merged] > -float("inf")]
+        if len(merged) == 0:
+            # no tokens of neighbouring references left to merge
+            break
+        kept = torch.ones_like(best, dtype=torch.bool)
+        kept[merged] = False
+
+        xb = (xb * sb[:, None]).index_add(0, match[merged], xa[merged] * sa[merged][:, None])
+        sb = sb.index_add(0, match[merged], sa[merged])
+        x = torch.cat([xa[kept], xb / sb[:, None]])
+        views = torch.cat([va[kept], vb])
+        size = torch.cat([sa[kept], sb])
+    return x, views, size
+
+
+def reference_token_budget(embeds, images, pose_in, budget, alphas=None, num_neighbors=4):
+    """
+    Reduce the reference tokens to at most `budget` per object: drop the background tokens, then merge near-duplicate
+    tokens of the `num_neighbors` nearest references (by camera angle).
+    :param embeds: reference tokens [b, t, l, c]
+    :param images: reference images [bt, 3, H, W] in [0, 1]
+    :param pose_in: reference poses [b, t, ...], as in the CaPE posemb
+    :param budget: maximum number of reference tokens per object
+    :param alphas: optional alpha masks [bt, 1, H, W] of the references
+    :param num_neighbors: number of nearest references whose tokens may be merged with a reference's tokens
+    :return: tokens [b, n, c], their reference views [b, n], and a mask [b, n] of the valid tokens if the objects end
+        up with different numbers of tokens (None otherwise)
+    """
+    b, t, l, c = embeds.shape
+    grid = (int(l ** 0.5), l // int(l ** 0.5))
+    fg = foreground_tokens(images, grid, alphas).view(b, t * l)
+    views = torch.arange(t, device=embeds.device).repeat_interleave(l)
+
+    angles = view_angles(pose_in)  # b t t
+    nearest = angles.topk(min(num_neighbors + 1, t), dim=-1, largest=False).indices
+    neighbors = torch.zeros_like(angles, dtype=torch.bool).scatter_(2, nearest, True)
+    neighbors = neighbors | neighbors.transpose(1, 2)
+
+    tokens, token_views = [], []
+    for i in range(b):
+        keep = fg[i] if fg[i].any() else torch.ones_like(fg[i])
+        x = embeds[i].reshape(t * l, c)[keep]
+        v = views[keep]
+        size = torch.ones_like(v, dtype=x.dtype)
+        x, v, _ = merge_tokens(x, v, size, budget, neighbors[i])
+        tokens.append(x.to(embeds.dtype))
+        token_views.append(v)
+
+    n = max(len(v) for v in token_views)
+    mask = torch.zeros(b, n, dtype=torch.bool, device=embeds.device)
+    for i, v in enumerate(token_views):
+        mask[i, :len(v)] = True
+        # pad with zero tokens of view 0, masked out of the cross-attention
+        tokens[i] = F.pad(tokens[i], (0, 0, 0, n - len(v)))
+        token_views[i] = F.pad(v, (0, n - len(v)))
+    return torch.stack(tokens), torch.stack(token_views), None if mask.all() else mask
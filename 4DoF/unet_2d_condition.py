@@ -23,7 +23,7 @@ from diffusers.loaders import UNet2DConditionLoadersMixin
 from diffusers.utils import BaseOutput
 from diffusers.utils import logging
 from diffusers.models.activations import get_activation
-from diffusers.models.attention_processor import AttentionProcessor, AttnProcessor
+from diffusers.models.attention_processor import Attention, AttentionProcessor, AttnProcessor, prepare_posemb
 from diffusers.models.embeddings import (
     GaussianFourierProjection,
     ImageHintTimeEmbedding,
@@ -64,6 +64,28 @@ class UNet2DConditionOutput(BaseOutput):
     sample: torch.FloatTensor = None
 
 
+class DeepCache(dict):
+    r"""
+    Deep UNet features reused across adjacent denoising steps (DeepCache).
+
+    The deep features of the UNet change slowly between neighbouring timesteps. On a full step the UNet stores the
+    input of its `branch` shallowest up blocks; on the following cheap steps it only runs the `branch` shallowest down
+    blocks and the matching up blocks on top of the stored features, skipping the deeper down, mid and up blocks. Pass
+    it to [`UNet2DConditionModel.forward`] as `deep_cache`.
+
+    The features are stored per named batch part, e.g. the `"uncond"` and `"cond"` halves of classifier-free guidance,
+    each a `(b t_out)` block of the batch, so a cheap step can run on any of the parts cached before.
+
+    Args:
+        branch (`int`, *optional*, defaults to 1):
+            The number of shallow resolution levels recomputed on cheap steps.
+    """
+
+    def __init__(self, branch: int = 1):
+        super().__init__()
+        self.branch = branch
+
+
 class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin):
     r"""
     A conditional 2D UNet model that takes a noisy sample, conditional state, and a timestep and returns a sample
@@ -699,6 +721,65 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         for module in self.children():
             fn_recursive_set_attention_slice(module, reversed_slice_size)
 
+    def set_token_merging(self, ratio: Optional[Union[float, List[float]]]):
+        r"""
+        Enable token merging (ToMe) in the multiview self-attention.
+
+        Before every self-attention, the most similar tokens of each target view are merged and the attention output
+        is copied back to the merged tokens. Tokens are only merged within a view, so they keep the CaPE pose of their
+        view. This reduces the `(t_out l)` self-attention cost for many target views, at some loss of detail.
+
+        Args:
+            ratio (`float` or `list(float)`, *optional*):
+                Fraction of the tokens of every view to merge, at most 0.75. A list sets one ratio per resolution
+                level, from the highest resolution (first down block) to the lowest, e.g. `[0.5, 0.25, 0.0, 0.0]`.
+                `None` or 0 disables token merging.
+        """
+        num_levels = len(self.down_blocks)
+        ratio = num_levels * [ratio] if not isinstance(ratio, (list, tuple)) else list(ratio)
+        if len(ratio) != num_levels:
+            raise ValueError(
+                f"You have provided {len(ratio)} token merging ratios, but {self.config} has {num_levels} resolution"
+                f" levels. Make sure to match `len(ratio)` to be {num_levels}."
+            )
+
+        def fn_recursive_set_token_merging(module: torch.nn.Module, ratio: Optional[float]):
+            if hasattr(module, "set_token_merging"):
+                module.set_token_merging(ratio)
+
+            for child in module.children():
+                fn_recursive_set_token_merging(child, ratio)
+
+        for level, block in enumerate(self.down_blocks):
+            fn_recursive_set_token_merging(block, ratio[level])
+        if self.mid_block is not None:
+            fn_recursive_set_token_merging(self.mid_block, ratio[-1])
+        for i, block in enumerate(self.up_blocks):
+            fn_recursive_set_token_merging(block, ratio[len(self.up_blocks) - 1 - i])
+
+    def fuse_qkv_projections(self):
+        r"""
+        Fuse the query, key and value projections of every self-attention layer into one linear layer, so the
+        multiview self-attention runs one matrix multiplication instead of three. Cross-attention layers are left
+        unchanged. The state dict (and so `save_pretrained`) keeps the separate projections, use
+        `unfuse_qkv_projections` to also split the modules again. Raises a `ValueError`, before fusing any layer, if
+        an attention processor (e.g. LoRA or custom diffusion) has no fused projections branch.
+        """
+        attention_layers = [module for module in self.modules() if isinstance(module, Attention)]
+        for module in attention_layers:
+            if not module.is_cross_attention and module.added_kv_proj_dim is None:
+                module.check_fused_projections_processor(module.processor)
+        for module in attention_layers:
+            module.fuse_projections(True)
+
+    def unfuse_qkv_projections(self):
+        r"""
+        Split the fused query, key and value projections of `fuse_qkv_projections` back into separate linear layers.
+        """
+        for module in self.modules():
+            if isinstance(module, Attention):
+                module.fuse_projections(False)
+
     def _set_gradient_checkpointing(self, module, value=False):
         if isinstance(module, (CrossAttnDownBlock2D, DownBlock2D, CrossAttnUpBlock2D, UpBlock2D)):
             module.gradient_checkpointing = value
@@ -717,6 +798,9 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         down_block_additional_residuals: Optional[Tuple[torch.Tensor]] = None,
         mid_block_additional_residual: Optional[torch.Tensor] = None,
         encoder_attention_mask: Optional[torch.Tensor] = None,
+        deep_cache: Optional[DeepCache] = None,
+        deep_cache_parts: Optional[List[str]] = None,
+        deep_cache_refresh: bool = True,
         return_dict: bool = True,
     ) -> Union[UNet2DConditionOutput, Tuple]:
         r"""
@@ -728,10 +812,20 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
             timestep (`torch.FloatTensor` or `float` or `int`): The number of timesteps to denoise an input.
             encoder_hidden_states (`torch.FloatTensor`):
                 The encoder hidden states with shape `(batch, sequence_length, feature_dim)`.
+            pose (`list`, *optional*):
+                The CaPE poses of the target and reference views, passed to the attention processors as `posemb`.
             encoder_attention_mask (`torch.Tensor`):
                 A cross-attention mask of shape `(batch, sequence_length)` is applied to `encoder_hidden_states`. If
                 `True` the mask is kept, otherwise if `False` it is discarded. Mask will be converted into a bias,
                 which adds large negative values to the attention scores corresponding to "discard" tokens.
+            deep_cache ([`DeepCache`], *optional*):
+                If set, the deep features are stored in the cache on full steps and reused on cheap steps.
+            deep_cache_parts (`List[str]`, *optional*):
+                Names of the equally sized parts of the batch the deep features are stored under, e.g.
+                `["uncond", "cond"]` for a classifier-free guidance batch. Defaults to one part for the whole batch.
+            deep_cache_refresh (`bool`, *optional*, defaults to `True`):
+                Whether to run the full UNet and store the deep features, or to reuse the cached ones. Parts that are
+                not cached yet always run the full UNet.
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`~models.unet_2d_condition.UNet2DConditionOutput`] instead of a plain
                 tuple.
@@ -785,6 +879,10 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
         if self.config.center_input_sample:
             sample = 2 * sample - 1.0
 
+        # prepare the CaPE poses once, shared by all attention layers
+        if pose is not None:
+            pose = prepare_posemb(pose)
+
         # 1. time
         timesteps = timestep
         if not torch.is_tensor(timesteps):
@@ -902,13 +1000,20 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
                 )
             image_embeds = added_cond_kwargs.get("image_embeds")
             encoder_hidden_states = self.encoder_hid_proj(image_embeds)
+        # cheap DeepCache step: only the shallow levels are run, on top of the cached deep features
+        deep_cache_parts = deep_cache_parts or ["all"]
+        use_deep_cache = (
+            deep_cache is not None and not deep_cache_refresh and all(part in deep_cache for part in deep_cache_parts)
+        )
+        down_blocks = self.down_blocks[: deep_cache.branch] if use_deep_cache else self.down_blocks
+
         # 2. pre-process
         sample = self.conv_in(sample)
 
 
         # 3. down
         down_block_res_samples = (sample,)
-        for downsample_block in self.down_blocks:
+        for downsample_block in down_blocks:
             if hasattr(downsample_block, "has_cross_attention") and downsample_block.has_cross_attention:
                 sample, res_samples = downsample_block(
                     hidden_states=sample,
@@ -936,8 +1041,13 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
 
             down_block_res_samples = new_down_block_res_samples
 
+        if use_deep_cache:
+            # skip connections of the shallow up blocks only
+            shallow_up_blocks = self.up_blocks[-deep_cache.branch :]
+            down_block_res_samples = down_block_res_samples[: sum(len(block.resnets) for block in shallow_up_blocks)]
+
         # 4. mid
-        if self.mid_block is not None:
+        if self.mid_block is not None and not use_deep_cache:
             sample = self.mid_block(
                 sample,
                 emb,
@@ -948,13 +1058,21 @@ class UNet2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixin)
                 posemb=pose,
             )
 
-        if mid_block_additional_residual is not None:
+        if mid_block_additional_residual is not None and not use_deep_cache:
             sample = sample + mid_block_additional_residual
 
         # 5. up
         for i, upsample_block in enumerate(self.up_blocks):
             is_final_block = i == len(self.up_blocks) - 1
 
+            if deep_cache is not None and i == len(self.up_blocks) - deep_cache.branch:
+                if use_deep_cache:
+                    sample = torch.cat([deep_cache[part] for part in deep_cache_parts])
+                else:
+                    deep_cache.update(zip(deep_cache_parts, sample.chunk(len(deep_cache_parts))))
+            elif use_deep_cache and i < len(self.up_blocks) - deep_cache.branch:
+                continue
+
             res_samples = down_block_res_samples[-len(upsample_block.resnets) :]
             down_block_res_samples = down_block_res_samples[: -len(upsample_block.resnets)]
 
@@ -91,6 +91,7 @@ else:
         KarrasVeScheduler,
         KDPM2AncestralDiscreteScheduler,
         KDPM2DiscreteScheduler,
+        LCMScheduler,
         PNDMScheduler,
         RePaintScheduler,
         SchedulerMixin,
@@ -11,7 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 
 import torch
 import torch.nn.functional as F
@@ -19,10 +19,59 @@ from torch import nn
 
 from ..utils import maybe_allow_in_graph
 from .activations import get_activation
-from .attention_processor import Attention
+from .attention_processor import Attention, prepare_posemb
 from .embeddings import CombinedTimestepLabelEmbeddings
 
 
+def bipartite_soft_matching(metric: torch.Tensor, r: int, grid: Optional[Tuple[int, int]] = None, stride=(2, 2)):
+    r"""
+    Token merging (ToMe) by bipartite soft matching, done independently for every row of `metric`.
+
+    One token of every `stride` cell of the `grid` is a destination token, the `r` source tokens most similar to a
+    destination token are merged into it. In the multiview UNet every row is one view, so merged tokens never mix views
+    and keep the CaPE pose of their view.
+
+    Returns the `merge` and `unmerge` functions, [b, n, c] -> [b, n - r, c] -> [b, n, c].
+    """
+    b, n, _ = metric.shape
+    h, w = grid if grid is not None else (1, n)
+    sy, sx = stride if grid is not None else (1, stride[0] * stride[1])
+    position = torch.arange(n, device=metric.device)
+    is_dst = (position // w % sy == 0) & (position % w % sx == 0)
+    src_idx, dst_idx = (~is_dst).nonzero().squeeze(1), is_dst.nonzero().squeeze(1)
+
+    r = min(r, len(src_idx))
+    if r <= 0:
+        return (lambda x: x), (lambda x: x)
+
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        scores = metric[:, src_idx] @ metric[:, dst_idx].transpose(-1, -2)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx, src_m_idx = edge_idx[:, r:], edge_idx[:, :r]  # unmerged and merged source tokens
+        dst_m_idx = node_idx[..., None].gather(1, src_m_idx)
+
+    def merge(x):
+        c = x.shape[-1]
+        src, dst = x[:, src_idx], x[:, dst_idx]
+        unm = src.gather(1, unm_idx.expand(-1, -1, c))
+        src = src.gather(1, src_m_idx.expand(-1, -1, c))
+        dst = dst.scatter_reduce(1, dst_m_idx.expand(-1, -1, c), src, reduce="mean")
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x):
+        c = x.shape[-1]
+        unm, dst = x[:, : unm_idx.shape[1]], x[:, unm_idx.shape[1] :]
+        out = x.new_empty(b, n, c)
+        out[:, dst_idx] = dst
+        out.scatter_(1, src_idx[unm_idx].expand(-1, -1, c), unm)
+        out.scatter_(1, src_idx[src_m_idx].expand(-1, -1, c), dst.gather(1, dst_m_idx.expand(-1, -1, c)))
+        return out
+
+    return merge, unmerge
+
+
 @maybe_allow_in_graph
 class BasicTransformerBlock(nn.Module):
     r"""
@@ -90,6 +139,7 @@ class BasicTransformerBlock(nn.Module):
             bias=attention_bias,
             cross_attention_dim=cross_attention_dim if only_cross_attention else None,
             upcast_attention=upcast_attention,
+            cape=True,
         )
 
         # 2. Cross-Attn
@@ -110,6 +160,7 @@ class BasicTransformerBlock(nn.Module):
                 dropout=dropout,
                 bias=attention_bias,
                 upcast_attention=upcast_attention,
+                cape=True,
             )  # is self-attn if encoder_hidden_states is none
         else:
             self.norm2 = None
@@ -123,11 +174,18 @@ class BasicTransformerBlock(nn.Module):
         self._chunk_size = None
         self._chunk_dim = 0
 
+        # let token merging default to None
+        self._tome_ratio = None
+
     def set_chunk_feed_forward(self, chunk_size: Optional[int], dim: int):
         # Sets chunk feed-forward
         self._chunk_size = chunk_size
         self._chunk_dim = dim
 
+    def set_token_merging(self, ratio: Optional[float]):
+        # Sets the fraction of the tokens of every view merged before the self-attention
+        self._tome_ratio = ratio
+
     def forward(
         self,
         hidden_states: torch.FloatTensor,
@@ -151,6 +209,22 @@ class BasicTransformerBlock(nn.Module):
             norm_hidden_states = self.norm1(hidden_states)
 
         cross_attention_kwargs = cross_attention_kwargs if cross_attention_kwargs is not None else {}
+        # the samples of an object share its reference tokens in the cross-attention, see `CaPEPoses.samples`
+        samples_per_object = cross_attention_kwargs.get("samples_per_object")
+        if samples_per_object is not None:
+            cross_attention_kwargs = {k: v for k, v in cross_attention_kwargs.items() if k != "samples_per_object"}
+
+        if self._tome_ratio and attention_mask is None:
+            # merge redundant tokens within each view (batch row) for the self-attention, the CaPE pose of a view is
+            # shared by all its tokens so merged tokens keep a consistent pose
+            n = norm_hidden_states.shape[1]
+            h = int(n**0.5)
+            merge, unmerge = bipartite_soft_matching(
+                norm_hidden_states, int(n * self._tome_ratio), grid=(h, n // h) if h * (n // h) == n else None
+            )
+            norm_hidden_states = merge(norm_hidden_states)
+        else:
+            unmerge = None
 
         attn_output = self.attn1(
             norm_hidden_states,
@@ -159,6 +233,8 @@ class BasicTransformerBlock(nn.Module):
             posemb=posemb,  # todo in self attn, posemb shoule be [pose_in, pose_in]?
             **cross_attention_kwargs,
         )
+        if unmerge is not None:
+            attn_output = unmerge(attn_output)
         if self.use_ada_layer_norm_zero:
             attn_output = gate_msa.unsqueeze(1) * attn_output
         hidden_states = attn_output + hidden_states
@@ -173,7 +249,7 @@ class BasicTransformerBlock(nn.Module):
                 norm_hidden_states,
                 encoder_hidden_states=encoder_hidden_states,
                 attention_mask=encoder_attention_mask,
-                posemb=posemb,
+                posemb=posemb if samples_per_object is None else prepare_posemb(posemb).samples(samples_per_object),
                 **cross_attention_kwargs,
             )
             hidden_states = attn_output + hidden_states
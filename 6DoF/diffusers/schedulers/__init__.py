@@ -45,6 +45,7 @@ else:
     from .scheduling_k_dpm_2_ancestral_discrete import KDPM2AncestralDiscreteScheduler
     from .scheduling_k_dpm_2_discrete import KDPM2DiscreteScheduler
     from .scheduling_karras_ve import KarrasVeScheduler
+    from .scheduling_lcm import LCMScheduler
     from .scheduling_pndm import PNDMScheduler
     from .scheduling_repaint import RePaintScheduler
     from .scheduling_sde_ve import ScoreSdeVeScheduler
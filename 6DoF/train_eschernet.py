@@ -98,7 +98,7 @@ def log_validation(validation_dataloader, vae, image_encoder, feature_extractor,
     pipeline = pipeline.to(accelerator.device)
     pipeline.set_progress_bar_config(disable=True)
 
-    if args.enable_xformers_memory_efficient_attention:
+    if args.enable_xformers_memory_efficient_attention and is_xformers_available():
         pipeline.enable_xformers_memory_efficient_attention()
 
     if args.seed is None:
@@ -397,6 +397,14 @@ def parse_args(input_args=None):
     parser.add_argument(
         "--enable_xformers_memory_efficient_attention", default=True, help="Whether or not to use xformers."
     )
+    parser.add_argument(
+        "--fuse_qkv_projections",
+        action="store_true",
+        help=(
+            "Whether or not to fuse the query, key and value projections of the UNet self-attention into one linear"
+            " layer. Saved checkpoints keep the separate projections."
+        ),
+    )
     parser.add_argument(
         "--set_grads_to_none",
         default=True,
@@ -565,6 +573,10 @@ def main(args):
     unet.requires_grad_(True)
     unet.train()
 
+    # fuse before the EMA and the optimizer are created, so they track the fused parameters
+    if args.fuse_qkv_projections:
+        unet.fuse_qkv_projections()
+
 
     # Create EMA for the unet.
     if args.use_ema:
@@ -582,7 +594,9 @@ def main(args):
             unet.enable_xformers_memory_efficient_attention()
             vae.enable_slicing()
         else:
-            raise ValueError("xformers is not available. Make sure it is installed correctly")
+            logger.warn(
+                "xformers is not available, falling back to the CaPE scaled dot-product attention of PyTorch 2.0."
+            )
 
     if args.gradient_checkpointing:
         unet.enable_gradient_checkpointing()
@@ -15,6 +15,19 @@ class CaPE_6DoF:
         f = einops.rearrange(f, '... (d k) -> ... d k', k=4)
         return einops.rearrange(f@P, '... d k -> ... (d k)', k=4)
 
+    def cape_embed_views(self, f, P):
+        """
+        Apply CaPE on feature, one pose per view.
+        Same as cape_embed(f, repeat(P, 'b t m n -> b (t l) m n')) without expanding P to every token.
+        :param f: feature vector of shape [b, (t l), d]
+        :param P: 4x4 transformation matrix of each view, [b, t, 4, 4]
+        :return: rotated feature f by pose P: f@P
+        """
+        b, n, d = f.shape
+        t = P.shape[1]
+        f = f.reshape(b, t, n // t * d // 4, 4)  # [b, t, (l d/4), 4]
+        return (f@P).reshape(b, n, d)
+
     def attn_with_CaPE(self, f1, f2, p1, p2):
         """
         Do attention dot production with CaPE pose encoding.
@@ -28,10 +41,9 @@ class CaPE_6DoF:
         """
         l = f1.shape[1] // p1.shape[1]
         assert f1.shape[1] // p1.shape[1] == f2.shape[1] // p2.shape[1]
-        p1_invT = einops.repeat(torch.inverse(p1).permute(0, 1, 3, 2), 'b t m n -> b (t l) m n', l=l)  # f1 [b, l*t1, d]
-        query = self.cape_embed(f1, p1_invT)  # [b, l*t1, d] query: f1 @ (p1)^(-T), transpose the last two dim
-        p2_copy = einops.repeat(p2, 'b t m n -> b (t l) m n', l=l) # f2 [b, l*t2, d]
-        key = self.cape_embed(f2, p2_copy)  # [b, l*t2, d] key: f2 @ p2
+        p1_invT = torch.inverse(p1).permute(0, 1, 3, 2)  # [b, t1, 4, 4]
+        query = self.cape_embed_views(f1, p1_invT)  # [b, l*t1, d] query: f1 @ (p1)^(-T), transpose the last two dim
+        key = self.cape_embed_views(f2, p2)  # [b, l*t2, d] key: f2 @ p2
         att = query @ key.permute(0, 2, 1)  # [b, l*t1, l*t2] attention: query@key^T
         return att
 
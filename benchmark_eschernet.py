@@ -0,0 +1,900 @@
+#!/usr/bin/env python
+# coding=utf-8
+# CPU-friendly micro benchmarks of the EscherNet denoising UNet.
+#
+# By default a small randomly initialized UNet with the EscherNet conditioning layout (12x12 ConvNeXt tokens of
+# dim 768 per reference view) is used, so the benchmarks run without the pretrained weights. Pass
+# --pretrained_model_name_or_path to time the released UNet instead.
+#
+#   python benchmark_eschernet.py --cape_type 6DoF --bench kv_cache --T_in 100 --T_out 3
+
+import argparse
+import contextlib
+import resource
+import sys
+import time
+
+import torch
+
+
+def parse_args(input_args=None):
+    parser = argparse.ArgumentParser(description="EscherNet benchmarks.")
+    parser.add_argument("--cape_type", type=str, default="6DoF", choices=["4DoF", "6DoF"])
+    parser.add_argument("--bench", type=str, default="kv_cache", choices=sorted(BENCHMARKS))
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        default=None,
+        help="Load the UNet from a pretrained model. Defaults to a small randomly initialized UNet.",
+    )
+    parser.add_argument("--T_in", type=int, default=8, help="Number of reference views.")
+    parser.add_argument("--T_out", type=int, default=3, help="Number of target views.")
+    parser.add_argument("--resolution", type=int, default=256)
+    parser.add_argument("--steps", type=int, default=5, help="Number of timed denoising steps.")
+    parser.add_argument("--guidance_scale", type=float, default=3.0)
+    parser.add_argument("--guidance_interval", type=float, nargs=2, default=None, metavar=("START", "END"))
+    parser.add_argument("--guidance_decay", type=str, default=None, choices=["linear", "cosine"])
+    parser.add_argument(
+        "--view_neighbors", type=int, default=None, help="Sparse self-attention neighbours, dense if not set."
+    )
+    parser.add_argument("--view_anchors", type=int, default=0)
+    parser.add_argument("--reference_token_budget", type=int, default=1024)
+    parser.add_argument(
+        "--tome_ratio", type=float, nargs="+", default=[0.5], help="Token merging ratio, one or one per level."
+    )
+    parser.add_argument(
+        "--num_objects",
+        type=int,
+        default=4,
+        help="Packed objects, object i has T_in - i %% 2 reference and T_out + i %% 2 target views.",
+    )
+    parser.add_argument(
+        "--schedulers",
+        type=str,
+        nargs="+",
+        default=["DDIMScheduler", "PNDMScheduler", "LMSDiscreteScheduler", "EulerDiscreteScheduler",
+                 "HeunDiscreteScheduler", "KDPM2DiscreteScheduler", "DPMSolverMultistepScheduler",
+                 "DPMSolverSinglestepScheduler", "DEISMultistepScheduler", "UniPCMultistepScheduler"],
+        help="Samplers compared against DDIM with 50 steps, deterministic ones only.",
+    )
+    parser.add_argument("--sampler_steps", type=int, nargs="+", default=[10, 15, 20, 25, 30])
+    parser.add_argument(
+        "--sampler_tolerance",
+        type=float,
+        default=0.05,
+        help="Relative latent error to DDIM-50 under which a sampler counts as matching it.",
+    )
+    parser.add_argument("--deep_cache_interval", type=int, default=3, help="Full UNet step every N steps.")
+    parser.add_argument("--deep_cache_branch", type=int, default=1, help="Shallow levels run on cheap steps.")
+    parser.add_argument("--parallel", type=int, default=8, help="Window of denoising steps sampled in parallel.")
+    parser.add_argument(
+        "--parallel_tolerance", type=float, default=0.1, help="Error tolerance of the parallel sampling."
+    )
+    parser.add_argument(
+        "--freeze_threshold", type=float, default=0.05, help="Relative latent update under which a view is frozen."
+    )
+    parser.add_argument("--num_samples", type=int, default=4, help="Samples generated per object.")
+    parser.add_argument(
+        "--vae_chunk_size",
+        type=int,
+        default=None,
+        help="Images per VAE call, decoded into uint8. All at once into float32 (as before) if not set.",
+    )
+    parser.add_argument(
+        "--bundle", type=str, default=None, help="Safetensors bundle of export_bundle.py for the cold start benchmark."
+    )
+    parser.add_argument("--chunked", action="store_true", help="Use the memory-bounded chunked CaPE attention.")
+    parser.add_argument(
+        "--max_memory", type=int, default=None, help="Chunked attention memory budget in MiB, free memory if not set."
+    )
+    parser.add_argument(
+        "--sdpa_math",
+        action="store_true",
+        help="Force the math scaled dot-product attention kernel, as on PyTorch 2.0 CPU (no flash kernel).",
+    )
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--seed", type=int, default=0)
+
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+    return args
+
+
+def load_unet(args):
+    from unet_2d_condition import UNet2DConditionModel
+
+    if args.pretrained_model_name_or_path is not None:
+        unet = UNet2DConditionModel.from_pretrained(args.pretrained_model_name_or_path, subfolder="unet")
+    else:
+        unet = UNet2DConditionModel(
+            sample_size=args.resolution // 8,
+            block_out_channels=(64, 128, 128, 128),
+            layers_per_block=1,
+            cross_attention_dim=768,
+            attention_head_dim=8,
+            norm_num_groups=32,
+        )
+    return unet.to(args.device).eval()
+
+
+def random_poses(args, batch_size):
+    # random rigid camera poses in the layout expected by the pipeline, batched for classifier-free guidance
+    def rigid(t):
+        rot, _ = torch.linalg.qr(torch.randn(batch_size, t, 3, 3))
+        pose = torch.eye(4).repeat(batch_size, t, 1, 1)
+        pose[..., :3, :3] = rot
+        pose[..., :3, 3] = torch.randn(batch_size, t, 3)
+        return pose.to(args.device)
+
+    if args.cape_type == "6DoF":
+        pose_out, pose_in = rigid(args.T_out), rigid(args.T_in)
+        return [[pose_out, torch.linalg.inv(pose_out).transpose(-1, -2)],
+                [pose_in, torch.linalg.inv(pose_in).transpose(-1, -2)]]
+    # [theta, azimuth, radius, 0]
+    pose_out, pose_in = torch.randn(batch_size, args.T_out, 4), torch.randn(batch_size, args.T_in, 4)
+    pose_out[..., 3], pose_in[..., 3] = 0, 0
+    return [pose_out.to(args.device), pose_in.to(args.device)]
+
+
+def timed(fn, steps, device):
+    fn(0)  # warmup
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for step in range(steps):
+        fn(step + 1)
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps
+
+
+def bench_kv_cache(args):
+    """Per-step UNet time with and without caching the reference cross-attention keys/values."""
+    from diffusers.models.attention_processor import CrossAttnKVCache
+
+    unet = load_unet(args)
+    batch_size = 2 if args.guidance_scale > 1.0 else 1
+    h = args.resolution // 8
+    latents = torch.randn(batch_size * args.T_out, 4, h, h, device=args.device)
+    prompt_embeds = torch.randn(batch_size, args.T_in * 144, unet.config.cross_attention_dim, device=args.device)
+    poses = random_poses(args, batch_size)
+
+    def run(cross_attention_kwargs):
+        def step(i):
+            return unet(latents, 999 - i, encoder_hidden_states=prompt_embeds, pose=poses,
+                        cross_attention_kwargs=cross_attention_kwargs).sample
+        return step
+
+    with torch.no_grad():
+        base = timed(run(None), args.steps, args.device)
+        # the warmup step fills the cache, as the first denoising step of the pipeline does
+        cached = timed(run({"kv_cache": CrossAttnKVCache()}), args.steps, args.device)
+        # the step that fills the cache and one that reuses it
+        cache = CrossAttnKVCache()
+        pairs = [(run(None)(i), run({"kv_cache": cache})(i)) for i in range(2)]
+        err = max((output - reference).abs().max().item() for reference, output in pairs)
+
+    print(f"T_in={args.T_in} T_out={args.T_out} {args.cape_type} on {args.device}")
+    print(f"no cache: {base * 1000:.1f} ms/step")
+    print(f"kv cache: {cached * 1000:.1f} ms/step ({base / cached:.2f}x), max abs diff {err:.2e}")
+    for reference, output in pairs:
+        assert torch.allclose(output, reference, atol=1e-5), "the cached keys/values change the noise prediction"
+
+
+def bench_cape_6dof(args):
+    """Per-token vs. per-view 6DoF CaPE on the queries of the first self-attention layer."""
+    import einops
+    from diffusers.models.attention_processor import cape_embed, cape_embed_views
+
+    if args.cape_type != "6DoF":
+        raise ValueError("cape_6dof benchmark requires --cape_type 6DoF")
+    batch_size = 2 if args.guidance_scale > 1.0 else 1
+    l = (args.resolution // 8) ** 2
+    query = torch.randn(batch_size, args.T_out * l, 320, device=args.device)
+    [_, pose_out_inv], _ = random_poses(args, batch_size)
+
+    def per_token(_):
+        return cape_embed(query, einops.repeat(pose_out_inv, 'b t f g -> b (t l) f g', l=l))
+
+    def per_view(_):
+        return cape_embed_views(query, pose_out_inv)
+
+    with torch.no_grad():
+        reference, output = per_token(0), per_view(0)
+        err = (output - reference).abs().max().item()
+        base = timed(per_token, args.steps, args.device)
+        blocked = timed(per_view, args.steps, args.device)
+    expanded = batch_size * args.T_out * l * 16 * pose_out_inv.element_size()
+
+    print(f"T_out={args.T_out} tokens/view={l} {args.cape_type} on {args.device}")
+    print(f"per token: {base * 1000:.1f} ms, {expanded / 2 ** 20:.1f} MiB of expanded poses")
+    print(f"per view:  {blocked * 1000:.1f} ms ({base / blocked:.2f}x), max abs diff {err:.2e}")
+    assert torch.allclose(output, reference, atol=1e-5), "per view CaPE differs from per token CaPE"
+
+
+def bench_cape_4dof(args):
+    """4DoF CaPE of one denoising step: rotary tables per query/key vs. cached tables with a complex multiply."""
+    import einops
+    from diffusers.models.attention_processor import CaPEPoses, cape, cape_key, cape_query, rotate_every_two
+
+    if args.cape_type != "4DoF":
+        raise ValueError("cape_4dof benchmark requires --cape_type 4DoF")
+    batch_size = 2 if args.guidance_scale > 1.0 else 1
+    pose_out, pose_in = random_poses(args, batch_size)
+    h = args.resolution // 8
+    # (query tokens per view, feature dim) of the SD attention layers, per resolution level
+    levels = [(h * h, 320), ((h // 2) ** 2, 640), ((h // 4) ** 2, 1280), ((h // 8) ** 2, 1280)]
+    features = [(torch.randn(batch_size, args.T_out * l, d, device=args.device),
+                 torch.randn(batch_size, args.T_in * 144, d, device=args.device)) for l, d in levels]
+
+    def rotate(x, p):
+        m = cape(x, einops.repeat(p, 'b t n -> b (t l) n', l=x.shape[1] // p.shape[1]))
+        return (x * m.cos()) + (rotate_every_two(x) * m.sin())
+
+    def per_call(_):
+        for query, key in features:
+            rotate(query, pose_out), rotate(query, pose_out), rotate(key, pose_in)
+
+    posemb = CaPEPoses([pose_out, pose_in])
+
+    def cached(_):
+        for query, key in features:
+            cape_query(query, posemb), cape_key(query, posemb, True), cape_key(key, posemb, False)
+
+    with torch.no_grad():
+        # queries, self-attention keys and cross-attention keys of every level
+        pairs = [pair for query, key in features for pair in [
+            (rotate(query, pose_out), cape_query(query, posemb)),
+            (rotate(query, pose_out), cape_key(query, posemb, True)),
+            (rotate(key, pose_in), cape_key(key, posemb, False)),
+        ]]
+        err = max((output - reference).abs().max().item() for reference, output in pairs)
+        base = timed(per_call, args.steps, args.device)
+        fused = timed(cached, args.steps, args.device)
+
+    print(f"T_in={args.T_in} T_out={args.T_out} {args.cape_type} on {args.device}, one q/k pass per resolution level")
+    print(f"per call tables: {base * 1000:.1f} ms")
+    print(f"cached tables:   {fused * 1000:.1f} ms ({base / fused:.2f}x), max abs diff {err:.2e}")
+    for reference, output in pairs:
+        assert torch.allclose(output, reference, atol=1e-5), "the complex multiply differs from cape + rotate_every_two"
+
+
+def sdpa_backend(args):
+    if not args.sdpa_math:
+        return contextlib.nullcontext()
+    from torch.nn.attention import SDPBackend, sdpa_kernel
+
+    return sdpa_kernel(SDPBackend.MATH)
+
+
+def peak_memory(device):
+    if device.startswith("cuda"):
+        return torch.cuda.max_memory_allocated(device)
+    # peak resident set size of the process, in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def bench_self_attn(args):
+    """
+    Multiview self-attention of the first UNet level: dense, sparse (--view_neighbors) and/or chunked (--chunked).
+    Run once per setting, the peak memory is per process.
+    """
+    from diffusers.models.attention_processor import Attention, CaPEChunkedAttnProcessor, ViewNeighbors
+
+    batch_size = 2 if args.guidance_scale > 1.0 else 1
+    l = (args.resolution // 8) ** 2
+    attn = Attention(320, heads=8, dim_head=40, cape=True).to(args.device).eval()
+    if args.chunked:
+        attn.set_processor(CaPEChunkedAttnProcessor(args.max_memory and args.max_memory * 2 ** 20))
+    hidden_states = torch.randn(batch_size * args.T_out, l, 320, device=args.device)
+    posemb = random_poses(args, batch_size)
+    cross_attention_kwargs = {}
+    if args.view_neighbors is not None:
+        cross_attention_kwargs["view_neighbors"] = ViewNeighbors.from_posemb(posemb, args.view_neighbors,
+                                                                             args.view_anchors)
+
+    def step(_):
+        return attn(hidden_states, posemb=posemb, **cross_attention_kwargs)
+
+    with torch.no_grad(), sdpa_backend(args):
+        if args.device.startswith("cuda"):
+            torch.cuda.reset_peak_memory_stats(args.device)
+        base = peak_memory(args.device)
+        duration = timed(step, args.steps, args.device)
+        peak = peak_memory(args.device)
+
+    mode = "dense" if args.view_neighbors is None else f"k={args.view_neighbors} anchors={args.view_anchors}"
+    if args.chunked:
+        mode += f", chunked ({args.max_memory or 'free'} MiB budget)"
+    print(f"T_out={args.T_out} tokens/view={l} {args.cape_type} on {args.device}, {mode}")
+    print(f"{duration * 1000:.1f} ms/layer, peak memory {peak / 2 ** 20:.0f} MiB (+{(peak - base) / 2 ** 20:.0f} MiB)")
+
+
+def bench_token_budget(args):
+    """Cross-attention of the first UNet level with all reference tokens vs. the reference token budget."""
+    from diffusers.models.attention_processor import Attention, prepare_posemb
+    from reference_tokens import reference_token_budget
+
+    batch_size = 2 if args.guidance_scale > 1.0 else 1
+    l = (args.resolution // 8) ** 2
+    attn = Attention(320, cross_attention_dim=768, heads=8, dim_head=40, cape=True).to(args.device).eval()
+    hidden_states = torch.randn(batch_size * args.T_out, l, 320, device=args.device)
+    posemb = random_poses(args, batch_size)
+    pose_in = posemb[1][0] if args.cape_type == "6DoF" else posemb[1]
+    # white background references with an object covering the centre, 12x12 tokens per reference
+    embeds = torch.randn(batch_size, args.T_in, 144, 768, device=args.device)
+    images = torch.ones(batch_size * args.T_in, 3, 256, 256, device=args.device)
+    yy, xx = torch.meshgrid(torch.linspace(-1, 1, 256), torch.linspace(-1, 1, 256), indexing="ij")
+    images[:, :, (yy ** 2 + xx ** 2 < 0.5).to(args.device)] = 0.5
+
+    with torch.no_grad():
+        start = time.perf_counter()
+        tokens, views, mask = reference_token_budget(embeds, images, pose_in, args.reference_token_budget)
+        stage = time.perf_counter() - start
+        encoder_attention_mask = None if mask is None else (1 - mask.to(tokens.dtype))[:, None] * -10000.0
+        budget_posemb = prepare_posemb(posemb, views)
+
+        full = timed(lambda _: attn(hidden_states, encoder_hidden_states=embeds.flatten(1, 2), posemb=posemb),
+                     args.steps, args.device)
+        reduced = timed(lambda _: attn(hidden_states, encoder_hidden_states=tokens, posemb=budget_posemb,
+                                       attention_mask=encoder_attention_mask), args.steps, args.device)
+
+    print(f"T_in={args.T_in} T_out={args.T_out} {args.cape_type} on {args.device}")
+    print(f"all tokens: {args.T_in * 144} keys, {full * 1000:.1f} ms/layer")
+    print(f"budget:     {tokens.shape[1]} keys, {reduced * 1000:.1f} ms/layer ({full / reduced:.2f}x), "
+          f"one-off budget stage {stage * 1000:.0f} ms")
+
+
+def bench_guidance(args):
+    """Denoising loop time with classifier-free guidance on all steps vs. the guidance schedule."""
+    from pipeline_zero1to3 import Zero1to3StableDiffusionPipeline
+
+    unet = load_unet(args)
+    h = args.resolution // 8
+    latents = torch.randn(args.T_out, 4, h, h, device=args.device)
+    prompt_embeds = torch.randn(2, args.T_in * 144, unet.config.cross_attention_dim, device=args.device)
+    poses = random_poses(args, 2)
+    cond_poses = [[p[1:] for p in pair] for pair in poses] if args.cape_type == "6DoF" else [p[1:] for p in poses]
+
+    def loop(schedule):
+        def run(_):
+            for i in range(args.steps):
+                scale = Zero1to3StableDiffusionPipeline.guidance_scale_at(i, args.steps, args.guidance_scale, *schedule)
+                if scale > 1.0:
+                    unet(torch.cat([latents] * 2), 999 - i, encoder_hidden_states=prompt_embeds, pose=poses)
+                else:
+                    unet(latents, 999 - i, encoder_hidden_states=prompt_embeds[1:], pose=cond_poses)
+        return run
+
+    with torch.no_grad():
+        base = timed(loop((None, None)), 1, args.device)
+        scheduled = timed(loop((args.guidance_interval, args.guidance_decay)), 1, args.device)
+    guided = sum(
+        Zero1to3StableDiffusionPipeline.guidance_scale_at(
+            i, args.steps, args.guidance_scale, args.guidance_interval, args.guidance_decay
+        ) > 1.0 for i in range(args.steps)
+    )
+
+    print(f"T_in={args.T_in} T_out={args.T_out} {args.cape_type} on {args.device}, {args.steps} steps")
+    print(f"guidance on all steps: {base:.2f} s")
+    print(f"guidance on {guided}/{args.steps} steps (interval {args.guidance_interval}, decay {args.guidance_decay}): "
+          f"{scheduled:.2f} s ({1 - scheduled / base:.0%} less)")
+
+
+def bench_null_condition(args):
+    """Per-step UNet time with the full vs. the closed-form null-condition classifier-free guidance branch."""
+    from diffusers.models.attention_processor import prepare_posemb
+
+    unet = load_unet(args)
+    h = args.resolution // 8
+    latents = torch.randn(2 * args.T_out, 4, h, h, device=args.device)
+    prompt_embeds = torch.randn(2, args.T_in * 144, unet.config.cross_attention_dim, device=args.device)
+    prompt_embeds[0] = 0  # null condition of the unconditional half, as in the pipeline
+    poses = prepare_posemb(random_poses(args, 2))
+
+    def run(cross_attention_kwargs):
+        def step(i):
+            return unet(latents, 999 - i, encoder_hidden_states=prompt_embeds, pose=poses,
+                        cross_attention_kwargs=cross_attention_kwargs).sample
+        return step
+
+    with torch.no_grad():
+        base = timed(run(None), args.steps, args.device)
+        null = timed(run({"null_condition": 1}), args.steps, args.device)
+        reference, output = run(None)(0), run({"null_condition": 1})(0)
+        err = (output - reference).abs().max().item()
+
+    print(f"T_in={args.T_in} T_out={args.T_out} {args.cape_type} on {args.device}, classifier-free guidance")
+    print(f"full null branch:        {base * 1000:.1f} ms/step")
+    print(f"closed-form null branch: {null * 1000:.1f} ms/step ({base / null:.2f}x), max abs diff {err:.2e}")
+    assert torch.allclose(output, reference, atol=1e-5), "the closed-form null branch changes the noise prediction"
+
+
+def bench_fused_qkv(args):
+    """Self-attention of the first UNet level with separate vs. fused query/key/value projections."""
+    from diffusers.models.attention_processor import Attention
+
+    batch_size = 2 if args.guidance_scale > 1.0 else 1
+    l = (args.resolution // 8) ** 2
+    attn = Attention(320, heads=8, dim_head=40, cape=True).to(args.device).eval()
+    hidden_states = torch.randn(batch_size * args.T_out, l, 320, device=args.device)
+    posemb = random_poses(args, batch_size)
+
+    def projections(_):
+        if attn.fused_projections:
+            return attn.to_qkv(hidden_states).chunk(3, dim=-1)
+        return attn.to_q(hidden_states), attn.to_k(hidden_states), attn.to_v(hidden_states)
+
+    with torch.no_grad(), sdpa_backend(args):
+        reference = attn(hidden_states, posemb=posemb)
+        base_proj = timed(projections, args.steps, args.device)
+        base = timed(lambda _: attn(hidden_states, posemb=posemb), args.steps, args.device)
+        attn.fuse_projections()
+        fused_proj = timed(projections, args.steps, args.device)
+        fused = timed(lambda _: attn(hidden_states, posemb=posemb), args.steps, args.device)
+        err = (attn(hidden_states, posemb=posemb) - reference).abs().max().item()
+
+    print(f"T_out={args.T_out} tokens/view={l} {args.cape_type} on {args.device}")
+    print(f"q/k/v projections: {base_proj * 1000:.1f} -> {fused_proj * 1000:.1f} ms ({base_proj / fused_proj:.2f}x)")
+    print(f"self-attention:    {base * 1000:.1f} -> {fused * 1000:.1f} ms/layer ({base / fused:.2f}x), "
+          f"max abs diff {err:.2e}")
+
+
+def bench_tome(args):
+    """Per-step UNet time and noise prediction error with token merging in the multiview self-attention."""
+    unet = load_unet(args)
+    batch_size = 2 if args.guidance_scale > 1.0 else 1
+    h = args.resolution // 8
+    latents = torch.randn(batch_size * args.T_out, 4, h, h, device=args.device)
+    prompt_embeds = torch.randn(batch_size, args.T_in * 144, unet.config.cross_attention_dim, device=args.device)
+    poses = random_poses(args, batch_size)
+    ratio = args.tome_ratio[0] if len(args.tome_ratio) == 1 else args.tome_ratio
+
+    def step(i):
+        return unet(latents, 999 - i, encoder_hidden_states=prompt_embeds, pose=poses).sample
+
+    with torch.no_grad(), sdpa_backend(args):
+        unet.set_token_merging(None)
+        base = timed(step, args.steps, args.device)
+        reference = step(0)
+        unet.set_token_merging(ratio)
+        merged = timed(step, args.steps, args.device)
+        err = ((step(0) - reference).norm() / reference.norm()).item()
+
+    print(f"T_in={args.T_in} T_out={args.T_out} {args.cape_type} on {args.device}")
+    print(f"no merging:      {base * 1000:.1f} ms/step")
+    print(f"tome ratio {ratio}: {merged * 1000:.1f} ms/step ({base / merged:.2f}x), relative noise error {err:.3f}")
+
+
+def bench_packed_objects(args):
+    """Per-step UNet time of several objects, one UNet call per object vs. all objects packed into one call."""
+    from diffusers.models.attention_processor import ViewSegments
+
+    def cat_poses(poses):
+        if isinstance(poses[0], torch.Tensor):
+            return torch.cat(poses, dim=1)
+        return [cat_poses(p) for p in zip(*poses)]
+
+    unet = load_unet(args)
+    batch_size = 2 if args.guidance_scale > 1.0 else 1
+    h = args.resolution // 8
+    objects = []
+    for i in range(args.num_objects):
+        t_in, t_out = max(1, args.T_in - i % 2), args.T_out + i % 2
+        latents = torch.randn(batch_size * t_out, 4, h, h, device=args.device)
+        prompt_embeds = torch.randn(batch_size, t_in * 144, unet.config.cross_attention_dim, device=args.device)
+        poses = random_poses(argparse.Namespace(**dict(vars(args), T_in=t_in, T_out=t_out)), batch_size)
+        objects.append((t_in, t_out, latents, prompt_embeds, poses))
+    target_views = [t_out for _, t_out, _, _, _ in objects]
+    segments = ViewSegments(target_views, [t_in for t_in, _, _, _, _ in objects])
+    # the latents are (b t_out) ordered, pack the views of every object within each batch row
+    packed_latents = torch.cat([latents.view(batch_size, -1, 4, h, h) for _, _, latents, _, _ in objects], dim=1)
+    packed_latents = packed_latents.view(-1, 4, h, h)
+    packed_embeds = torch.cat([prompt_embeds for _, _, _, prompt_embeds, _ in objects], dim=1)
+    packed_poses = cat_poses([poses for _, _, _, _, poses in objects])
+
+    def sequential(i):
+        return [unet(latents, 999 - i, encoder_hidden_states=prompt_embeds, pose=poses).sample
+                for _, _, latents, prompt_embeds, poses in objects]
+
+    def packed(i):
+        return unet(packed_latents, 999 - i, encoder_hidden_states=packed_embeds, pose=packed_poses,
+                    cross_attention_kwargs={"view_segments": segments}).sample
+
+    with torch.no_grad(), sdpa_backend(args):
+        base = timed(sequential, args.steps, args.device)
+        batched = timed(packed, args.steps, args.device)
+        reference = torch.cat([x.view(batch_size, -1, 4, h, h) for x in sequential(0)], dim=1).view(-1, 4, h, h)
+        err = (packed(0) - reference).abs().max().item()
+
+    print(f"{args.num_objects} objects, T_out={target_views} {args.cape_type} on {args.device}")
+    print(f"one call per object: {base * 1000:.1f} ms/step")
+    print(f"packed objects:      {batched * 1000:.1f} ms/step ({base / batched:.2f}x), max abs diff {err:.2e}")
+
+
+def bench_schedulers(args):
+    """Denoised latents of each sampler vs. DDIM with 50 steps, and the fewest steps within `--sampler_tolerance`."""
+    import diffusers
+
+    unet = load_unet(args)
+    if args.pretrained_model_name_or_path is not None:
+        config = diffusers.DDIMScheduler.load_config(args.pretrained_model_name_or_path, subfolder="scheduler")
+    else:
+        # the Stable Diffusion noise schedule EscherNet is trained with
+        config = diffusers.DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear",
+                                         clip_sample=False, set_alpha_to_one=False, steps_offset=1).config
+    h = args.resolution // 8
+    noise = torch.randn(args.T_out, 4, h, h, device=args.device)
+    prompt_embeds = torch.randn(2, args.T_in * 144, unet.config.cross_attention_dim, device=args.device)
+    prompt_embeds[0] = 0  # null condition of the unconditional half, as in the pipeline
+    poses = random_poses(args, 2)
+
+    def sample(name, steps):
+        # the denoising loop of the pipeline, with classifier-free guidance on all steps
+        scheduler = getattr(diffusers, name).from_config(config)
+        scheduler.set_timesteps(steps, device=args.device)
+        latents = noise * scheduler.init_noise_sigma
+        for t in scheduler.timesteps:
+            latent_model_input = scheduler.scale_model_input(torch.cat([latents] * 2), t)
+            noise_pred = unet(latent_model_input, t, encoder_hidden_states=prompt_embeds, pose=poses).sample
+            noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+            noise_pred = noise_pred_uncond + args.guidance_scale * (noise_pred_text - noise_pred_uncond)
+            latents = scheduler.step(noise_pred, t, latents, return_dict=False)[0]
+        return latents
+
+    print(f"T_in={args.T_in} T_out={args.T_out} {args.cape_type} on {args.device}, "
+          f"relative latent error to DDIM-50 (tolerance {args.sampler_tolerance})")
+    print(f"{'sampler':<30}" + "".join(f"{steps:>8}" for steps in args.sampler_steps) + "  min steps")
+    with torch.no_grad():
+        reference = sample("DDIMScheduler", 50)
+        for name in args.schedulers:
+            errors = [((sample(name, steps) - reference).norm() / reference.norm()).item()
+                      for steps in args.sampler_steps]
+            matching = [steps for steps, err in zip(args.sampler_steps, errors) if err < args.sampler_tolerance]
+            print(f"{name:<30}" + "".join(f"{err:>8.3f}" for err in errors) +
+                  f"  {matching[0] if matching else '-':>9}")
+
+
+def bench_deep_cache(args):
+    """Denoising loop time and final noise error with the deep UNet features reused across steps (DeepCache)."""
+    from unet_2d_condition import DeepCache
+
+    unet = load_unet(args)
+    h = args.resolution // 8
+    latents = torch.randn(2 * args.T_out, 4, h, h, device=args.device)
+    prompt_embeds = torch.randn(2, args.T_in * 144, unet.config.cross_attention_dim, device=args.device)
+    poses = random_poses(args, 2)
+
+    def loop(interval):
+        def run(_):
+            deep_cache = DeepCache(args.deep_cache_branch) if interval is not None else None
+            for i in range(args.steps):
+                noise_pred = unet(latents, 999 - i * 1000 // args.steps, encoder_hidden_states=prompt_embeds,
+                                  pose=poses, deep_cache=deep_cache, deep_cache_parts=["uncond", "cond"],
+                                  deep_cache_refresh=interval is None or i % interval == 0).sample
+            return noise_pred
+        return run
+
+    with torch.no_grad(), sdpa_backend(args):
+        base = timed(loop(None), 1, args.device)
+        cached = timed(loop(args.deep_cache_interval), 1, args.device)
+        reference = loop(None)(0)
+        err = ((loop(args.deep_cache_interval)(0) - reference).norm() / reference.norm()).item()
+
+    print(f"T_in={args.T_in} T_out={args.T_out} {args.cape_type} on {args.device}, {args.steps} steps")
+    print(f"full UNet on all steps: {base:.2f} s")
+    print(f"deep cache interval {args.deep_cache_interval}, branch {args.deep_cache_branch}: {cached:.2f} s "
+          f"({base / cached:.2f}x), relative error of the last noise prediction {err:.3f}")
+
+
+def bench_parallel(args):
+    """Latency of sequential DDIM vs. parallel-in-time sampling (ParaDiGMS) of the same steps, with the UNet calls."""
+    from diffusers import AutoencoderKL, DDIMParallelScheduler
+    from diffusers.models.attention_processor import prepare_posemb
+    from pipeline_zero1to3 import Zero1to3StableDiffusionPipeline
+
+    unet = load_unet(args)
+    scheduler = DDIMParallelScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear",
+                                      clip_sample=False, set_alpha_to_one=False, steps_offset=1)
+    # only the denoising loop of the pipeline runs, the VAE and the image encoder are not used
+    pipeline = Zero1to3StableDiffusionPipeline(vae=AutoencoderKL(), image_encoder=None, unet=unet, scheduler=scheduler,
+                                               safety_checker=None, feature_extractor=None,
+                                               requires_safety_checker=False)
+    pipeline.set_progress_bar_config(disable=True)
+    calls = []
+    unet.register_forward_hook(lambda *_: calls.append(1))
+
+    h = args.resolution // 8
+    noise = torch.randn(args.T_out, 4, h, h, device=args.device)
+    prompt_embeds = torch.randn(2, args.T_in * 144, unet.config.cross_attention_dim, device=args.device)
+    prompt_embeds[0] = 0  # null condition of the unconditional half, as in the pipeline
+    unet_inputs = (prompt_embeds, prepare_posemb(random_poses(args, 2)), None, None)
+    scheduler.set_timesteps(args.steps, device=args.device)
+
+    def sequential(_):
+        latents = noise
+        for t in scheduler.timesteps:
+            noise_pred = unet(torch.cat([latents] * 2), t, encoder_hidden_states=prompt_embeds,
+                              pose=unet_inputs[1]).sample
+            noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+            noise_pred = noise_pred_uncond + args.guidance_scale * (noise_pred_text - noise_pred_uncond)
+            latents = scheduler.step(noise_pred, t, latents, return_dict=False)[0]
+        return latents
+
+    def parallel(_):
+        with pipeline.progress_bar(total=args.steps) as progress_bar:
+            return pipeline._parallel_sampling(
+                noise, scheduler.timesteps, unet_inputs, True, args.guidance_scale, None, None, args.parallel,
+                args.parallel_tolerance, None, 0.0, progress_bar, None, 1,
+            )
+
+    with torch.no_grad(), sdpa_backend(args):
+        base = timed(sequential, 1, args.device)
+        calls.clear()
+        reference = sequential(0)
+        base_calls = len(calls)
+        window = timed(parallel, 1, args.device)
+        calls.clear()
+        err = ((parallel(0) - reference).norm() / reference.norm()).item()
+        window_calls = len(calls)
+
+    print(f"T_in={args.T_in} T_out={args.T_out} {args.cape_type} on {args.device}, {args.steps} DDIM steps, "
+          f"{torch.get_num_threads()} threads")
+    print(f"sequential: {base:.2f} s, {base_calls} UNet calls")
+    print(f"parallel window {args.parallel}, tolerance {args.parallel_tolerance}: {window:.2f} s ({base / window:.2f}x), "
+          f"{window_calls} UNet calls, relative latent error {err:.4f}")
+
+
+def load_pipeline(args):
+    # the full pipeline, with a small random image encoder and VAE (8x downsampling) next to the small UNet by default
+    from diffusers import AutoencoderKL, DDIMScheduler
+    from transformers import ConvNextV2Config
+    from CN_encoder import CN_encoder
+    from pipeline_zero1to3 import Zero1to3StableDiffusionPipeline
+
+    if args.pretrained_model_name_or_path is not None:
+        image_encoder = CN_encoder.from_pretrained(args.pretrained_model_name_or_path, subfolder="image_encoder")
+        pipeline = Zero1to3StableDiffusionPipeline.from_pretrained(
+            args.pretrained_model_name_or_path, image_encoder=None, safety_checker=None, feature_extractor=None
+        )
+        pipeline.image_encoder = image_encoder
+    else:
+        image_encoder = CN_encoder(ConvNextV2Config(hidden_sizes=[96, 192, 384, 768], depths=[1, 1, 1, 1]))
+        vae = AutoencoderKL(block_out_channels=(32,) * 4, down_block_types=("DownEncoderBlock2D",) * 4,
+                            up_block_types=("UpDecoderBlock2D",) * 4, norm_num_groups=32)
+        scheduler = DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", clip_sample=False,
+                                  set_alpha_to_one=False, steps_offset=1)
+        pipeline = Zero1to3StableDiffusionPipeline(vae=vae, image_encoder=image_encoder, unet=load_unet(args),
+                                                   scheduler=scheduler, safety_checker=None, feature_extractor=None,
+                                                   requires_safety_checker=False)
+    pipeline = pipeline.to(args.device)
+    pipeline.set_progress_bar_config(disable=True)
+    return pipeline
+
+
+def bench_freeze(args):
+    """Pipeline time and average active target views per UNet call with the converged views frozen."""
+    pipeline = load_pipeline(args)
+    active_views = []
+    pipeline.unet.register_forward_pre_hook(
+        lambda _, inputs, kwargs: active_views.append(inputs[0].shape[0] // kwargs["encoder_hidden_states"].shape[0]),
+        with_kwargs=True,
+    )
+
+    images = torch.rand(args.T_in, 3, args.resolution, args.resolution, device=args.device) * 2 - 1
+    poses = random_poses(args, 1)
+    latents = torch.randn(args.T_out, 4, args.resolution // 8, args.resolution // 8, device=args.device)
+
+    def generate(freeze_threshold):
+        def run(_):
+            return pipeline(input_imgs=images, prompt_imgs=images, poses=poses, height=args.resolution,
+                            width=args.resolution, T_in=args.T_in, T_out=args.T_out, num_inference_steps=args.steps,
+                            guidance_scale=args.guidance_scale, latents=latents, freeze_threshold=freeze_threshold,
+                            output_type="latent").images
+        return run
+
+    with torch.no_grad(), sdpa_backend(args):
+        base = timed(generate(None), 1, args.device)
+        frozen = timed(generate(args.freeze_threshold), 1, args.device)
+        reference = generate(None)(0)
+        active_views.clear()
+        err = ((generate(args.freeze_threshold)(0) - reference).norm() / reference.norm()).item()
+
+    print(f"T_in={args.T_in} T_out={args.T_out} {args.cape_type} on {args.device}, {args.steps} DDIM steps")
+    print(f"all views on every step: {base:.2f} s")
+    print(f"freeze threshold {args.freeze_threshold}: {frozen:.2f} s ({base / frozen:.2f}x), "
+          f"{sum(active_views) / max(len(active_views), 1):.2f} active views per UNet call over {len(active_views)} "
+          f"calls, relative latent error {err:.4f}")
+
+
+def bench_samples(args):
+    """Pipeline time of `--num_samples` samples of one object, one call per sample vs. one batched call."""
+    pipeline = load_pipeline(args)
+    images = torch.rand(args.T_in, 3, args.resolution, args.resolution, device=args.device) * 2 - 1
+    poses = random_poses(args, 1)
+    latents = torch.randn(args.num_samples * args.T_out, 4, args.resolution // 8, args.resolution // 8,
+                          device=args.device)
+
+    def generate(samples, latents):
+        return pipeline(input_imgs=images, prompt_imgs=images, poses=poses, height=args.resolution,
+                        width=args.resolution, T_in=args.T_in, T_out=args.T_out, num_inference_steps=args.steps,
+                        guidance_scale=args.guidance_scale, num_images_per_prompt=samples, latents=latents,
+                        cache_reference_kv=True, output_type="latent").images
+
+    def separate(_):
+        return torch.cat([generate(1, x) for x in latents.chunk(args.num_samples)])
+
+    with torch.no_grad(), sdpa_backend(args):
+        base = timed(separate, 1, args.device)
+        batched = timed(lambda _: generate(args.num_samples, latents), 1, args.device)
+        reference = separate(0)
+        err = ((generate(args.num_samples, latents) - reference).norm() / reference.norm()).item()
+
+    print(f"T_in={args.T_in} T_out={args.T_out} {args.cape_type} on {args.device}, {args.steps} DDIM steps, "
+          f"{args.num_samples} samples")
+    print(f"one call per sample: {base:.2f} s")
+    print(f"batched samples:     {batched:.2f} s ({base / batched:.2f}x), relative latent error {err:.2e}")
+
+
+def bench_vae(args):
+    """
+    VAE encoding of the T_in references and decoding of the T_out views, all at once into float32 images or in chunks
+    of --vae_chunk_size into a uint8 buffer. Run once per setting, the peak memory is per process.
+    """
+    import numpy as np
+    from diffusers import AutoencoderKL, DDIMScheduler
+    from pipeline_zero1to3 import Zero1to3StableDiffusionPipeline
+
+    if args.pretrained_model_name_or_path is not None:
+        vae = AutoencoderKL.from_pretrained(args.pretrained_model_name_or_path, subfolder="vae")
+    else:
+        # the Stable Diffusion VAE architecture, randomly initialized
+        vae = AutoencoderKL(block_out_channels=(128, 256, 512, 512), down_block_types=("DownEncoderBlock2D",) * 4,
+                            up_block_types=("UpDecoderBlock2D",) * 4, layers_per_block=2, norm_num_groups=32)
+    # only the VAE of the pipeline runs
+    pipeline = Zero1to3StableDiffusionPipeline(vae=vae.to(args.device).eval(), image_encoder=None, unet=load_unet(args),
+                                               scheduler=DDIMScheduler(clip_sample=False, steps_offset=1),
+                                               safety_checker=None, feature_extractor=None,
+                                               requires_safety_checker=False)
+    images = torch.rand(args.T_in, 3, args.resolution, args.resolution, device=args.device) * 2 - 1
+    latents = torch.randn(args.T_out, 4, args.resolution // 8, args.resolution // 8, device=args.device)
+    dtype = np.float32 if args.vae_chunk_size is None else np.uint8
+
+    with torch.no_grad():
+        if args.device.startswith("cuda"):
+            torch.cuda.reset_peak_memory_stats(args.device)
+        base = peak_memory(args.device)
+        encode = timed(lambda _: pipeline.prepare_img_latents(images, args.T_in, latents.dtype, args.device,
+                                                              chunk_size=args.vae_chunk_size), 1, args.device)
+        decode = timed(lambda _: pipeline.decode_latents(latents, args.vae_chunk_size, dtype), 1, args.device)
+        peak = peak_memory(args.device)
+
+    mode = "all at once, float32" if args.vae_chunk_size is None else f"chunks of {args.vae_chunk_size}, uint8"
+    print(f"T_in={args.T_in} T_out={args.T_out} at {args.resolution}px on {args.device}, {mode}")
+    print(f"encode {args.T_in / encode:.1f} images/s, decode {args.T_out / decode:.1f} images/s, "
+          f"peak memory {peak / 2 ** 20:.0f} MiB (+{(peak - base) / 2 ** 20:.0f} MiB)")
+
+
+def bench_resume(args):
+    """
+    Checkpoint and resume: a run interrupted after half of the --steps stochastic DDIM steps (eta=1) and resumed from
+    its checkpoint, with a new generator of the same seed as a restarted job has, vs. an uninterrupted run.
+    """
+    import os
+    import tempfile
+
+    pipeline = load_pipeline(args)
+    images = torch.rand(args.T_in, 3, args.resolution, args.resolution, device=args.device) * 2 - 1
+    poses = random_poses(args, 1)
+    interrupt = args.steps // 2
+
+    class Interrupted(Exception):
+        pass
+
+    def stop(i, t, latents):
+        # called before the checkpoint of step i + 1, the last checkpoint is the one after `interrupt` steps
+        if i == interrupt:
+            raise Interrupted
+
+    def generate(**kwargs):
+        return pipeline(input_imgs=images, prompt_imgs=images, poses=poses, height=args.resolution,
+                        width=args.resolution, T_in=args.T_in, T_out=args.T_out, num_inference_steps=args.steps,
+                        guidance_scale=args.guidance_scale, eta=1.0, output_type="latent",
+                        generator=torch.Generator(args.device).manual_seed(args.seed), **kwargs).images
+
+    with torch.no_grad(), sdpa_backend(args), tempfile.TemporaryDirectory() as tmp:
+        checkpoint_path = os.path.join(tmp, "checkpoint.pt")
+        start = time.perf_counter()
+        reference = generate()
+        full = time.perf_counter() - start
+        try:
+            generate(checkpoint_path=checkpoint_path, checkpoint_steps=1, callback=stop)
+        except Interrupted:
+            pass
+        start = time.perf_counter()
+        resumed = generate(checkpoint_path=checkpoint_path, checkpoint_steps=1)
+        rest = time.perf_counter() - start
+
+    print(f"T_in={args.T_in} T_out={args.T_out} {args.cape_type} on {args.device}, {args.steps} DDIM steps (eta=1)")
+    print(f"uninterrupted: {full:.2f} s, resumed after {interrupt} steps: {rest:.2f} s, "
+          f"max abs diff {(resumed - reference).abs().max().item():.2e}")
+    assert torch.equal(resumed, reference), "the resumed run differs from the uninterrupted run"
+
+
+def bench_cold_start(args):
+    """
+    Time from loading the pipeline to the end of its first denoising step: as eval_eschernet.py loads it from
+    --pretrained_model_name_or_path (float32 modules cast to float16 on GPU), or from --bundle. Run once per setting
+    in a new process, and a second time to compare with the files in the page cache.
+    """
+    import diffusers
+    from CN_encoder import CN_encoder
+    from pipeline_zero1to3 import Zero1to3StableDiffusionPipeline
+
+    if (args.pretrained_model_name_or_path is None) == (args.bundle is None):
+        raise ValueError("The cold start benchmark needs either `--pretrained_model_name_or_path` or `--bundle`.")
+    start = time.perf_counter()
+    if args.bundle is not None:
+        pipeline = Zero1to3StableDiffusionPipeline.from_bundle(args.bundle, args.device)
+    else:
+        scheduler = diffusers.DDIMScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler")
+        image_encoder = CN_encoder.from_pretrained(args.pretrained_model_name_or_path, subfolder="image_encoder")
+        pipeline = Zero1to3StableDiffusionPipeline.from_pretrained(
+            args.pretrained_model_name_or_path, scheduler=scheduler, image_encoder=None, safety_checker=None,
+            feature_extractor=None, torch_dtype=torch.float16 if args.device.startswith("cuda") else torch.float32,
+        )
+        pipeline.image_encoder = image_encoder
+        pipeline = pipeline.to(args.device)
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    loaded = time.perf_counter() - start
+    pipeline.set_progress_bar_config(disable=True)
+
+    images = torch.rand(args.T_in, 3, args.resolution, args.resolution, device=args.device) * 2 - 1
+    with torch.autocast("cuda", enabled=args.device.startswith("cuda")):
+        # the first denoising step, with the encoding of the references
+        pipeline(input_imgs=images, prompt_imgs=images, poses=random_poses(args, 1), height=args.resolution,
+                 width=args.resolution, T_in=args.T_in, T_out=args.T_out, num_inference_steps=1,
+                 guidance_scale=args.guidance_scale, output_type="latent")
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    first_step = time.perf_counter() - start
+
+    source = args.bundle if args.bundle is not None else args.pretrained_model_name_or_path
+    print(f"{source} on {args.device}: loaded in {loaded:.2f} s, first denoising step after {first_step:.2f} s")
+
+
+BENCHMARKS = {
+    "kv_cache": bench_kv_cache,
+    "cape_6dof": bench_cape_6dof,
+    "cape_4dof": bench_cape_4dof,
+    "self_attn": bench_self_attn,
+    "token_budget": bench_token_budget,
+    "tome": bench_tome,
+    "fused_qkv": bench_fused_qkv,
+    "null_condition": bench_null_condition,
+    "guidance": bench_guidance,
+    "packed_objects": bench_packed_objects,
+    "schedulers": bench_schedulers,
+    "deep_cache": bench_deep_cache,
+    "parallel": bench_parallel,
+    "freeze": bench_freeze,
+    "samples": bench_samples,
+    "vae": bench_vae,
+    "resume": bench_resume,
+    "cold_start": bench_cold_start,
+}
+
+
+def main(args):
+    # use the customized diffusers modules
+    sys.path.insert(0, f"./{args.cape_type}/")
+    torch.manual_seed(args.seed)
+    BENCHMARKS[args.bench](args)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
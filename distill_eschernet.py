@@ -0,0 +1,567 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Copyright 2023 The HuggingFace Inc. team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+
+# Latent consistency distillation (https://arxiv.org/abs/2310.04378) of a few-step EscherNet student from the
+# multiview CaPE UNet: the student learns to map any point of the teacher's (classifier-free guided) DDIM trajectories
+# to the same x_0, and samples in 2-4 steps with the `LCMScheduler`. The student keeps the UNet and the CaPE pose
+# interface of the teacher, 4DoF or 6DoF.
+#
+#   accelerate launch distill_eschernet.py --cape_type 6DoF --pretrained_model_name_or_path kxic/eschernet-6dof \
+#       --train_data_dir /data/objaverse/views_release --output_dir logs_lcm_6dof --mixed_precision bf16
+#
+# A tiny randomly initialized teacher on random views runs end-to-end on CPU:
+#
+#   python distill_eschernet.py --cape_type 6DoF --tiny --output_dir logs_lcm_tiny --max_train_steps 4
+
+import argparse
+import copy
+import logging
+import math
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import einops
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.utils.checkpoint
+import transformers
+from accelerate import Accelerator
+from accelerate.logging import get_logger
+from accelerate.utils import ProjectConfiguration, set_seed
+from PIL import Image
+from torchvision import transforms
+from tqdm.auto import tqdm
+from transformers import ConvNextV2Config
+
+logger = get_logger(__name__)
+
+
+class RandomViews(torch.utils.data.Dataset):
+    """Random reference/target views and camera poses in the layout of `ObjaverseData`, for `--tiny` runs."""
+
+    def __init__(self, cape_type, num_objects, T_in, T_out, resolution):
+        self.cape_type = cape_type
+        self.num_objects = num_objects
+        self.T_in = T_in
+        self.T_out = T_out
+        self.resolution = resolution
+
+    def __len__(self):
+        return self.num_objects
+
+    def spherical(self, generator, t):
+        # [theta, azimuth, radius, 0]
+        pose = (torch.rand(t, 4, generator=generator) * 2 - 1) * torch.pi
+        pose[:, 3] = 0
+        return pose
+
+    def rigid(self, generator, t):
+        rot, _ = torch.linalg.qr(torch.randn(t, 3, 3, generator=generator))
+        pose = torch.eye(4).repeat(t, 1, 1)
+        pose[:, :3, :3] = rot
+        pose[:, :3, 3] = torch.randn(t, 3, generator=generator)
+        return pose
+
+    def __getitem__(self, index):
+        generator = torch.Generator().manual_seed(index)
+        data = {}
+        data["image_input"] = torch.rand(self.T_in, 3, self.resolution, self.resolution, generator=generator) * 2 - 1
+        data["image_target"] = torch.rand(self.T_out, 3, self.resolution, self.resolution, generator=generator) * 2 - 1
+        if self.cape_type == "4DoF":
+            data["pose_out"] = self.spherical(generator, self.T_out)
+            data["pose_in"] = self.spherical(generator, self.T_in)
+        else:
+            data["pose_out"] = self.rigid(generator, self.T_out)
+            data["pose_out_inv"] = torch.linalg.inv(data["pose_out"]).transpose(1, 2)
+            data["pose_in"] = self.rigid(generator, self.T_in)
+            data["pose_in_inv"] = torch.linalg.inv(data["pose_in"]).transpose(1, 2)
+        return data
+
+
+def get_poses(batch, dtype, cape_type):
+    # CaPE poses of the batch, pose_out - self-attn, pose_in - cross-attn
+    if cape_type == "4DoF":
+        pose_in = batch["pose_in"].to(dtype=dtype)  # BxTx4
+        pose_out = batch["pose_out"].to(dtype=dtype)  # BxTx4
+        return [pose_out, pose_in]
+    pose_in = batch["pose_in"].to(dtype=dtype)  # BxTx4x4
+    pose_out = batch["pose_out"].to(dtype=dtype)  # BxTx4x4
+    pose_in_inv = batch["pose_in_inv"].to(dtype=dtype)  # BxTx4x4
+    pose_out_inv = batch["pose_out_inv"].to(dtype=dtype)  # BxTx4x4
+    return [[pose_out, pose_out_inv], [pose_in, pose_in_inv]]
+
+
+def guidance_poses(poses):
+    # poses of the [unconditional, conditional] classifier-free guidance batch
+    if isinstance(poses, torch.Tensor):
+        return torch.cat([poses] * 2)
+    return [guidance_poses(p) for p in poses]
+
+
+def ddim_solver_timesteps(num_train_timesteps, num_ddim_timesteps):
+    # the increasing timesteps of the teacher's DDIM solver, the distillation timesteps of the LCMScheduler
+    step_ratio = num_train_timesteps // num_ddim_timesteps
+    return torch.from_numpy(np.arange(1, num_ddim_timesteps + 1) * step_ratio - 1).long()
+
+
+def scalings_for_boundary_conditions(timestep, sigma_data=0.5, timestep_scaling=10.0):
+    # the consistency boundary condition c_skip * x_t + c_out * x_0, as `LCMScheduler` applies it in sampling
+    scaled_timestep = timestep_scaling * timestep
+    c_skip = sigma_data**2 / (scaled_timestep**2 + sigma_data**2)
+    c_out = scaled_timestep / (scaled_timestep**2 + sigma_data**2) ** 0.5
+    return c_skip, c_out
+
+
+def tiny_models(args):
+    # a small randomly initialized teacher with the EscherNet layout, latents at 1/2 of the resolution
+    from diffusers import AutoencoderKL, DDPMScheduler
+    from CN_encoder import CN_encoder
+    from unet_2d_condition import UNet2DConditionModel
+
+    noise_scheduler = DDPMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear",
+                                    clip_sample=False)
+    image_encoder = CN_encoder(ConvNextV2Config(hidden_sizes=[16, 32, 64, 96], depths=[1, 1, 1, 1]))
+    vae = AutoencoderKL(block_out_channels=(32, 32), down_block_types=("DownEncoderBlock2D",) * 2,
+                        up_block_types=("UpDecoderBlock2D",) * 2, latent_channels=4, norm_num_groups=32)
+    unet = UNet2DConditionModel(sample_size=args.resolution // 2, block_out_channels=(32, 64, 64, 64),
+                                layers_per_block=1, cross_attention_dim=96, attention_head_dim=8, norm_num_groups=32)
+    return noise_scheduler, image_encoder, vae, unet
+
+
+def parse_args(input_args=None):
+    parser = argparse.ArgumentParser(description="Latent consistency distillation of a few-step EscherNet.")
+    parser.add_argument("--cape_type", type=str, default="6DoF", choices=["4DoF", "6DoF"])
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        default=None,
+        help="Path to the EscherNet teacher or its model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--tiny",
+        action="store_true",
+        help="Distill a tiny randomly initialized teacher on random views, to test the script end-to-end on CPU.",
+    )
+    parser.add_argument(
+        "--train_data_dir",
+        type=str,
+        default=None,
+        help="A folder containing the Objaverse renderings, as for train_eschernet.py.",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default="logs_lcm",
+        help="The output directory where the student pipeline and the checkpoints will be written.",
+    )
+    parser.add_argument("--seed", type=int, default=42, help="A seed for reproducible training.")
+    parser.add_argument("--resolution", type=int, default=256, help="The resolution of the input and target views.")
+    parser.add_argument("--train_batch_size", type=int, default=4, help="Batch size (per device).")
+    parser.add_argument("--T_in", type=int, default=3, help="Number of input views.")
+    parser.add_argument("--T_out", type=int, default=3, help="Number of output views.")
+    parser.add_argument("--max_train_steps", type=int, default=10000, help="Total number of training steps.")
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=1)
+    parser.add_argument("--gradient_checkpointing", action="store_true")
+    parser.add_argument("--learning_rate", type=float, default=1e-6, help="Learning rate of the student.")
+    parser.add_argument("--lr_scheduler", type=str, default="constant_with_warmup")
+    parser.add_argument("--lr_warmup_steps", type=int, default=500)
+    parser.add_argument("--adam_beta1", type=float, default=0.9, help="The beta1 parameter for the Adam optimizer.")
+    parser.add_argument("--adam_beta2", type=float, default=0.999, help="The beta2 parameter for the Adam optimizer.")
+    parser.add_argument("--adam_weight_decay", type=float, default=1e-2, help="Weight decay to use.")
+    parser.add_argument("--adam_epsilon", type=float, default=1e-08, help="Epsilon value for the Adam optimizer")
+    parser.add_argument("--max_grad_norm", default=1.0, type=float, help="Max gradient norm.")
+    parser.add_argument(
+        "--num_ddim_timesteps",
+        type=int,
+        default=50,
+        help="Number of steps of the teacher's DDIM solver, the student skips between its consecutive timesteps.",
+    )
+    parser.add_argument(
+        "--guidance_scale",
+        type=float,
+        default=3.0,
+        help="Classifier-free guidance scale of the teacher, distilled into the student (sampled without guidance).",
+    )
+    parser.add_argument(
+        "--ema_decay",
+        type=float,
+        default=0.95,
+        help="EMA decay of the target network the student's consistency targets are computed with.",
+    )
+    parser.add_argument(
+        "--loss_type", type=str, default="huber", choices=["l2", "huber"], help="Consistency loss."
+    )
+    parser.add_argument("--huber_c", type=float, default=0.001, help="The huber loss parameter.")
+    parser.add_argument(
+        "--timestep_scaling_factor",
+        type=float,
+        default=10.0,
+        help="Timestep scaling of the boundary condition, saved to the LCMScheduler of the student.",
+    )
+    parser.add_argument(
+        "--num_inference_steps",
+        type=int,
+        default=4,
+        help="Number of sampling steps of the student sample written with the final pipeline.",
+    )
+    parser.add_argument("--checkpointing_steps", type=int, default=1000)
+    parser.add_argument(
+        "--checkpoints_total_limit", type=int, default=2, help="Max number of checkpoints to store."
+    )
+    parser.add_argument("--dataloader_num_workers", type=int, default=4)
+    parser.add_argument(
+        "--mixed_precision",
+        type=str,
+        default=None,
+        choices=["no", "fp16", "bf16"],
+        help="Precision of the frozen teacher, VAE and image encoder; the student is trained in float32.",
+    )
+    parser.add_argument(
+        "--allow_tf32",
+        action="store_true",
+        help="Whether or not to allow TF32 on Ampere GPUs. Can be used to speed up training.",
+    )
+    parser.add_argument(
+        "--report_to",
+        type=str,
+        default=None,
+        help='The integration to report the results and logs to, e.g. "wandb" or "tensorboard".',
+    )
+    parser.add_argument("--logging_dir", type=str, default="logs")
+    parser.add_argument("--tracker_project_name", type=str, default="eschernet_lcm")
+
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+
+    if not args.tiny and (args.pretrained_model_name_or_path is None or args.train_data_dir is None):
+        raise ValueError("Specify `--pretrained_model_name_or_path` and `--train_data_dir`, or `--tiny`.")
+    if args.resolution % 8 != 0:
+        raise ValueError("`--resolution` must be divisible by 8 for consistently sized encoded images.")
+    return args
+
+
+ConvNextV2_preprocess = transforms.Compose([
+    transforms.Resize((224, 224), interpolation=transforms.InterpolationMode.BICUBIC),
+    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+])
+
+
+def _encode_image(image_encoder, image, T_in):
+    # [-1, 1] -> [0, 1]
+    image = (image + 1.) / 2.
+    image = ConvNextV2_preprocess(image)
+    image_embeddings = image_encoder(image)  # bt, l, c
+    return einops.rearrange(image_embeddings, '(b t) l c -> b (t l) c', t=T_in)
+
+
+def predicted_origin(noise_pred, timesteps, sample, alphas_cumprod):
+    # x_0 of the epsilon prediction
+    alphas = alphas_cumprod[timesteps].view(-1, 1, 1, 1)
+    return (sample - (1 - alphas).sqrt() * noise_pred) / alphas.sqrt()
+
+
+@torch.no_grad()
+def update_ema(target_params, source_params, rate):
+    for target, source in zip(target_params, source_params):
+        target.detach().mul_(rate).add_(source, alpha=1 - rate)
+
+
+@torch.no_grad()
+def save_student(accelerator, args, unet, vae, image_encoder, noise_scheduler, batch, global_step):
+    # the student pipeline with the LCM sampler, and a few-step sample of `batch` next to its ground truth
+    from diffusers import LCMScheduler
+    from pipeline_zero1to3 import Zero1to3StableDiffusionPipeline
+
+    scheduler = LCMScheduler.from_config(
+        noise_scheduler.config,
+        original_inference_steps=args.num_ddim_timesteps,
+        timestep_scaling=args.timestep_scaling_factor,
+    )
+    pipeline = Zero1to3StableDiffusionPipeline(
+        vae=vae,
+        image_encoder=image_encoder,
+        unet=accelerator.unwrap_model(unet),
+        scheduler=scheduler,
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+    pipeline.set_progress_bar_config(disable=True)
+    pipeline_save_path = os.path.join(args.output_dir, f"pipeline-{global_step}")
+    pipeline.save_pretrained(pipeline_save_path)
+
+    input_image = batch["image_input"][:1].to(accelerator.device)
+    input_image = einops.rearrange(input_image, 'b t c h w -> (b t) c h w')
+    poses = get_poses({k: v[:1].to(accelerator.device) for k, v in batch.items()}, torch.float32, args.cape_type)
+    image = pipeline(input_imgs=input_image, prompt_imgs=input_image, poses=poses, height=args.resolution,
+                     width=args.resolution, T_in=args.T_in, T_out=args.T_out, guidance_scale=1.0,
+                     num_inference_steps=args.num_inference_steps,
+                     generator=torch.Generator(device=accelerator.device).manual_seed(args.seed),
+                     output_type="numpy").images
+    gt_image = (batch["image_target"][0].permute(0, 2, 3, 1).float().numpy() + 1) / 2
+    grid = np.concatenate([np.concatenate(list(gt_image), axis=1), np.concatenate(list(image), axis=1)], axis=0)
+    Image.fromarray((grid.clip(0, 1) * 255).astype(np.uint8)).save(
+        os.path.join(pipeline_save_path, f"sample_{args.num_inference_steps}steps.png")
+    )
+    logger.info(f"Saved the student pipeline to {pipeline_save_path}")
+
+
+def main(args):
+    # use the customized diffusers modules
+    sys.path.insert(0, f"./{args.cape_type}/")
+    import diffusers
+    from diffusers import AutoencoderKL, DDPMScheduler
+    from diffusers.optimization import get_scheduler
+    from CN_encoder import CN_encoder
+    from unet_2d_condition import UNet2DConditionModel
+
+    logging_dir = Path(args.output_dir, args.logging_dir)
+    accelerator_project_config = ProjectConfiguration(project_dir=args.output_dir, logging_dir=logging_dir)
+    accelerator = Accelerator(
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        mixed_precision=args.mixed_precision,
+        log_with=args.report_to,
+        project_config=accelerator_project_config,
+    )
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    logger.info(accelerator.state, main_process_only=False)
+    if accelerator.is_local_main_process:
+        transformers.utils.logging.set_verbosity_warning()
+        diffusers.utils.logging.set_verbosity_info()
+    else:
+        transformers.utils.logging.set_verbosity_error()
+        diffusers.utils.logging.set_verbosity_error()
+
+    if args.seed is not None:
+        set_seed(args.seed)
+    if accelerator.is_main_process:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    # Load the teacher, the student and its EMA target start from the teacher
+    if args.tiny:
+        noise_scheduler, image_encoder, vae, teacher_unet = tiny_models(args)
+    else:
+        noise_scheduler = DDPMScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler")
+        image_encoder = CN_encoder.from_pretrained(args.pretrained_model_name_or_path, subfolder="image_encoder")
+        vae = AutoencoderKL.from_pretrained(args.pretrained_model_name_or_path, subfolder="vae")
+        teacher_unet = UNet2DConditionModel.from_pretrained(args.pretrained_model_name_or_path, subfolder="unet")
+    if noise_scheduler.config.prediction_type != "epsilon":
+        raise ValueError(f"Only epsilon prediction teachers are supported, got {noise_scheduler.config.prediction_type}")
+
+    unet = copy.deepcopy(teacher_unet)
+    target_unet = copy.deepcopy(teacher_unet)
+    for model in (vae, image_encoder, teacher_unet, target_unet):
+        model.requires_grad_(False)
+        model.eval()
+    unet.requires_grad_(True)
+    unet.train()
+    if args.gradient_checkpointing:
+        unet.enable_gradient_checkpointing()
+    if args.allow_tf32:
+        torch.backends.cuda.matmul.allow_tf32 = True
+
+    T_in = args.T_in
+    T_out = args.T_out
+
+    optimizer = torch.optim.AdamW(
+        unet.parameters(),
+        lr=args.learning_rate,
+        betas=(args.adam_beta1, args.adam_beta2),
+        weight_decay=args.adam_weight_decay,
+        eps=args.adam_epsilon,
+    )
+    lr_scheduler = get_scheduler(
+        args.lr_scheduler,
+        optimizer=optimizer,
+        num_warmup_steps=args.lr_warmup_steps * accelerator.num_processes,
+        num_training_steps=args.max_train_steps * accelerator.num_processes,
+    )
+
+    # Init Dataset
+    if args.tiny:
+        train_dataset = RandomViews(args.cape_type, 8, T_in, T_out, args.resolution)
+    else:
+        from dataset import ObjaverseData
+
+        image_transforms = transforms.Compose(
+            [
+                transforms.Resize((args.resolution, args.resolution)),
+                transforms.ToTensor(),
+                transforms.Normalize([0.5], [0.5])
+            ]
+        )
+        train_dataset = ObjaverseData(root_dir=args.train_data_dir, image_transforms=image_transforms,
+                                      validation=False, T_in=T_in, T_out=T_out)
+    train_dataloader = torch.utils.data.DataLoader(
+        train_dataset,
+        shuffle=True,
+        batch_size=args.train_batch_size,
+        num_workers=0 if args.tiny else args.dataloader_num_workers,
+    )
+    sample_batch = next(iter(torch.utils.data.DataLoader(train_dataset, batch_size=1)))
+
+    unet, optimizer, lr_scheduler, train_dataloader = accelerator.prepare(
+        unet, optimizer, lr_scheduler, train_dataloader
+    )
+
+    # the frozen teacher, VAE and image encoder run in the mixed precision, the student and its target in float32
+    weight_dtype = torch.float32
+    if accelerator.mixed_precision == "fp16":
+        weight_dtype = torch.float16
+    elif accelerator.mixed_precision == "bf16":
+        weight_dtype = torch.bfloat16
+    vae.to(accelerator.device, dtype=weight_dtype)
+    image_encoder.to(accelerator.device, dtype=weight_dtype)
+    teacher_unet.to(accelerator.device, dtype=weight_dtype)
+    target_unet.to(accelerator.device)
+
+    # the DDIM solver of the teacher
+    alphas_cumprod = noise_scheduler.alphas_cumprod.to(accelerator.device)
+    ddim_timesteps = ddim_solver_timesteps(noise_scheduler.config.num_train_timesteps, args.num_ddim_timesteps)
+    ddim_timesteps = ddim_timesteps.to(accelerator.device)
+    step_ratio = noise_scheduler.config.num_train_timesteps // args.num_ddim_timesteps
+
+    if accelerator.is_main_process and args.report_to is not None:
+        accelerator.init_trackers(args.tracker_project_name, config=dict(vars(args)))
+
+    total_batch_size = args.train_batch_size * accelerator.num_processes * args.gradient_accumulation_steps
+    logger.info("***** Running consistency distillation *****")
+    logger.info(f"  Num examples = {len(train_dataset)}")
+    logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
+    logger.info(f"  Total optimization steps = {args.max_train_steps}")
+    logger.info(f"  Teacher DDIM steps = {args.num_ddim_timesteps}, guidance scale = {args.guidance_scale}")
+
+    global_step = 0
+    num_train_epochs = math.ceil(args.max_train_steps * args.gradient_accumulation_steps / len(train_dataloader))
+    progress_bar = tqdm(range(args.max_train_steps), desc="Steps", disable=not accelerator.is_local_main_process)
+
+    for epoch in range(num_train_epochs):
+        for step, batch in enumerate(train_dataloader):
+            with accelerator.accumulate(unet):
+                gt_image = einops.rearrange(batch["image_target"].to(dtype=weight_dtype), 'b t c h w -> (b t) c h w')
+                input_image = einops.rearrange(batch["image_input"].to(dtype=weight_dtype), 'b t c h w -> (b t) c h w')
+                poses = get_poses(batch, torch.float32, args.cape_type)
+
+                with torch.no_grad():
+                    latents = vae.encode(gt_image).latent_dist.sample() * vae.config.scaling_factor
+                    prompt_embeds = _encode_image(image_encoder, input_image, T_in)
+                latents = latents.float()
+
+                # a random timestep of the DDIM solver per object, and the solver step from it
+                bsz = latents.shape[0] // T_out
+                index = torch.randint(0, args.num_ddim_timesteps, (bsz,), device=latents.device)
+                start_timesteps = einops.repeat(ddim_timesteps[index], 'b -> (b t)', t=T_out)
+                timesteps = (start_timesteps - step_ratio).clamp(min=0)
+                scaling = args.timestep_scaling_factor
+                c_skip_start, c_out_start = [c.view(-1, 1, 1, 1) for c in scalings_for_boundary_conditions(
+                    start_timesteps, timestep_scaling=scaling)]
+                c_skip, c_out = [c.view(-1, 1, 1, 1) for c in scalings_for_boundary_conditions(
+                    timesteps, timestep_scaling=scaling)]
+
+                noise = torch.randn_like(latents)
+                noisy_latents = noise_scheduler.add_noise(latents, noise, start_timesteps)
+
+                # the student's consistency function at the start of the solver step
+                noise_pred = unet(
+                    noisy_latents,
+                    start_timesteps,
+                    encoder_hidden_states=prompt_embeds.float(),
+                    pose=poses,
+                ).sample
+                pred_x0 = predicted_origin(noise_pred, start_timesteps, noisy_latents, alphas_cumprod)
+                model_pred = c_skip_start * noisy_latents + c_out_start * pred_x0
+
+                with torch.no_grad():
+                    # one guided DDIM step of the teacher
+                    teacher_pred = teacher_unet(
+                        torch.cat([noisy_latents] * 2).to(weight_dtype),
+                        torch.cat([start_timesteps] * 2),
+                        encoder_hidden_states=torch.cat([torch.zeros_like(prompt_embeds), prompt_embeds]),
+                        pose=guidance_poses(get_poses(batch, weight_dtype, args.cape_type)),
+                    ).sample.float()
+                    noise_pred_uncond, noise_pred_cond = teacher_pred.chunk(2)
+                    teacher_pred = noise_pred_uncond + args.guidance_scale * (noise_pred_cond - noise_pred_uncond)
+                    teacher_x0 = predicted_origin(teacher_pred, start_timesteps, noisy_latents, alphas_cumprod)
+                    alphas_prev = alphas_cumprod[timesteps].view(-1, 1, 1, 1)
+                    solver_latents = alphas_prev.sqrt() * teacher_x0 + (1 - alphas_prev).sqrt() * teacher_pred
+
+                    # the target network's consistency function at the end of the solver step
+                    target_pred = target_unet(
+                        solver_latents,
+                        timesteps,
+                        encoder_hidden_states=prompt_embeds.float(),
+                        pose=poses,
+                    ).sample
+                    target_x0 = predicted_origin(target_pred, timesteps, solver_latents, alphas_cumprod)
+                    target = c_skip * solver_latents + c_out * target_x0
+
+                if args.loss_type == "l2":
+                    loss = F.mse_loss(model_pred, target)
+                else:
+                    loss = torch.mean(torch.sqrt((model_pred - target) ** 2 + args.huber_c**2) - args.huber_c)
+
+                accelerator.backward(loss)
+                if accelerator.sync_gradients:
+                    accelerator.clip_grad_norm_(unet.parameters(), args.max_grad_norm)
+                optimizer.step()
+                lr_scheduler.step()
+                optimizer.zero_grad(set_to_none=True)
+
+            if accelerator.sync_gradients:
+                update_ema(target_unet.parameters(), unet.parameters(), args.ema_decay)
+                progress_bar.update(1)
+                global_step += 1
+
+                if accelerator.is_main_process and global_step % args.checkpointing_steps == 0:
+                    # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
+                    if args.checkpoints_total_limit is not None:
+                        checkpoints = [d for d in os.listdir(args.output_dir) if d.startswith("checkpoint")]
+                        checkpoints = sorted(checkpoints, key=lambda x: int(x.split("-")[1]))
+                        num_to_remove = max(0, len(checkpoints) - args.checkpoints_total_limit + 1)
+                        for removing_checkpoint in checkpoints[:num_to_remove]:
+                            shutil.rmtree(os.path.join(args.output_dir, removing_checkpoint))
+                    save_path = os.path.join(args.output_dir, f"checkpoint-{global_step}")
+                    accelerator.save_state(save_path)
+                    logger.info(f"Saved state to {save_path}")
+
+            logs = {"loss": loss.detach().item(), "lr": lr_scheduler.get_last_lr()[0]}
+            progress_bar.set_postfix(**logs)
+            accelerator.log(logs, step=global_step)
+
+            if global_step >= args.max_train_steps:
+                break
+
+    # Create the student pipeline using the trained UNet and save it.
+    accelerator.wait_for_everyone()
+    if accelerator.is_main_process:
+        save_student(accelerator, args, unet, vae.float(), image_encoder.float(), noise_scheduler, sample_batch,
+                     global_step)
+
+    accelerator.end_training()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
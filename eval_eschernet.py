@@ -14,7 +14,10 @@
 # See the License for the specific language governing permissions and
 
 import argparse
+import math
 import os
+import time
+import zlib
 import einops
 import numpy as np
 import torch
@@ -32,15 +35,40 @@ import matplotlib.pyplot as plt
 # read .exr files for RTMV dataset
 os.environ["OPENCV_IO_ENABLE_OPENEXR"] = "1"
 
+# samplers of the vendored diffusers that can replace DDIM, built from the DDIM scheduler config with `from_config`
+SCHEDULERS = [
+    "DDIMScheduler",
+    "PNDMScheduler",
+    "LMSDiscreteScheduler",
+    "EulerDiscreteScheduler",
+    "EulerAncestralDiscreteScheduler",
+    "HeunDiscreteScheduler",
+    "KDPM2DiscreteScheduler",
+    "KDPM2AncestralDiscreteScheduler",
+    "DPMSolverMultistepScheduler",
+    "DPMSolverSinglestepScheduler",
+    "DEISMultistepScheduler",
+    "UniPCMultistepScheduler",
+    "DDIMParallelScheduler",
+    "DDPMParallelScheduler",
+    "LCMScheduler",
+]
+
 
 def parse_args(input_args=None):
     parser = argparse.ArgumentParser(description="Simple example of a Zero123 training script.")
     parser.add_argument(
         "--pretrained_model_name_or_path",
         type=str,
-        default="lambdalabs/sd-image-variations-diffusers",
-        required=True,
-        help="Path to pretrained model or model identifier from huggingface.co/models.",
+        default=None,
+        help="Path to pretrained model or model identifier from huggingface.co/models. Required without --bundle.",
+    )
+    parser.add_argument(
+        "--bundle",
+        type=str,
+        default=None,
+        help="Load the pipeline from a safetensors bundle of export_bundle.py, in the dtype it was exported in,"
+        " instead of from --pretrained_model_name_or_path.",
     )
     parser.add_argument(
         "--revision",
@@ -121,6 +149,163 @@ def parse_args(input_args=None):
     parser.add_argument(
         "--enable_xformers_memory_efficient_attention", default=True, help="Whether or not to use xformers."
     )
+    parser.add_argument(
+        "--cache_reference_kv",
+        action="store_true",
+        help="Whether or not to cache the cross-attention keys/values of the reference views across denoising steps.",
+    )
+    parser.add_argument(
+        "--view_neighbors",
+        type=int,
+        default=None,
+        help="If set, each target view only attends to its nearest target views in the multiview self-attention.",
+    )
+    parser.add_argument(
+        "--view_anchors",
+        type=int,
+        default=0,
+        help="Number of global anchor views every target view also attends to, used with --view_neighbors.",
+    )
+    parser.add_argument(
+        "--chunked_attention",
+        action="store_true",
+        help="Whether or not to use memory-bounded chunked attention (e.g. for many target views on CPU).",
+    )
+    parser.add_argument(
+        "--attention_max_memory",
+        type=float,
+        default=None,
+        help="Memory budget in GiB of the chunked attention, defaults to half of the free memory.",
+    )
+    parser.add_argument(
+        "--reference_token_budget",
+        type=int,
+        default=None,
+        help="If set, prune background and merge near-duplicate reference tokens down to this many tokens.",
+    )
+    parser.add_argument(
+        "--null_condition_attention",
+        action="store_true",
+        help="Whether or not to skip the cross-attention of the unconditional classifier-free guidance branch.",
+    )
+    parser.add_argument(
+        "--guidance_interval",
+        type=float,
+        nargs=2,
+        default=None,
+        metavar=("START", "END"),
+        help="Only apply classifier-free guidance on this interval of the denoising steps, as fractions in [0, 1].",
+    )
+    parser.add_argument(
+        "--guidance_decay",
+        type=str,
+        default=None,
+        choices=["linear", "cosine"],
+        help="Decay the guidance scale to 1 over the denoising steps.",
+    )
+    parser.add_argument(
+        "--guidance_stop_threshold",
+        type=float,
+        default=None,
+        help="Stop classifier-free guidance once the relative cond/uncond noise difference falls below this value.",
+    )
+    parser.add_argument(
+        "--fuse_qkv_projections",
+        action="store_true",
+        help="Whether or not to fuse the query, key and value projections of the UNet self-attention.",
+    )
+    parser.add_argument(
+        "--tome_ratio",
+        type=float,
+        nargs="+",
+        default=None,
+        help=(
+            "If set, merge this fraction of the tokens of every target view in the multiview self-attention (ToMe)."
+            " One value for all resolution levels, or one value per level from the highest resolution to the lowest."
+        ),
+    )
+    parser.add_argument(
+        "--scheduler",
+        type=str,
+        default="DDIMScheduler",
+        choices=SCHEDULERS,
+        help="Sampler used for the denoising, created from the DDIM scheduler config of the checkpoint.",
+    )
+    parser.add_argument("--steps", type=int, default=50, help="Number of denoising steps.")
+    parser.add_argument(
+        "--deep_cache_interval",
+        type=int,
+        default=None,
+        help="If set, run the full UNet every N steps and reuse its deep features in between (DeepCache).",
+    )
+    parser.add_argument(
+        "--deep_cache_branch",
+        type=int,
+        default=1,
+        help="Number of shallow resolution levels recomputed on the cheap DeepCache steps.",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=None,
+        help="If set, denoise windows of N steps in parallel by Picard iterations (ParaDiGMS), needs a parallel"
+        " --scheduler.",
+    )
+    parser.add_argument(
+        "--parallel_tolerance",
+        type=float,
+        default=0.1,
+        help="Error tolerance of the parallel sampling, relative to the noise level of every step.",
+    )
+    parser.add_argument(
+        "--warm_start_angle",
+        type=float,
+        default=None,
+        help="If set, target views closer than this angle (in degrees) to a reference view start from its latent.",
+    )
+    parser.add_argument(
+        "--warm_start_strength",
+        type=float,
+        default=0.5,
+        help="Fraction of the denoising steps run for a target view at the pose of its reference.",
+    )
+    parser.add_argument(
+        "--warm_start_inversion",
+        action="store_true",
+        help="Start the warm-started views from the DDIM inversion of the reference instead of the noised latent.",
+    )
+    parser.add_argument(
+        "--freeze_threshold",
+        type=float,
+        default=None,
+        help="If set, drop a target view from the UNet batch once the relative update of its latent falls below"
+        " this threshold.",
+    )
+    parser.add_argument(
+        "--vae_chunk_size",
+        type=int,
+        default=8,
+        help="Number of views decoded per VAE call into the uint8 output, bounds the decoding memory for large T_out.",
+    )
+    parser.add_argument(
+        "--checkpoint_steps",
+        type=int,
+        default=None,
+        help="If set, save the denoising state of every object every this many steps and resume from it when the"
+        " evaluation is restarted, e.g. after the job was killed at its time limit.",
+    )
+    parser.add_argument(
+        "--per_view_noise",
+        action="store_true",
+        help="Draw the noise of every target view from its own generator seeded from (--seed, object name, view index),"
+        " so the results do not depend on the order, batching or sharding of the objects.",
+    )
+    parser.add_argument(
+        "--objects_per_batch",
+        type=int,
+        default=1,
+        help="Number of objects packed into one pipeline batch, their views only attend to the same object.",
+    )
 
 
 
@@ -132,6 +317,20 @@ def parse_args(input_args=None):
         raise ValueError(
             "`--resolution` must be divisible by 8 for consistently sized encoded images."
         )
+    if args.pretrained_model_name_or_path is None and args.bundle is None:
+        raise ValueError("Pass either `--pretrained_model_name_or_path` or `--bundle`.")
+    if args.objects_per_batch > 1 and (args.view_neighbors is not None or args.reference_token_budget is not None
+                                       or args.warm_start_angle is not None or args.freeze_threshold is not None):
+        raise ValueError("`--objects_per_batch` can not be combined with `--view_neighbors`, `--reference_token_budget`,"
+                         " `--warm_start_angle` or `--freeze_threshold`.")
+    if args.parallel is not None and "Parallel" not in args.scheduler:
+        raise ValueError("`--parallel` needs `--scheduler DDIMParallelScheduler` or `DDPMParallelScheduler`.")
+    if args.per_view_noise and args.seed is None:
+        raise ValueError("`--per_view_noise` needs a `--seed`.")
+    if args.checkpoint_steps is not None and (args.parallel is not None or args.deep_cache_interval is not None
+                                              or args.freeze_threshold is not None):
+        raise ValueError("`--checkpoint_steps` can not be combined with `--parallel`, `--deep_cache_interval` or"
+                         " `--freeze_threshold`.")
 
     return args
 
@@ -186,7 +385,9 @@ def main(args):
         import sys
         sys.path.insert(0, "./6DoF/")
         # use the customized diffusers modules
+        import diffusers
         from diffusers import DDIMScheduler
+        from diffusers.utils.import_utils import is_xformers_available
         from dataset import get_pose
         from CN_encoder import CN_encoder
         from pipeline_zero1to3 import Zero1to3StableDiffusionPipeline
@@ -195,7 +396,9 @@ def main(args):
         import sys
         sys.path.insert(0, "./4DoF/")
         # use the customized diffusers modules
+        import diffusers
         from diffusers import DDIMScheduler
+        from diffusers.utils.import_utils import is_xformers_available
         from dataset import get_pose
         from CN_encoder import CN_encoder
         from pipeline_zero1to3 import Zero1to3StableDiffusionPipeline
@@ -235,7 +438,34 @@ def main(args):
         raise NotImplementedError
 
     T_in = args.T_in
-    OUTPUT_DIR= f"logs_{CaPE_TYPE}/{DATA_TYPE}/N{T_in}M{T_out}"
+    LOG_DIR = f"logs_{CaPE_TYPE}"
+    if args.scheduler != "DDIMScheduler" or args.steps != 50:
+        # keep the results of other samplers apart from the DDIM-50 results, e.g. logs_6DoF_UniPCMultistepScheduler20
+        LOG_DIR += f"_{args.scheduler}{args.steps}"
+    if args.parallel is not None:
+        LOG_DIR += f"_parallel{args.parallel}"
+    if args.warm_start_angle is not None:
+        LOG_DIR += f"_warm{args.warm_start_angle:g}"
+    if args.freeze_threshold is not None:
+        LOG_DIR += f"_freeze{args.freeze_threshold:g}"
+    if args.deep_cache_interval is not None:
+        LOG_DIR += f"_deepcache{args.deep_cache_interval}b{args.deep_cache_branch}"
+    if args.view_neighbors is not None:
+        LOG_DIR += f"_neighbors{args.view_neighbors}a{args.view_anchors}"
+    if args.reference_token_budget is not None:
+        LOG_DIR += f"_budget{args.reference_token_budget}"
+    if args.tome_ratio is not None:
+        LOG_DIR += "_tome" + "-".join(f"{ratio:g}" for ratio in args.tome_ratio)
+    if args.per_view_noise:
+        LOG_DIR += "_viewnoise"
+    # keep the results of the guidance schedules apart, e.g. logs_6DoF_interval0-0.6, compared by eval_guidance.py
+    if args.guidance_interval is not None:
+        LOG_DIR += f"_interval{args.guidance_interval[0]:g}-{args.guidance_interval[1]:g}"
+    if args.guidance_decay is not None:
+        LOG_DIR += f"_{args.guidance_decay}"
+    if args.guidance_stop_threshold is not None:
+        LOG_DIR += f"_stop{args.guidance_stop_threshold:g}"
+    OUTPUT_DIR= f"{LOG_DIR}/{DATA_TYPE}/N{T_in}M{T_out}"
     os.makedirs(OUTPUT_DIR, exist_ok=True)
 
     # get all folders in DATA_DIR
@@ -262,33 +492,134 @@ def main(args):
     )
 
     # Init pipeline
-    scheduler = DDIMScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler",
-                                              revision=args.revision)
-    image_encoder = CN_encoder.from_pretrained(args.pretrained_model_name_or_path, subfolder="image_encoder", revision=args.revision)
-    pipeline = Zero1to3StableDiffusionPipeline.from_pretrained(
-        args.pretrained_model_name_or_path,
-        revision=args.revision,
-        scheduler=scheduler,
-        image_encoder=None,
-        safety_checker=None,
-        feature_extractor=None,
-        torch_dtype=weight_dtype,
-    )
-    pipeline.image_encoder = image_encoder
+    load_start = time.perf_counter()
+    if args.bundle is not None:
+        # the weights are memory-mapped from the bundle directly onto the device, see `export_bundle.py`
+        pipeline = Zero1to3StableDiffusionPipeline.from_bundle(args.bundle, device)
+        if args.scheduler != "DDIMScheduler":
+            pipeline.scheduler = getattr(diffusers, args.scheduler).from_config(pipeline.scheduler.config)
+    else:
+        scheduler = DDIMScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler",
+                                                  revision=args.revision)
+        if args.scheduler != "DDIMScheduler":
+            scheduler = getattr(diffusers, args.scheduler).from_config(scheduler.config)
+        image_encoder = CN_encoder.from_pretrained(args.pretrained_model_name_or_path, subfolder="image_encoder", revision=args.revision)
+        pipeline = Zero1to3StableDiffusionPipeline.from_pretrained(
+            args.pretrained_model_name_or_path,
+            revision=args.revision,
+            scheduler=scheduler,
+            image_encoder=None,
+            safety_checker=None,
+            feature_extractor=None,
+            torch_dtype=weight_dtype,
+        )
+        pipeline.image_encoder = image_encoder
     pipeline = pipeline.to(device)
+    print(f"Pipeline loaded in {time.perf_counter() - load_start:.2f}s")
     pipeline.set_progress_bar_config(disable=False)
 
     if args.enable_xformers_memory_efficient_attention:
-        pipeline.enable_xformers_memory_efficient_attention()
+        # without xformers (e.g. on CPU) the default CaPE scaled dot-product attention processor is kept
+        if args.view_neighbors is not None:
+            print("--view_neighbors requires the CaPE scaled dot-product attention, not enabling xformers.")
+        elif args.freeze_threshold is not None:
+            print("--freeze_threshold requires the CaPE scaled dot-product attention, not enabling xformers.")
+        elif args.chunked_attention:
+            print("--chunked_attention is set, not enabling xformers.")
+        elif is_xformers_available():
+            pipeline.enable_xformers_memory_efficient_attention()
+        else:
+            print("xformers is not available, using CaPE scaled dot-product attention instead.")
         # enable vae slicing
         pipeline.enable_vae_slicing()
-
-    if args.seed is None:
+    if args.chunked_attention:
+        max_memory = None if args.attention_max_memory is None else int(args.attention_max_memory * 2 ** 30)
+        pipeline.enable_chunked_attention(max_memory)
+    if args.fuse_qkv_projections:
+        pipeline.fuse_qkv_projections()
+    if args.tome_ratio is not None:
+        pipeline.enable_token_merging(args.tome_ratio[0] if len(args.tome_ratio) == 1 else args.tome_ratio)
+
+    if args.seed is None or args.per_view_noise:
         generator = None
     else:
         generator = torch.Generator(device=device).manual_seed(args.seed)
 
 
+    pipeline_kwargs = dict(
+        height=h, width=w, guidance_scale=args.guidance_scale, num_inference_steps=args.steps, generator=generator,
+        cache_reference_kv=args.cache_reference_kv, null_condition_attention=args.null_condition_attention,
+        guidance_interval=args.guidance_interval, guidance_decay=args.guidance_decay,
+        guidance_stop_threshold=args.guidance_stop_threshold, deep_cache_interval=args.deep_cache_interval,
+        deep_cache_branch=args.deep_cache_branch, parallel=args.parallel, parallel_tolerance=args.parallel_tolerance,
+        warm_start_angle=None if args.warm_start_angle is None else math.radians(args.warm_start_angle),
+        warm_start_strength=args.warm_start_strength, warm_start_inversion=args.warm_start_inversion,
+        freeze_threshold=args.freeze_threshold, vae_chunk_size=args.vae_chunk_size, output_type="uint8",
+        view_seed=args.seed if args.per_view_noise else None,
+    )
+
+    def save_results(obj_name, input_image, gt_image, image):
+        output_dir = os.path.join(OUTPUT_DIR, obj_name)
+        os.makedirs(output_dir, exist_ok=True)
+        # save input image for visualization
+        imsave(os.path.join(output_dir, 'input.png'),
+               ((np.concatenate(input_image.permute(0, 2, 3, 1).cpu().numpy(), 1) + 1) / 2 * 255).astype(np.uint8))
+        # save output image
+        if T_out >= 100:
+            # save to N imgs
+            for i in range(T_out):
+                imsave(os.path.join(output_dir, f'{i}.png'), image[i])
+            # make a gif
+            frames = [Image.fromarray(image[i]) for i in range(T_out)]
+            frame_one = frames[0]
+            frame_one.save(os.path.join(output_dir, "output.gif"), format="GIF", append_images=frames,
+                           save_all=True, duration=50, loop=1)
+        else:
+            imsave(os.path.join(output_dir, '0.png'), np.concatenate(image, 1))
+            # save gt for visualization
+            if len(gt_image)>0:
+                imsave(os.path.join(output_dir, 'gt.png'),
+                       ((np.concatenate(gt_image.permute(0, 2, 3, 1).cpu().numpy(), 1) + 1) / 2 * 255).astype(np.uint8))
+
+    inference_times = {}
+
+    # target views per UNet call, the average active batch with `--freeze_threshold`
+    active_views = []
+    if args.freeze_threshold is not None:
+        pipeline.unet.register_forward_pre_hook(
+            lambda _, inputs, kwargs: active_views.append(inputs[0].shape[0] // kwargs["encoder_hidden_states"].shape[0]),
+            with_kwargs=True,
+        )
+
+    def run_batch(objects):
+        checkpoint_kwargs = {}
+        if args.checkpoint_steps is not None:
+            # one checkpoint per pipeline call, next to the results of its first object, removed once the results of
+            # all its objects are saved
+            checkpoint_dir = os.path.join(OUTPUT_DIR, objects[0]["name"])
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            checkpoint_kwargs = dict(checkpoint_path=os.path.join(checkpoint_dir, "checkpoint.pt"),
+                                     checkpoint_steps=args.checkpoint_steps)
+        start_time = time.perf_counter()
+        with torch.autocast("cuda"):
+            if len(objects) == 1:
+                obj = objects[0]
+                images = [pipeline(input_imgs=obj["input_imgs"], prompt_imgs=obj["input_imgs"], poses=obj["poses"],
+                                   T_in=T_in, T_out=T_out, view_neighbors=args.view_neighbors,
+                                   view_anchors=args.view_anchors, reference_token_budget=args.reference_token_budget,
+                                   object_ids=[obj["object_id"]], view_indices=obj["view_indices"],
+                                   **pipeline_kwargs, **checkpoint_kwargs).images]
+            else:
+                images = pipeline.generate_batch(objects, **pipeline_kwargs, **checkpoint_kwargs)
+        # the time of a packed batch is shared evenly by its objects
+        elapsed = (time.perf_counter() - start_time) / len(objects)
+        for obj, image in zip(objects, images):
+            inference_times[obj["name"]] = elapsed
+            save_results(obj["name"], obj["input_imgs"], obj["gt_image"], image)
+        if checkpoint_kwargs:
+            os.remove(checkpoint_kwargs["checkpoint_path"])
+
+    pending = []
     for obj_name in tqdm(obj_names):
         print(f"Processing {obj_name}")
         if DATA_TYPE == "NeRF":
@@ -525,42 +856,28 @@ def main(args):
         assert T_in == pose_in.shape[1]
         assert T_out == pose_out.shape[1]
 
-        # run inference
+        # run inference, the objects are packed into batches of `--objects_per_batch`
         if CaPE_TYPE == "6DoF":
-            with torch.autocast("cuda"):
-                image = pipeline(input_imgs=input_image, prompt_imgs=input_image, poses=[[pose_out, pose_out_inv], [pose_in, pose_in_inv]],
-                                 height=h, width=w, T_in=T_in, T_out=T_out,
-                                 guidance_scale=args.guidance_scale, num_inference_steps=50, generator=generator,
-                                 output_type="numpy").images
+            poses = [[pose_out, pose_out_inv], [pose_in, pose_in_inv]]
         elif CaPE_TYPE == "4DoF":
-            with torch.autocast("cuda"):
-                image = pipeline(input_imgs=input_image, prompt_imgs=input_image, poses=[pose_out, pose_in],
-                                 height=h, width=w, T_in=T_in, T_out=T_out,
-                                 guidance_scale=args.guidance_scale, num_inference_steps=50, generator=generator,
-                                 output_type="numpy").images
-
-        # save results
-        output_dir = os.path.join(OUTPUT_DIR, obj_name)
-        os.makedirs(output_dir, exist_ok=True)
-        # save input image for visualization
-        imsave(os.path.join(output_dir, 'input.png'),
-               ((np.concatenate(input_image.permute(0, 2, 3, 1).cpu().numpy(), 1) + 1) / 2 * 255).astype(np.uint8))
-        # save output image
-        if T_out >= 100:
-            # save to N imgs
-            for i in range(T_out):
-                imsave(os.path.join(output_dir, f'{i}.png'), (image[i] * 255).astype(np.uint8))
-            # make a gif
-            frames = [Image.fromarray((image[i] * 255).astype(np.uint8)) for i in range(T_out)]
-            frame_one = frames[0]
-            frame_one.save(os.path.join(output_dir, "output.gif"), format="GIF", append_images=frames,
-                           save_all=True, duration=50, loop=1)
-        else:
-            imsave(os.path.join(output_dir, '0.png'), (np.concatenate(image, 1) * 255).astype(np.uint8))
-            # save gt for visualization
-            if len(gt_image)>0:
-                imsave(os.path.join(output_dir, 'gt.png'),
-                       ((np.concatenate(gt_image.permute(0, 2, 3, 1).cpu().numpy(), 1) + 1) / 2 * 255).astype(np.uint8))
+            poses = [pose_out, pose_in]
+        # a stable id of the object and the dataset indices of its target views for `--per_view_noise`
+        object_id = zlib.crc32(obj_name.encode())
+        pending.append(dict(name=obj_name, object_id=object_id, view_indices=torch.as_tensor(test_index),
+                            input_imgs=input_image, poses=poses, gt_image=gt_image))
+        if len(pending) == args.objects_per_batch:
+            run_batch(pending)
+            pending = []
+    if len(pending) > 0:
+        run_batch(pending)
+
+    # inference time per object, to compare the speed-ups against the metrics of metrics/eval_2D_NVS.py
+    if len(inference_times) > 0:
+        with open(os.path.join(OUTPUT_DIR, "inference_times.json"), "w") as f:
+            json.dump(inference_times, f, indent=2)
+        print(f"Mean inference time per object: {np.mean(list(inference_times.values())):.2f}s")
+    if len(active_views) > 0:
+        print(f"Mean active target views per UNet call: {np.mean(active_views):.2f} of {T_out}")
 
 
 
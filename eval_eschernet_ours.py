@@ -15,6 +15,7 @@
 
 import argparse
 import os
+import time
 import einops
 import numpy as np
 import torch
@@ -121,6 +122,88 @@ def parse_args(input_args=None):
     parser.add_argument(
         "--enable_xformers_memory_efficient_attention", default=True, help="Whether or not to use xformers."
     )
+    parser.add_argument(
+        "--cache_reference_kv",
+        action="store_true",
+        help="Whether or not to cache the cross-attention keys/values of the reference views across denoising steps.",
+    )
+    parser.add_argument(
+        "--view_neighbors",
+        type=int,
+        default=None,
+        help="If set, each target view only attends to its nearest target views in the multiview self-attention.",
+    )
+    parser.add_argument(
+        "--view_anchors",
+        type=int,
+        default=0,
+        help="Number of global anchor views every target view also attends to, used with --view_neighbors.",
+    )
+    parser.add_argument(
+        "--chunked_attention",
+        action="store_true",
+        help="Whether or not to use memory-bounded chunked attention (e.g. for many target views on CPU).",
+    )
+    parser.add_argument(
+        "--attention_max_memory",
+        type=float,
+        default=None,
+        help="Memory budget in GiB of the chunked attention, defaults to half of the free memory.",
+    )
+    parser.add_argument(
+        "--reference_token_budget",
+        type=int,
+        default=None,
+        help="If set, prune background and merge near-duplicate reference tokens down to this many tokens.",
+    )
+    parser.add_argument(
+        "--null_condition_attention",
+        action="store_true",
+        help="Whether or not to skip the cross-attention of the unconditional classifier-free guidance branch.",
+    )
+    parser.add_argument(
+        "--guidance_interval",
+        type=float,
+        nargs=2,
+        default=None,
+        metavar=("START", "END"),
+        help="Only apply classifier-free guidance on this interval of the denoising steps, as fractions in [0, 1].",
+    )
+    parser.add_argument(
+        "--guidance_decay",
+        type=str,
+        default=None,
+        choices=["linear", "cosine"],
+        help="Decay the guidance scale to 1 over the denoising steps.",
+    )
+    parser.add_argument(
+        "--guidance_stop_threshold",
+        type=float,
+        default=None,
+        help="Stop classifier-free guidance once the relative cond/uncond noise difference falls below this value.",
+    )
+    parser.add_argument(
+        "--fuse_qkv_projections",
+        action="store_true",
+        help="Whether or not to fuse the query, key and value projections of the UNet self-attention.",
+    )
+    parser.add_argument(
+        "--tome_ratio",
+        type=float,
+        nargs="+",
+        default=None,
+        help=(
+            "If set, merge this fraction of the tokens of every target view in the multiview self-attention (ToMe)."
+            " One value for all resolution levels, or one value per level from the highest resolution to the lowest."
+        ),
+    )
+    parser.add_argument(
+        "--checkpoint_steps",
+        type=int,
+        default=None,
+        help="If set, save the denoising state of every object every this many steps and resume from it when the"
+        " evaluation is restarted, e.g. after the job was killed at its time limit.",
+    )
 
 
 
@@ -187,6 +270,7 @@ def main(args):
         sys.path.insert(0, "./6DoF/")
         # use the customized diffusers modules
         from diffusers import DDIMScheduler
+        from diffusers.utils.import_utils import is_xformers_available
         from dataset import get_pose
         from CN_encoder import CN_encoder
         from pipeline_zero1to3 import Zero1to3StableDiffusionPipeline
@@ -196,6 +280,7 @@ def main(args):
         sys.path.insert(0, "./4DoF/")
         # use the customized diffusers modules
         from diffusers import DDIMScheduler
+        from diffusers.utils.import_utils import is_xformers_available
         from dataset import get_pose
         from CN_encoder import CN_encoder
         from pipeline_zero1to3 import Zero1to3StableDiffusionPipeline
@@ -283,9 +368,24 @@ def main(args):
     pipeline.set_progress_bar_config(disable=False)
 
     if args.enable_xformers_memory_efficient_attention:
-        pipeline.enable_xformers_memory_efficient_attention()
+        # without xformers (e.g. on CPU) the default CaPE scaled dot-product attention processor is kept
+        if args.view_neighbors is not None:
+            print("--view_neighbors requires the CaPE scaled dot-product attention, not enabling xformers.")
+        elif args.chunked_attention:
+            print("--chunked_attention is set, not enabling xformers.")
+        elif is_xformers_available():
+            pipeline.enable_xformers_memory_efficient_attention()
+        else:
+            print("xformers is not available, using CaPE scaled dot-product attention instead.")
         # enable vae slicing
         pipeline.enable_vae_slicing()
+    if args.chunked_attention:
+        max_memory = None if args.attention_max_memory is None else int(args.attention_max_memory * 2 ** 30)
+        pipeline.enable_chunked_attention(max_memory)
+    if args.fuse_qkv_projections:
+        pipeline.fuse_qkv_projections()
+    if args.tome_ratio is not None:
+        pipeline.enable_token_merging(args.tome_ratio[0] if len(args.tome_ratio) == 1 else args.tome_ratio)
 
     if args.seed is None:
         generator = None
@@ -293,6 +393,7 @@ def main(args):
         generator = torch.Generator(device=device).manual_seed(args.seed)
 
 
+    inference_times = {}
     for obj_name in tqdm(obj_names):
         print(f"Processing {obj_name}")
         if DATA_TYPE == "NeRF":
@@ -589,19 +690,39 @@ def main(args):
         assert T_in == pose_in.shape[1]
         assert T_out == pose_out.shape[1]
 
+        checkpoint_kwargs = {}
+        if args.checkpoint_steps is not None:
+            # removed once the results of the object are saved
+            os.makedirs(os.path.join(OUTPUT_DIR, obj_name), exist_ok=True)
+            checkpoint_kwargs = dict(checkpoint_path=os.path.join(OUTPUT_DIR, obj_name, "checkpoint.pt"),
+                                     checkpoint_steps=args.checkpoint_steps)
+
         # run inference
+        start_time = time.perf_counter()
         if CaPE_TYPE == "6DoF":
             with torch.autocast("cuda"):
                 image = pipeline(input_imgs=input_image, prompt_imgs=input_image, poses=[[pose_out, pose_out_inv], [pose_in, pose_in_inv]],
                                  height=h, width=w, T_in=T_in, T_out=T_out,
                                  guidance_scale=args.guidance_scale, num_inference_steps=50, generator=generator,
-                                 output_type="numpy").images
+                                 cache_reference_kv=args.cache_reference_kv, view_neighbors=args.view_neighbors,
+                                 view_anchors=args.view_anchors, reference_token_budget=args.reference_token_budget,
+                                 null_condition_attention=args.null_condition_attention,
+                                 guidance_interval=args.guidance_interval, guidance_decay=args.guidance_decay,
+                                 guidance_stop_threshold=args.guidance_stop_threshold,
+                                 output_type="numpy", **checkpoint_kwargs).images
         elif CaPE_TYPE == "4DoF":
             with torch.autocast("cuda"):
                 image = pipeline(input_imgs=input_image, prompt_imgs=input_image, poses=[pose_out, pose_in],
                                  height=h, width=w, T_in=T_in, T_out=T_out,
                                  guidance_scale=args.guidance_scale, num_inference_steps=50, generator=generator,
-                                 output_type="numpy").images
+                                 cache_reference_kv=args.cache_reference_kv, view_neighbors=args.view_neighbors,
+                                 view_anchors=args.view_anchors, reference_token_budget=args.reference_token_budget,
+                                 null_condition_attention=args.null_condition_attention,
+                                 guidance_interval=args.guidance_interval, guidance_decay=args.guidance_decay,
+                                 guidance_stop_threshold=args.guidance_stop_threshold,
+                                 output_type="numpy", **checkpoint_kwargs).images
+
+        inference_times[obj_name] = time.perf_counter() - start_time
 
         # save results
         output_dir = os.path.join(OUTPUT_DIR, obj_name)
@@ -625,6 +746,14 @@ def main(args):
             if len(gt_image)>0:
                 imsave(os.path.join(output_dir, 'gt.png'),
                        ((np.concatenate(gt_image.permute(0, 2, 3, 1).cpu().numpy(), 1) + 1) / 2 * 255).astype(np.uint8))
+        if checkpoint_kwargs:
+            os.remove(checkpoint_kwargs["checkpoint_path"])
+
+    # inference time per object, to compare the speed-ups against the metrics of metrics/eval_2D_NVS.py
+    if len(inference_times) > 0:
+        with open(os.path.join(OUTPUT_DIR, "inference_times.json"), "w") as f:
+            json.dump(inference_times, f, indent=2)
+        print(f"Mean inference time per object: {np.mean(list(inference_times.values())):.2f}s")
 
 
 
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding=utf-8
+# PSNR/LPIPS vs. time of the classifier-free guidance schedules on GSO25. Every setting is evaluated with
+# eval_eschernet.py into its own log folder (skipped if its inference_times.json exists), the test views 10-24 are
+# scored as in metrics/eval_2D_NVS.py, and one row per setting and T_in is appended to a CSV file.
+#
+#   python eval_guidance.py --cape_type 6DoF --pretrained_model_name_or_path kxic/eschernet-6dof \
+#       --data_dir ./demo/GSO30 --T_ins 1 3
+
+import argparse
+import csv
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+# eval_eschernet.py flags and log folder suffix of every guidance setting, "full" guides all steps
+SETTINGS = {
+    "full": ([], ""),
+    "interval0-0.6": (["--guidance_interval", "0", "0.6"], "_interval0-0.6"),
+    "interval0-0.4": (["--guidance_interval", "0", "0.4"], "_interval0-0.4"),
+    "linear": (["--guidance_decay", "linear"], "_linear"),
+    "cosine": (["--guidance_decay", "cosine"], "_cosine"),
+    "stop0.05": (["--guidance_stop_threshold", "0.05"], "_stop0.05"),
+    "stop0.1": (["--guidance_stop_threshold", "0.1"], "_stop0.1"),
+}
+TEST_VIEWS = range(10, 25)
+
+
+def parse_args(input_args=None):
+    parser = argparse.ArgumentParser(description="PSNR/LPIPS vs. time of the guidance schedules on GSO25.")
+    parser.add_argument("--cape_type", type=str, default="6DoF", choices=["4DoF", "6DoF"])
+    parser.add_argument(
+        "--pretrained_model_name_or_path", type=str, default=None, help="Passed to eval_eschernet.py, if set."
+    )
+    parser.add_argument("--data_dir", type=str, default="./demo/GSO30", help="The GSO objects with render_mvs_25.")
+    parser.add_argument("--T_ins", type=int, nargs="+", default=[1, 2, 3, 5, 10])
+    parser.add_argument("--settings", type=str, nargs="+", default=list(SETTINGS), choices=list(SETTINGS))
+    parser.add_argument(
+        "--eval_args", type=str, nargs=argparse.REMAINDER, default=[],
+        help="Further eval_eschernet.py arguments that keep its log folder, e.g. --bundle or --cache_reference_kv.",
+    )
+    parser.add_argument("--output", type=str, default=None, help="Defaults to logs_<cape_type>_guidance.csv.")
+
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+    return args
+
+
+def load_rgb(path, size=None):
+    # [H, W, 3] uint8 on a white background, as metrics/eval_2D_NVS.py loads the images
+    from matplotlib import pyplot as plt
+    from PIL import Image
+
+    img = plt.imread(path)
+    if img.shape[-1] == 4:
+        img[img[:, :, -1] == 0.] = [1., 1., 1., 1.]
+    img = Image.fromarray(np.uint8(img[:, :, :3] * 255.))
+    if size is not None:
+        img = img.resize((size, size))
+    return np.array(img)
+
+
+def score(log_dir, data_dir):
+    # mean PSNR, SSIM and LPIPS over the objects, each averaged over its test views
+    import cv2
+    import lpips
+    import torch
+    from skimage.metrics import structural_similarity as calculate_ssim
+
+    lpips_fn = lpips.LPIPS(net='alex', version='0.1')
+
+    def to_tensor(x):
+        # [H, W, 3] uint8 -> [3, H, W] in [-1, 1]
+        return torch.from_numpy(x).permute(2, 0, 1).float() / 127.5 - 1
+
+    objects = sorted(f for f in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, f)))
+    metrics = []
+    for obj in objects:
+        pred_all = load_rgb(os.path.join(log_dir, obj, "0.png"))
+        views = []
+        for i in TEST_VIEWS:
+            gt = load_rgb(os.path.join(data_dir, obj, "render_mvs_25", "model", f"{i:03d}.png"), 256)
+            pred = pred_all[:, 256 * i:256 * (i + 1)]
+            with torch.no_grad():
+                lpips_i = lpips_fn(to_tensor(pred), to_tensor(gt)).item()
+            views.append((cv2.PSNR(gt, pred), calculate_ssim(pred, gt, channel_axis=2), lpips_i))
+        metrics.append(np.mean(views, axis=0))
+    return len(objects), np.mean(metrics, axis=0)
+
+
+def main(args):
+    output = args.output or f"logs_{args.cape_type}_guidance.csv"
+    new_file = not os.path.exists(output)
+    with open(output, "a", newline="") as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(["setting", "T_in", "objects", "psnr", "ssim", "lpips", "seconds_per_object"])
+        for T_in in args.T_ins:
+            for setting in args.settings:
+                flags, suffix = SETTINGS[setting]
+                log_dir = os.path.join(f"logs_{args.cape_type}{suffix}", "GSO25", f"N{T_in}M25")
+                times_path = os.path.join(log_dir, "inference_times.json")
+                if not os.path.exists(times_path):
+                    model = ([] if args.pretrained_model_name_or_path is None
+                             else ["--pretrained_model_name_or_path", args.pretrained_model_name_or_path])
+                    subprocess.run([sys.executable, "eval_eschernet.py", "--cape_type", args.cape_type, *model,
+                                    "--data_type", "GSO25", "--data_dir", args.data_dir, "--T_in", str(T_in),
+                                    *flags, *args.eval_args], check=True)
+                with open(times_path) as times:
+                    seconds = np.mean(list(json.load(times).values()))
+                num_objects, (psnr, ssim, lpips) = score(log_dir, args.data_dir)
+                writer.writerow([setting, T_in, num_objects, f"{psnr:.3f}", f"{ssim:.4f}", f"{lpips:.4f}",
+                                 f"{seconds:.2f}"])
+                f.flush()
+                print(f"{setting} T_in={T_in}: PSNR {psnr:.2f}, SSIM {ssim:.3f}, LPIPS {lpips:.3f}, "
+                      f"{seconds:.2f} s/object")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# coding=utf-8
+# Export an EscherNet checkpoint to a single safetensors bundle with the UNet, VAE and ConvNeXt image encoder weights
+# in the inference dtype and the configs of all components. Loading the bundle with `eval_eschernet.py --bundle`
+# memory-maps it into modules created on the meta device, instead of resolving the Hub cache and building every module
+# in float32 before casting it.
+#
+#   python export_bundle.py --cape_type 6DoF --pretrained_model_name_or_path kxic/eschernet-6dof \
+#       --output eschernet-6dof-fp16.safetensors
+
+import argparse
+import os
+import sys
+
+import torch
+
+DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}
+
+
+def parse_args(input_args=None):
+    parser = argparse.ArgumentParser(description="Export an EscherNet pipeline to a single safetensors bundle.")
+    parser.add_argument("--cape_type", type=str, default="6DoF", choices=["4DoF", "6DoF"])
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        required=True,
+        help="Path to pretrained model or model identifier from huggingface.co/models.",
+    )
+    parser.add_argument("--revision", type=str, default=None, required=False)
+    parser.add_argument("--output", type=str, required=True, help="Path of the safetensors bundle.")
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="fp16",
+        choices=sorted(DTYPES),
+        help="Dtype of the exported weights, the dtype the pipeline runs in after loading the bundle.",
+    )
+
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+    return args
+
+
+def main(args):
+    # use the customized diffusers modules
+    sys.path.insert(0, f"./{args.cape_type}/")
+    from diffusers import DDIMScheduler
+    from CN_encoder import CN_encoder
+    from pipeline_zero1to3 import Zero1to3StableDiffusionPipeline
+
+    # the components as loaded by eval_eschernet.py
+    scheduler = DDIMScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler",
+                                              revision=args.revision)
+    image_encoder = CN_encoder.from_pretrained(args.pretrained_model_name_or_path, subfolder="image_encoder",
+                                               revision=args.revision)
+    pipeline = Zero1to3StableDiffusionPipeline.from_pretrained(
+        args.pretrained_model_name_or_path,
+        revision=args.revision,
+        scheduler=scheduler,
+        image_encoder=None,
+        safety_checker=None,
+        feature_extractor=None,
+    )
+    pipeline.image_encoder = image_encoder
+
+    pipeline.save_bundle(args.output, DTYPES[args.dtype])
+    print(f"Saved {args.output} ({os.path.getsize(args.output) / 2 ** 20:.0f} MiB, {args.dtype})")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the reference CaPE.py
+sys.path.insert(0, ROOT)
+
+# modules of the 4DoF and 6DoF trees, which share their names
+TREE_MODULES = ("diffusers", "unet_2d_condition", "CN_encoder", "pipeline_zero1to3", "dataset", "reference_tokens")
+
+
+def use_cape_type(cape_type):
+    # use the customized diffusers modules of one tree, dropping the ones of the other tree
+    for name in list(sys.modules):
+        if name.split(".")[0] in TREE_MODULES:
+            del sys.modules[name]
+    for tree in ("4DoF", "6DoF"):
+        if os.path.join(ROOT, tree) in sys.path:
+            sys.path.remove(os.path.join(ROOT, tree))
+    sys.path.insert(0, os.path.join(ROOT, cape_type))
+
+
+@pytest.fixture(scope="module", params=["4DoF", "6DoF"])
+def cape_type(request):
+    # tests import the tree modules inside the test, after this fixture
+    use_cape_type(request.param)
+    return request.param
+
+
+@pytest.fixture(scope="session")
+def CaPE():
+    # CaPE.py checks itself on random poses when imported, with a fixed seed as in benchmark_eschernet.py
+    with torch.random.fork_rng():
+        torch.manual_seed(0)
+        import CaPE
+    return CaPE
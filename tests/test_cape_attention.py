@@ -0,0 +1,88 @@
+# Multiview self- and cross-attention of the CaPE attention processors vs. the reference attention of CaPE.py: per
+# head scores of `attn_with_CaPE`, softmax and `head_to_batch_dim` values.
+#
+#   python -m pytest tests
+
+import pytest
+import torch
+
+BATCH_SIZE = 2  # classifier-free guidance
+T_IN = 3
+T_OUT = 2
+TOKENS = 16  # tokens per view
+
+
+def random_poses(cape_type, device):
+    # random camera poses in the layout expected by the pipeline
+    if cape_type == "6DoF":
+        def rigid(t):
+            rot, _ = torch.linalg.qr(torch.randn(BATCH_SIZE, t, 3, 3))
+            pose = torch.eye(4).repeat(BATCH_SIZE, t, 1, 1)
+            pose[..., :3, :3] = rot
+            pose[..., :3, 3] = torch.randn(BATCH_SIZE, t, 3)
+            return pose.to(device)
+
+        pose_out, pose_in = rigid(T_OUT), rigid(T_IN)
+        return [[pose_out, torch.linalg.inv(pose_out).transpose(-1, -2)],
+                [pose_in, torch.linalg.inv(pose_in).transpose(-1, -2)]]
+    # [theta, azimuth, radius, 0]
+    pose_out, pose_in = torch.randn(BATCH_SIZE, T_OUT, 4), torch.randn(BATCH_SIZE, T_IN, 4)
+    pose_out[..., 3], pose_in[..., 3] = 0, 0
+    return [pose_out.to(device), pose_in.to(device)]
+
+
+def reference_attention(CaPE, cape_type, attn, hidden_states, encoder_hidden_states, posemb):
+    if cape_type == "6DoF":
+        cape, pose_out, pose_in = CaPE.CaPE_6DoF(), posemb[0][0], posemb[1][0]
+    else:
+        cape, pose_out, pose_in = CaPE.CaPE_4DoF(), posemb[0], posemb[1]
+    pose_key = pose_out if encoder_hidden_states is None else pose_in
+
+    hidden_states = hidden_states.reshape(BATCH_SIZE, T_OUT * TOKENS, -1)
+    context = hidden_states if encoder_hidden_states is None else encoder_hidden_states
+    query = attn.to_q(hidden_states)
+    key = attn.to_k(context)
+    value = attn.head_to_batch_dim(attn.to_v(context))
+    # the scores of head h are the CaPE attention of the query channels of h
+    head_dim = query.shape[-1] // attn.heads
+    masks = torch.eye(attn.heads, device=query.device).repeat_interleave(head_dim, dim=1)
+    scores = torch.stack([cape.attn_with_CaPE(query * mask, key, pose_out, pose_key) for mask in masks], dim=1)
+    probs = (scores.flatten(0, 1) * attn.scale).softmax(dim=-1)
+    hidden_states = attn.to_out[1](attn.to_out[0](attn.batch_to_head_dim(probs @ value)))
+    return hidden_states.reshape(BATCH_SIZE * T_OUT, TOKENS, -1)
+
+
+@pytest.mark.parametrize("processor_name", ["CaPEAttnProcessor2_0", "CaPEChunkedAttnProcessor",
+                                            "XFormersAttnProcessor"])
+@pytest.mark.parametrize("cross_attention", [False, True], ids=["self-attn", "cross-attn"])
+def test_cape_attention(CaPE, cape_type, processor_name, cross_attention):
+    from diffusers.models import attention_processor
+    from diffusers.utils.import_utils import is_xformers_available
+
+    device = "cpu"
+    if processor_name == "XFormersAttnProcessor":
+        if not is_xformers_available():
+            pytest.skip("xformers is not installed")
+        if not torch.cuda.is_available():
+            pytest.skip("xformers' memory efficient attention requires a GPU")
+        device = "cuda"
+        processor = attention_processor.XFormersAttnProcessor()
+    elif processor_name == "CaPEChunkedAttnProcessor":
+        # a memory budget of a few query tokens per chunk
+        processor = attention_processor.CaPEChunkedAttnProcessor(max_memory=2 ** 12)
+    else:
+        processor = attention_processor.CaPEAttnProcessor2_0()
+
+    torch.manual_seed(0)
+    attn = attention_processor.Attention(320, cross_attention_dim=768 if cross_attention else None, heads=8,
+                                         dim_head=40, cape=True).to(device).eval()
+    attn.set_processor(processor)
+    posemb = random_poses(cape_type, device)
+    hidden_states = torch.randn(BATCH_SIZE * T_OUT, TOKENS, 320, device=device)
+    encoder_hidden_states = torch.randn(BATCH_SIZE, T_IN * TOKENS, 768, device=device) if cross_attention else None
+
+    with torch.no_grad():
+        expected = reference_attention(CaPE, cape_type, attn, hidden_states, encoder_hidden_states, posemb)
+        output = attn(hidden_states, encoder_hidden_states=encoder_hidden_states, posemb=posemb)
+
+    torch.testing.assert_close(output, expected, rtol=0, atol=1e-5)